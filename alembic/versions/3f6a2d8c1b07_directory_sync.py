@@ -0,0 +1,38 @@
+"""directory sync
+
+Revision ID: 3f6a2d8c1b07
+Revises: b7d3c91e5f24
+Create Date: 2026-10-18 20:41:37.552810
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '3f6a2d8c1b07'
+down_revision = 'b7d3c91e5f24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'directory_sync',
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('corp_id', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('cursor', sa.String(), nullable=True),
+        sa.Column('synced_users', sa.Integer(), nullable=False),
+        sa.Column('started_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('finished_at', sa.DateTime(timezone=True), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('corp_id', name='uq_directory_sync_corp_id'),
+    )
+
+
+def downgrade():
+    op.drop_table('directory_sync')
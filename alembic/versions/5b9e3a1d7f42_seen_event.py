@@ -0,0 +1,35 @@
+"""seen event
+
+Revision ID: 5b9e3a1d7f42
+Revises: d2a7c5e9b318
+Create Date: 2026-10-18 22:58:19.640285
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '5b9e3a1d7f42'
+down_revision = 'd2a7c5e9b318'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'seen_event',
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_key', sa.String(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('event_key', name='uq_seen_event_event_key'),
+    )
+    op.create_index('ix_seen_event_expires_at', 'seen_event', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_seen_event_expires_at', table_name='seen_event')
+    op.drop_table('seen_event')
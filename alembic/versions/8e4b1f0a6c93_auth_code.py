@@ -0,0 +1,36 @@
+"""auth code
+
+Revision ID: 8e4b1f0a6c93
+Revises: 3f6a2d8c1b07
+Create Date: 2026-10-18 21:26:08.913442
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = '8e4b1f0a6c93'
+down_revision = '3f6a2d8c1b07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'auth_code',
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('auth_code', sa.String(), nullable=False),
+        sa.Column('payload', sa.String(), nullable=False),
+        sa.Column('expires_at', sa.DateTime(timezone=True), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('auth_code', name='uq_auth_code_auth_code'),
+    )
+    op.create_index('ix_auth_code_expires_at', 'auth_code', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_auth_code_expires_at', table_name='auth_code')
+    op.drop_table('auth_code')
@@ -0,0 +1,26 @@
+"""event inbox order key
+
+Revision ID: a9c3e7f1d5b8
+Revises: e4b8d1f6a2c5
+Create Date: 2026-10-19 14:26:53.604219
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'a9c3e7f1d5b8'
+down_revision = 'e4b8d1f6a2c5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('event_inbox', sa.Column('order_key', sa.String(), nullable=True))
+    op.create_index('ix_event_inbox_order_key_status', 'event_inbox', ['order_key', 'status'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_event_inbox_order_key_status', table_name='event_inbox')
+    op.drop_column('event_inbox', 'order_key')
@@ -0,0 +1,39 @@
+"""dingding_user indexes
+
+Revision ID: b7d3c91e5f24
+Revises: 562081c7444b
+Create Date: 2026-10-18 18:05:12.218734
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'b7d3c91e5f24'
+down_revision = '562081c7444b'
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    'ix_dingding_user_user_id': ['user_id'],
+    'ix_dingding_user_union_id': ['union_id'],
+    'ix_dingding_user_tenant_id_staff_id': ['tenant_id', 'staff_id'],
+}
+
+
+def upgrade():
+    # 用户表较大时避免锁表, CREATE INDEX CONCURRENTLY 不能在事务中执行
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES.items():
+            op.create_index(
+                name,
+                'dingding_user',
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+            )
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name in INDEXES:
+            op.drop_index(name, table_name='dingding_user', postgresql_concurrently=True)
@@ -0,0 +1,37 @@
+"""cache event
+
+Revision ID: c6f1e8a3b2d4
+Revises: 5b9e3a1d7f42
+Create Date: 2026-10-19 01:12:46.318204
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'c6f1e8a3b2d4'
+down_revision = '5b9e3a1d7f42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cache_event',
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('kind', sa.String(), nullable=False),
+        sa.Column('key', sa.String(), nullable=False),
+        sa.Column('value', sa.String(), nullable=True),
+        sa.Column('origin', sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint('id'),
+        sqlite_autoincrement=True,
+    )
+    op.create_index('ix_cache_event_created_at', 'cache_event', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_cache_event_created_at', table_name='cache_event')
+    op.drop_table('cache_event')
@@ -0,0 +1,46 @@
+"""event inbox
+
+Revision ID: d2a7c5e9b318
+Revises: 8e4b1f0a6c93
+Create Date: 2026-10-18 22:14:51.307126
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'd2a7c5e9b318'
+down_revision = '8e4b1f0a6c93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'event_inbox',
+        sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('updated_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=False),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('event_type', sa.String(), nullable=False),
+        sa.Column('payload', sa.String(), nullable=False),
+        sa.Column('status', sa.String(), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(timezone=True), nullable=False),
+        sa.Column('claim_id', sa.String(), nullable=True),
+        sa.Column('last_error', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+    )
+    op.create_index(
+        'ix_event_inbox_status_next_attempt_at',
+        'event_inbox',
+        ['status', 'next_attempt_at'],
+        unique=False,
+    )
+    op.create_index('ix_event_inbox_claim_id', 'event_inbox', ['claim_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_event_inbox_claim_id', table_name='event_inbox')
+    op.drop_index('ix_event_inbox_status_next_attempt_at', table_name='event_inbox')
+    op.drop_table('event_inbox')
@@ -0,0 +1,24 @@
+"""outbox report
+
+Revision ID: e4b8d1f6a2c5
+Revises: c6f1e8a3b2d4
+Create Date: 2026-10-19 09:41:07.152836
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = 'e4b8d1f6a2c5'
+down_revision = 'c6f1e8a3b2d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('message_outbox', sa.Column('report', sa.String(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('message_outbox', 'report')
@@ -0,0 +1,56 @@
+"""
+钉钉回调加解密的微基准测试
+
+分别测试 签名 / 加密 / 解密 的吞吐量, 以及每次回调新建实例 (旧的用法) 与共享实例的差异。
+
+    python -m benchmarks.callback_crypto --number 20000
+"""
+import argparse
+import base64
+import json
+import os
+import timeit
+
+from crypto import DingCallbackCrypto3
+
+TOKEN = 'benchmark-token'
+ENCODING_AES_KEY = base64.b64encode(os.urandom(32)).decode()[:-1]
+SUITE_KEY = 'suite-benchmark'
+PAYLOAD = json.dumps(
+    {'EventType': 'sync_http_push_high', 'bizData': [{'bizType': 2, 'bizData': '{"suiteTicket": "x"}'}] * 4}
+)
+
+
+def main(number: int) -> None:
+    dtc = DingCallbackCrypto3(TOKEN, ENCODING_AES_KEY, SUITE_KEY)
+    encrypted = dtc.get_encrypted_map(PAYLOAD)
+    args = (encrypted['msg_signature'], encrypted['timeStamp'], encrypted['nonce'], encrypted['encrypt'])
+    assert dtc.get_decrypt_msg(*args) == PAYLOAD
+
+    def callback_with_new_instance():
+        instance = DingCallbackCrypto3(TOKEN, ENCODING_AES_KEY, SUITE_KEY)
+        instance.get_decrypt_msg(*args)
+        instance.get_encrypted_map('success')
+
+    def callback_with_shared_instance():
+        dtc.get_decrypt_msg(*args)
+        dtc.get_encrypted_map('success')
+
+    cases = {
+        'sign': lambda: dtc.generate_signature(args[2], args[1], TOKEN, args[3]),
+        'encrypt': lambda: dtc.encrypt(PAYLOAD),
+        'decrypt': lambda: dtc.get_decrypt_msg(*args),
+        'nonce': lambda: dtc.generate_random_key(16),
+        'callback (new instance)': callback_with_new_instance,
+        'callback (shared instance)': callback_with_shared_instance,
+    }
+    print(f'payload {len(PAYLOAD)} 字节, 每项 {number} 次')
+    for name, func in cases.items():
+        seconds = min(timeit.repeat(func, number=number, repeat=3))
+        print(f'{name:>28}: {number / seconds:12.0f} ops/s {seconds / number * 1e6:8.2f} us/op')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000)
+    main(parser.parse_args().number)
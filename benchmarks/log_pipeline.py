@@ -0,0 +1,108 @@
+"""
+日志管道基准测试
+
+对比旧的 indent=2 JSONFormatter + 同步 StreamHandler 与 单行 JSONFormatter (json / orjson) 以及
+LogQueueHandler 的开销。日志写入临时文件, 统计的是调用 logger.info 的线程中每条日志的耗时,
+异步 handler 另外统计队列中的日志全部写完的总耗时。
+
+    python -m benchmarks.log_pipeline --number 50000
+"""
+import argparse
+import json
+import logging
+import tempfile
+import time
+from collections.abc import Callable
+from logging import Formatter
+from logging import Handler
+from logging import LogRecord
+from logging import StreamHandler
+
+from tpdingding.middleware.track import JSONFormatter
+from tpdingding.middleware.track import LogExtraFactory
+from tpdingding.middleware.track import LogQueueHandler
+from tpdingding.middleware.track import orjson
+
+# 与 handle_org_suite_auth 打印的企业授权信息大小相近
+PAYLOAD = {
+    'syncAction': 'org_suite_auth',
+    'auth_corp_info': {'corpid': 'ding' + '0' * 28, 'corp_name': '测试企业', 'industry': '互联网'},
+    'auth_info': {'agent': [{'agentid': 123456789, 'agent_name': '应用', 'admin_list': ['user'] * 20}]},
+    'auth_user_info': {'userId': 'manager', 'unionId': 'x' * 32},
+    'permanent_code': 'p' * 64,
+}
+
+
+class LegacyJSONFormatter(Formatter):
+    """旧版本的 JSONFormatter"""
+
+    default_time_format = '%Y-%m-%d %H:%M:%S.%%03d %z'
+    attrs = ['request_id', 'user_account', 'name', 'levelname', 'process']
+
+    def format(self, record: LogRecord) -> str:
+        data = {attr: record.__dict__.get(attr) for attr in self.attrs}
+        data['message'] = record.getMessage()
+        data['asctime'] = self.formatTime(record, self.default_time_format) % record.msecs
+        return json.dumps(data, ensure_ascii=False, indent=2)
+
+
+def run(name: str, handler_factory: Callable[[], Handler], number: int) -> None:
+    logger = logging.getLogger(f'benchmark.{name}')
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handler = handler_factory()
+    logger.addHandler(handler)
+
+    started_at = time.perf_counter()
+    for _ in range(number):
+        logger.info('handle_org_suite_auth: %s', PAYLOAD)
+    emitted_at = time.perf_counter()
+    logger.removeHandler(handler)
+    handler.close()  # 异步 handler 等待队列写完
+    finished_at = time.perf_counter()
+
+    print(
+        f'{name:>18}: 调用方 {(emitted_at - started_at) / number * 1e6:8.2f} us/条, '
+        f'全部写完 {finished_at - started_at:6.2f} 秒'
+    )
+
+
+def main(number: int) -> None:
+    logging.setLogRecordFactory(LogExtraFactory)
+    with tempfile.TemporaryFile('w') as stream:
+
+        def stream_handler(formatter: Formatter) -> Callable[[], Handler]:
+            def factory() -> Handler:
+                handler = StreamHandler(stream)
+                handler.setFormatter(formatter)
+                return handler
+
+            return factory
+
+        def queue_handler(formatter: Formatter) -> Callable[[], Handler]:
+            def factory() -> Handler:
+                handler = LogQueueHandler(stream)
+                handler.setFormatter(formatter)
+                return handler
+
+            return factory
+
+        cases = {
+            'legacy indent=2': stream_handler(LegacyJSONFormatter()),
+            'json': stream_handler(JSONFormatter(backend='json')),
+            'json + queue': queue_handler(JSONFormatter(backend='json')),
+        }
+        if orjson is not None:
+            cases['orjson'] = stream_handler(JSONFormatter(backend='orjson'))
+            cases['orjson + queue'] = queue_handler(JSONFormatter(backend='orjson'))
+        else:
+            print('没有安装 orjson, 跳过 orjson 的测试')
+
+        for name, factory in cases.items():
+            run(name, factory, number)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=50000)
+    main(parser.parse_args().number)
@@ -0,0 +1,153 @@
+"""
+中间件开销基准测试: BaseHTTPMiddleware 与纯 ASGI 中间件对比
+
+直接以 ASGI 协议调用应用, 不经过网络和 HTTP 客户端, 只比较中间件栈本身的开销。
+两个应用挂载相同的回调接口, 数据库会话都使用 sqlite, 请求不访问数据库。
+
+    DINGDING_DEPLOY_MODE=CLOUD python -m benchmarks.middleware --requests 20000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from fastapi import Depends
+from fastapi import FastAPI
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.middleware.base import RequestResponseEndpoint
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import ASGIApp
+
+from settings import settings
+from tpdingding.helper.dependencies import get_context
+from tpdingding.helper.session import sqlite_session_maker
+from tpdingding.middleware.context import CONTEXT
+from tpdingding.middleware.context import ContextMiddleware
+from tpdingding.middleware.session import DBSessionMiddleware
+from tpdingding.middleware.track import REQUEST_ID_CTX
+from tpdingding.middleware.track import REQUEST_ID_HEADER
+from tpdingding.middleware.track import USER_ACCOUNT_CTX
+from tpdingding.middleware.track import USER_ID_HEADER
+from tpdingding.middleware.track import RequestIdMiddleware
+from tpdingding.model.context import Context
+
+PATH = '/dingding/event/pushed'
+BODY = json.dumps({'encrypt': 'x' * 256}).encode()
+
+
+class LegacyRequestIdMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        request_id = request.headers.get(REQUEST_ID_HEADER, str(uuid.uuid4()))
+        REQUEST_ID_CTX.set(request_id)
+        user_info = request.headers.get(USER_ID_HEADER)
+        if (not user_info) or (user_info == 'undefined'):
+            user_info = '{}'
+        USER_ACCOUNT_CTX.set(json.loads(user_info).get('account'))
+        response = await call_next(request)
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+
+
+class LegacyContextMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        request.state.context = Context(**dict(CONTEXT))
+        return await call_next(request)
+
+
+class LegacyDBSessionMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
+        async with sqlite_session_maker() as session:
+            try:
+                response = await call_next(request)
+                await session.commit()
+                return response
+            finally:
+                await session.close()
+
+
+def build_app(middlewares: list[type]) -> FastAPI:
+    app = FastAPI()
+
+    @app.post(PATH)
+    async def pushed(request: Request, ctx: Context = Depends(get_context)) -> dict[str, str]:
+        await request.body()
+        return {'suite_key': ctx.suite_key, 'msg': 'success'}
+
+    for middleware in middlewares:
+        app.add_middleware(middleware)
+    return app
+
+
+async def call(app: ASGIApp) -> int:
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'POST',
+        'scheme': 'http',
+        'path': PATH,
+        'raw_path': PATH.encode(),
+        'query_string': b'',
+        'root_path': '',
+        'headers': [(b'content-type', b'application/json'), (b'content-length', str(len(BODY)).encode())],
+        'client': ('127.0.0.1', 10000),
+        'server': ('127.0.0.1', 8000),
+        'state': {},
+    }
+    messages = [{'type': 'http.request', 'body': BODY, 'more_body': False}]
+    response_complete = asyncio.Event()
+    status = 0
+
+    async def receive():
+        # 与 uvicorn 一致: 请求体读完后, 响应发送完成才返回 disconnect
+        if messages:
+            return messages.pop()
+        await response_complete.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        nonlocal status
+        if message['type'] == 'http.response.start':
+            status = message['status']
+        elif not message.get('more_body', False):
+            response_complete.set()
+
+    await app(scope, receive, send)
+    return status
+
+
+async def run(app: ASGIApp, requests: int, concurrency: int) -> float:
+    await call(app)  # 预热, 构建中间件栈
+    queue = iter(range(requests))
+
+    async def client():
+        for _ in queue:
+            assert await call(app) == 200
+
+    started = time.perf_counter()
+    await asyncio.gather(*(asyncio.create_task(client()) for _ in range(concurrency)))
+    return requests / (time.perf_counter() - started)
+
+
+async def main(requests: int, concurrency: int) -> None:
+    print(f'部署模式 {settings.dingding_deploy_mode}, 请求数 {requests}, 并发 {concurrency}')
+    apps = {
+        'BaseHTTPMiddleware': build_app(
+            [LegacyRequestIdMiddleware, LegacyContextMiddleware, LegacyDBSessionMiddleware]
+        ),
+        'pure ASGI': build_app([RequestIdMiddleware, ContextMiddleware, DBSessionMiddleware]),
+    }
+    results = {name: await run(app, requests, concurrency) for name, app in apps.items()}
+    for name, rps in results.items():
+        print(f'{name:>20}: {rps:10.0f} req/s')
+    print(f'{"speedup":>20}: {results["pure ASGI"] / results["BaseHTTPMiddleware"]:10.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--concurrency', type=int, default=50)
+    args = parser.parse_args()
+    asyncio.run(main(args.requests, args.concurrency))
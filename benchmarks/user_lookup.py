@@ -0,0 +1,106 @@
+"""
+dingding_user 查询计划基准测试
+
+在临时表中写入 --users 个用户 (默认 100 万), 分别在只有 (corp_id, user_id) 唯一约束
+和加上 DingDingUserOrm 定义的索引之后, 用 EXPLAIN ANALYZE 检查发送消息路径上的查询计划。
+临时表只存在于本次连接中, 不影响 dingding_user 表。
+
+    DINGDING_DEPLOY_MODE=LOCAL python -m benchmarks.user_lookup --users 1000000
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Any
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from tpdingding.helper.session import POSTGRES_ENGINE
+from tpdingding.persistence.model.orm import DingDingUserOrm
+
+TABLE = 'bench_dingding_user'
+CORPS = 50
+TENANTS = 200
+BATCH = 100  # 一次发送消息查询的用户数
+
+
+def queries(users: int) -> dict[str, tuple[str, dict[str, Any]]]:
+    step = users // BATCH
+    user_ids = [f'user{i}' for i in range(1, users, step)][:BATCH]
+    staff_ids = [f'staff{i}' for i in range(7, users, TENANTS)][:BATCH]
+    return {
+        'of_user_ids': (f'SELECT * FROM {TABLE} WHERE user_id = ANY(:user_ids)', {'user_ids': user_ids}),
+        'of_staff_ids': (
+            f'SELECT * FROM {TABLE} WHERE tenant_id = :tenant_id AND staff_id = ANY(:staff_ids)',
+            {'tenant_id': f'tenant{7 % TENANTS}', 'staff_ids': staff_ids},
+        ),
+        'union_id': (f'SELECT * FROM {TABLE} WHERE union_id = :union_id', {'union_id': f'union{users // 2}'}),
+    }
+
+
+async def seed(conn: AsyncConnection, users: int) -> None:
+    started_at = time.perf_counter()
+    await conn.execute(text(f'CREATE TEMP TABLE {TABLE} (LIKE dingding_user INCLUDING DEFAULTS)'))
+    await conn.execute(
+        text(
+            f"""
+            INSERT INTO {TABLE} (id, nick, corp_id, open_id, union_id, user_id, staff_id, tenant_id)
+            SELECT i, 'nick' || i, 'corp' || (i % {CORPS}), 'open' || i, 'union' || i, 'user' || i,
+                   'staff' || i, 'tenant' || (i % {TENANTS})
+            FROM generate_series(1, :users) AS i
+            """
+        ),
+        {'users': users},
+    )
+    await conn.execute(text(f'ALTER TABLE {TABLE} ADD UNIQUE (corp_id, user_id)'))
+    await conn.execute(text(f'ANALYZE {TABLE}'))
+    print(f'写入 {users} 个用户, 耗时 {time.perf_counter() - started_at:.1f} 秒')
+
+
+async def create_indexes(conn: AsyncConnection) -> None:
+    for index in DingDingUserOrm.__table__.indexes:
+        columns = ', '.join(column.name for column in index.columns)
+        await conn.execute(text(f'CREATE INDEX {index.name}_bench ON {TABLE} ({columns})'))
+    await conn.execute(text(f'ANALYZE {TABLE}'))
+
+
+def plan_nodes(plan: dict[str, Any]) -> list[str]:
+    nodes = [plan['Node Type'] + (f" ({plan['Index Name']})" if 'Index Name' in plan else '')]
+    for child in plan.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+async def explain(conn: AsyncConnection, users: int) -> dict[str, list[str]]:
+    result = {}
+    for name, (sql, params) in queries(users).items():
+        row = (await conn.execute(text(f'EXPLAIN (ANALYZE, FORMAT JSON) {sql}'), params)).scalar_one()
+        data = (json.loads(row) if isinstance(row, str) else row)[0]
+        nodes = plan_nodes(data['Plan'])
+        result[name] = nodes
+        print(f"  {name:>14}: {data['Execution Time']:10.3f} ms  {' -> '.join(nodes)}")
+    return result
+
+
+async def main(users: int) -> None:
+    async with POSTGRES_ENGINE.connect() as conn:
+        await seed(conn, users)
+        print('只有唯一约束 (corp_id, user_id):')
+        await explain(conn, users)
+
+        await create_indexes(conn)
+        print('加上 DingDingUserOrm 定义的索引:')
+        plans = await explain(conn, users)
+        await conn.rollback()
+
+    seq_scans = [name for name, nodes in plans.items() if any(node.startswith('Seq Scan') for node in nodes)]
+    if seq_scans:
+        raise SystemExit(f'以下查询仍然是顺序扫描: {seq_scans}')
+    print('所有查询均使用索引')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=1_000_000)
+    asyncio.run(main(parser.parse_args().users))
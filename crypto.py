@@ -15,30 +15,37 @@ corpId         企业自建应用-事件订阅, 使用appKey
 """
 
 import base64
-import binascii
 import hashlib
-import io
-import string
+import os
+import secrets
 import struct
 import time
-from random import choice
-from typing import Any
 
 # pylint: disable=no-name-in-module
 # pylint: disable=import-error
 from Crypto.Cipher import AES
 
+BLOCK_SIZE = 32  # 钉钉使用 32 字节作为 PKCS#7 的块大小
+
 
 class DingCallbackCrypto3:
+    """
+    钉钉回调加解密
+
+    实例创建后只读, 可以在多个请求和线程之间共享; AES-CBC 对象有状态, 每次加解密单独创建
+    """
+
     def __init__(self, token: str, encoding_aes_key: str, key: str):
         # https://open-dev.dingtalk.com/fe/app#/appMgr/provider/h5/119556/17
         self.encoding_aes_key = encoding_aes_key
         self.key = key
         self.token = token
         self.aes_key = base64.b64decode(self.encoding_aes_key + '=')
+        self.aes_iv = self.aes_key[:16]  # 初始向量
+        self.key_bytes = key.encode()
 
     # 生成回调处理完成后的success加密数据
-    def get_encrypted_map(self, content):
+    def get_encrypted_map(self, content: str) -> dict[str, str]:
         encrypt_content = self.encrypt(content)
         time_stamp = str(int(time.time()))
         nonce = self.generate_random_key(16)
@@ -51,89 +58,60 @@ class DingCallbackCrypto3:
         解密
         """
         sign = self.generate_signature(nonce, time_stamp, self.token, content)
-        # print(sign, msg_signature)
-        if msg_signature != sign:
+        # compare_digest 的 str 参数只能包含 ASCII 字符, 比较 bytes 避免非 ASCII 的签名抛出 TypeError
+        if not secrets.compare_digest(msg_signature.encode(), sign.encode()):
             raise ValueError('signature check error')
 
-        content = base64.decodebytes(content.encode('UTF-8'))  # 钉钉返回的消息体
-
-        iv = self.aes_key[:16]  # 初始向量
-        aes_decode = AES.new(self.aes_key, AES.MODE_CBC, iv)
-
-        decode_res = aes_decode.decrypt(content)
-        # pad = int(binascii.hexlify(decode_res[-1]),16)
-        pad = int(decode_res[-1])
-        if pad > 32:
-            raise ValueError('Input is not padded or padding is corrupt')
-        decode_res = decode_res[:-pad]
-        l = struct.unpack('!i', decode_res[16:20])[0]
-        # 获取去除初始向量，四位msg长度以及尾部corpid
-        # nl = len(decode_res)
-
-        if decode_res[(20 + l) :].decode() != self.key:
+        aes_decode = AES.new(self.aes_key, AES.MODE_CBC, self.aes_iv)
+        decode_res = self.pks7decode(aes_decode.decrypt(base64.b64decode(content)))
+        # 去除 16 字节随机串, 4 字节消息长度以及尾部 corpId
+        l = struct.unpack('!I', decode_res[16:20])[0]
+        if decode_res[20 + l :] != self.key_bytes:
             raise ValueError('corpId 校验错误')
-        return decode_res[20 : (20 + l)].decode()
+        return decode_res[20 : 20 + l].decode()
 
-    def encrypt(self, content):
+    def encrypt(self, content: str) -> str:
         """
         加密
         :param content:
         :return:
         """
-        msg_len = self.length(content)
-        content = ''.join([self.generate_random_key(16), msg_len.decode(), content, self.key])
-        content_encode = self.pks7encode(content)
-        iv = self.aes_key[:16]
-        aes_encode = AES.new(self.aes_key, AES.MODE_CBC, iv)
-        aes_encrypt = aes_encode.encrypt(content_encode.encode('UTF-8'))
-        return base64.encodebytes(aes_encrypt).decode('UTF-8')
+        content_bytes = content.encode()
+        plain = b''.join([os.urandom(16), self.length(content_bytes), content_bytes, self.key_bytes])
+        aes_encrypt = AES.new(self.aes_key, AES.MODE_CBC, self.aes_iv).encrypt(self.pks7encode(plain))
+        return base64.b64encode(aes_encrypt).decode()
 
     # 生成回调返回使用的签名值
     @classmethod
     def generate_signature(cls, nonce: str, timestamp: str, token: str, msg_encrypt: str) -> str:
-        # print(type(nonce), type(timestamp), type(token), type(msg_encrypt))
-        v = msg_encrypt
-        sign_list = ''.join(sorted([nonce, timestamp, token, v]))
+        sign_list = ''.join(sorted([nonce, timestamp, token, msg_encrypt]))
         return hashlib.sha1(sign_list.encode()).hexdigest()
 
     @classmethod
-    def length(cls, content: str) -> bytes:
+    def length(cls, content: bytes) -> bytes:
         """
-        将msg_len转为符合要求的四位字节长度
+        将msg_len转为符合要求的四位字节长度 (网络字节序)
         """
-        l = len(content)
-        return struct.pack('>l', l)
+        return struct.pack('!I', len(content))
 
     @classmethod
-    def pks7encode(cls, content: str) -> str:
+    def pks7encode(cls, content: bytes) -> bytes:
         """
-        安装 PKCS#7 标准填充字符串
+        按照 PKCS#7 标准填充
         """
-        l = len(content)
-        output = io.StringIO()
-        val = 32 - (l % 32)
-        for _ in range(val):
-            output.write('%02x' % val)  # pylint: disable=consider-using-f-string
-        # print "pks7encode",content,"pks7encode", val, "pks7encode", output.getvalue()
-        return content + binascii.unhexlify(output.getvalue()).decode()
+        val = BLOCK_SIZE - (len(content) % BLOCK_SIZE)
+        return content + bytes((val,)) * val
 
     @classmethod
-    def pks7decode(cls, content: Any) -> str:
-        nl = len(content)
-        val = int(binascii.hexlify(content[-1]), 16)
-        if val > 32:
+    def pks7decode(cls, content: bytes) -> bytes:
+        val = content[-1] if content else 0
+        if not 0 < val <= BLOCK_SIZE:
             raise ValueError('Input is not padded or padding is corrupt')
-
-        l = nl - val
-        return content[:l]
+        return content[:-val]
 
     @classmethod
-    def generate_random_key(
-        cls,
-        size,
-        chars=string.ascii_letters + string.ascii_lowercase + string.ascii_uppercase + string.digits,
-    ):
+    def generate_random_key(cls, size: int) -> str:
         """
         生成加密所需要的随机字符串
         """
-        return ''.join(choice(chars) for i in range(size))
+        return secrets.token_hex((size + 1) // 2)[:size]
@@ -8,19 +8,54 @@ from starlette.responses import JSONResponse
 from settings import DeployMode
 from settings import settings
 from tpdingding.exception import DingDingException
+from tpdingding.helper.executor import BLOCKING_EXECUTOR
+from tpdingding.helper.http import HTTP_CLIENTS
+from tpdingding.helper.pool import warm_up
 from tpdingding.helper.session import POSTGRES_ENGINE
 from tpdingding.helper.session import SQLITE_ENGINE
+from tpdingding.middleware.context import CACHE_BUS
+from tpdingding.middleware.context import CONTEXT
+from tpdingding.middleware.context import DIRECTORY_SRV
+from tpdingding.middleware.context import MESSAGE_SRV
+from tpdingding.middleware.context import SUITE_TICKET_STORE
 from tpdingding.middleware.context import ContextMiddleware
 from tpdingding.middleware.deploy import REPO
+from tpdingding.middleware.deploy import SESSION
 from tpdingding.middleware.session import DBSessionMiddleware
 from tpdingding.middleware.track import RequestIdMiddleware
 from tpdingding.middleware.track import init_logger
 from tpdingding.router import router
+from tpdingding.worker.inbox import InboxWorkerPool
+from tpdingding.worker.outbox import OutboxWorkerPool
 
 init_logger(settings)
 
 app = FastAPI()
 
+OUTBOX_WORKER = OutboxWorkerPool(
+    repo=REPO,
+    message_srv=MESSAGE_SRV,
+    workers=settings.outbox_workers,
+    poll_interval=settings.outbox_poll_interval,
+    lease=settings.outbox_lease,
+    max_attempts=settings.outbox_max_attempts,
+    backoff_base=settings.outbox_backoff_base,
+    backoff_max=settings.outbox_backoff_max,
+)
+# 接收钉钉事件回调的部署模式处理收件箱
+INBOX_ENABLED = settings.inbox_enabled and settings.dingding_deploy_mode in (DeployMode.CLOUD, DeployMode.DEV_DEBUG)
+INBOX_WORKER = InboxWorkerPool(
+    repo=REPO,
+    context=CONTEXT,
+    session=SESSION,
+    workers=settings.inbox_workers,
+    poll_interval=settings.inbox_poll_interval,
+    lease=settings.inbox_lease,
+    max_attempts=settings.inbox_max_attempts,
+    backoff_base=settings.inbox_backoff_base,
+    backoff_max=settings.inbox_backoff_max,
+)
+
 
 app.add_middleware(RequestIdMiddleware)
 app.add_middleware(ContextMiddleware)
@@ -42,23 +77,37 @@ async def exception_handler(_: Request, exc: DingDingException) -> JSONResponse:
 
 @app.on_event('startup')
 async def startup():
+    HTTP_CLIENTS.start()
     if settings.dingding_deploy_mode in (DeployMode.LOCAL, DeployMode.DEV_DEBUG):
         logging.info('部署模式为 %s ，初始化 Postgres 数据库连接', settings.dingding_deploy_mode)
-        await POSTGRES_ENGINE.connect()
+        await warm_up(POSTGRES_ENGINE, min(settings.pg_pool_warm_up, settings.pg_pool_size))
+        if settings.outbox_enabled:
+            OUTBOX_WORKER.start()
     elif settings.dingding_deploy_mode == DeployMode.CLOUD:
         logging.info('部署模式为 %s ，初始化 SQLite 数据库', settings.dingding_deploy_mode)
         await REPO.create_all()
 
+    await CACHE_BUS.start()
+    if INBOX_ENABLED:
+        INBOX_WORKER.start()
     logging.info('应用启动完成')
 
 
 @app.on_event('shutdown')
 async def shutdown():
+    if INBOX_ENABLED:
+        await INBOX_WORKER.stop()
+    await SUITE_TICKET_STORE.stop()
+    await CACHE_BUS.stop()
     if settings.dingding_deploy_mode in (DeployMode.LOCAL, DeployMode.DEV_DEBUG):
+        await OUTBOX_WORKER.stop()
+        await DIRECTORY_SRV.stop()
         logging.warning('部署模式为 %s ，关闭 Postgres 数据库连接', settings.dingding_deploy_mode)
         await POSTGRES_ENGINE.dispose()
     elif settings.dingding_deploy_mode == DeployMode.CLOUD:
         logging.warning('部署模式为 %s ，关闭 SQLite 数据库连接', settings.dingding_deploy_mode)
-        SQLITE_ENGINE.dispose()
+        await SQLITE_ENGINE.dispose()
 
+    await HTTP_CLIENTS.close()
+    BLOCKING_EXECUTOR.shutdown()
     logging.info('应用关闭完成')
@@ -10,3 +10,19 @@ class DingDingException(Exception):
         super().__init__(message)
         self.message = message
         self.errcode = errcode
+
+
+class RetryableException(DingDingException):
+    """可重试的错误: 钉钉限流、系统繁忙、5xx、超时"""
+
+
+class TokenInvalidException(DingDingException):
+    """access_token 无效或过期, 刷新 token 后可重试"""
+
+
+class ReadOnlySessionException(DingDingException):
+    """只读数据库会话中执行了写操作"""
+
+
+class MissingSessionException(DingDingException):
+    """没有设置数据库会话作用域: 请求之外的后台任务需要使用 background_session"""
@@ -1,13 +1,23 @@
+import asyncio
+import itertools
 import json
 import logging
+from collections import defaultdict
 from enum import Enum
 from typing import Any
+from typing import Optional
 
+from settings import settings
+from tpdingding.helper.session import after_commit
+from tpdingding.helper.session import background_session
+from tpdingding.middleware.deploy import SESSION
+from tpdingding.model.cache import CacheKind
 from tpdingding.model.context import Context
-from tpdingding.model.entity import Suite
 from tpdingding.model.event import SyncAction
 
 BIZ_TYPE_HANDLER_MAP = {}
+# 连续的同类型数据合并为一次调用, 参数为 bizData 列表
+BIZ_TYPE_BATCH_HANDLER_MAP = {}
 
 
 class BizType(int, Enum):
@@ -24,6 +34,14 @@ def biz_handler_register(type_: BizType):
     return decorator
 
 
+def biz_batch_handler_register(type_: BizType):
+    def decorator(func):
+        BIZ_TYPE_BATCH_HANDLER_MAP[type_] = func
+        return func
+
+    return decorator
+
+
 @biz_handler_register(BizType.DEFAULT)
 async def _default_handler(_: Context, msg: dict[str, Any]) -> bool:
     logging.warning('No handler for msg %s', msg)
@@ -33,40 +51,98 @@ async def _default_handler(_: Context, msg: dict[str, Any]) -> bool:
 @biz_handler_register(BizType.SUITE_TICKET)
 async def handle_suite_ticket(ctx: Context, data: dict[str, Any]) -> bool:
     biz_data = json.loads(data['biz_data'])
-    await ctx.repo.save_suite_ticket(
-        Suite(
-            corp_id=data['corp_id'],
-            suite_ticket=biz_data['suiteTicket'],
-            suite_key=ctx.suite_key,
-        )
-    )
-    ctx.dingding_srv.refresh_suite(corp_id=data['corp_id'], suite_ticket=biz_data['suiteTicket'])
+    if not ctx.suite_ticket_store.save(data['corp_id'], biz_data['suiteTicket']):
+        logging.info('suite ticket 没有变化, 跳过保存')
     return True
 
 
-@biz_handler_register(BizType.ORG_SUITE_AUTH)
-async def handle_org_suite_auth(ctx: Context, data: dict[str, Any]) -> bool:
-    corp_id = data['corp_id']
-    biz_data = json.loads(data['biz_data'])
-    sync_action = biz_data['syncAction'].upper()
-    if sync_action == SyncAction.ORG_SUITE_AUTH:
-        await ctx.repo.save_org_suite_auth_info(corp_id, biz_data)
-    elif sync_action == SyncAction.ORG_SUITE_RELIEVE:
-        await ctx.repo.relieve_org_suite_auth_info(corp_id)
-    else:
-        raise Exception(f'Unknown sync action {sync_action}')  # pylint: disable=broad-exception-raised
-    logging.info('handle_org_suite_auth: %s', biz_data)
+@biz_batch_handler_register(BizType.ORG_SUITE_AUTH)
+async def handle_org_suite_auths(ctx: Context, items: list[dict[str, Any]]) -> bool:
+    """同一企业的多次授权变更只保留最后一次, 授权与解除授权各用一条语句保存"""
+    latest: dict[str, dict[str, Any]] = {}
+    for data in items:
+        biz_data = json.loads(data['biz_data'])
+        sync_action = biz_data['syncAction'].upper()
+        if sync_action not in (SyncAction.ORG_SUITE_AUTH, SyncAction.ORG_SUITE_RELIEVE):
+            raise Exception(f'Unknown sync action {sync_action}')  # pylint: disable=broad-exception-raised
+        latest[data['corp_id']] = biz_data
+
+    auths = {
+        corp_id: biz_data
+        for corp_id, biz_data in latest.items()
+        if biz_data['syncAction'].upper() == SyncAction.ORG_SUITE_AUTH
+    }
+    if auths:
+        await ctx.repo.save_org_suite_auth_infos(auths)
+    if relieves := [corp_id for corp_id in latest if corp_id not in auths]:
+        await ctx.repo.relieve_org_suite_auth_infos(relieves)
+
+    for biz_data in latest.values():
+        logging.info('handle_org_suite_auth: %s', biz_data)
+
+    def evict() -> None:
+        for corp_id in latest:
+            ctx.dingding_srv.evict_corp(corp_id)
+            ctx.notifier.notify(CacheKind.CORP_AUTH, corp_id)
+
+    # 提交之后再让各个 worker 与本地部署删除缓存, 避免在提交之前重新读到旧的授权信息
+    after_commit(ctx.repo.session_maker(), evict)
     return True
 
 
+def _biz_type(data: dict[str, Any]) -> BizType:
+    if data['biz_type'] in BizType.__members__.values():
+        return BizType(data['biz_type'])
+    return BizType.DEFAULT
+
+
+def _batch_type(data: dict[str, Any]) -> Optional[BizType]:
+    biz_type = _biz_type(data)
+    return biz_type if biz_type in BIZ_TYPE_BATCH_HANDLER_MAP else None
+
+
+async def _first_seen(ctx: Context, data: dict[str, Any]) -> bool:
+    if await ctx.event_dedup.first_seen(data):
+        return True
+    logging.info('跳过重复推送的数据 biz_type: %s, biz_id: %s', data['biz_type'], data.get('biz_id'))
+    return False
+
+
+async def _handle_batch(ctx: Context, biz_type: BizType, items: list[dict[str, Any]]) -> None:
+    async with background_session(*SESSION):
+        if fresh := [data for data in items if await _first_seen(ctx, data)]:
+            await BIZ_TYPE_BATCH_HANDLER_MAP[biz_type](ctx, fresh)
+
+
+async def _handle_corp(ctx: Context, items: list[dict[str, Any]], semaphore: asyncio.Semaphore) -> None:
+    async with semaphore, background_session(*SESSION):
+        for data in items:
+            if await _first_seen(ctx, data):
+                await BIZ_TYPE_HANDLER_MAP[_biz_type(data)](ctx, data)
+
+
 async def handle_biz_types(ctx: Context, msg: dict[str, Any]) -> bool:
-    for biz_data in msg['bizData']:
-        biz_type = biz_data['biz_type']
-        if biz_type in BizType.__members__.values():
-            handler = BIZ_TYPE_HANDLER_MAP[BizType(biz_type)]
-        else:
-            handler = BIZ_TYPE_HANDLER_MAP[BizType.DEFAULT]
-
-        await handler(ctx, biz_data)
+    """
+    处理一次推送中的 bizData
+
+    连续的同类型数据有批量 handler 时合并为一批处理; 其余数据按 corp_id 分组, 不同企业并发处理,
+    同一企业内按推送顺序处理。AsyncSession 不能并发使用, 每个分组在各自的会话与事务中处理,
+    部分分组失败时整个推送重试, 已经提交的分组在重试时被去重跳过
+    """
+    semaphore = asyncio.Semaphore(settings.biz_dispatch_concurrency)
+    for batch_type, group in itertools.groupby(msg['bizData'], key=_batch_type):
+        if batch_type is not None:
+            await _handle_batch(ctx, batch_type, list(group))
+            continue
+
+        corps: dict[str, list[dict[str, Any]]] = defaultdict(list)
+        for data in group:
+            corps[data.get('corp_id')].append(data)
+        # 等待所有企业处理结束再抛出异常, 避免重试时与仍在处理的分组并发
+        results = await asyncio.gather(
+            *(_handle_corp(ctx, items, semaphore) for items in corps.values()), return_exceptions=True
+        )
+        if errors := [result for result in results if isinstance(result, BaseException)]:
+            raise errors[0]
 
     return True
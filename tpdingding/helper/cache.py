@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from collections.abc import Awaitable
+from collections.abc import Callable
+from collections.abc import Hashable
+from collections.abc import Iterable
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Generic
+from typing import TypeVar
+
+V = TypeVar('V')
+
+
+@dataclass
+class CacheMetrics:
+    hits: int = 0
+    stale_hits: int = 0
+    misses: int = 0
+    loads: int = 0
+    failures: int = 0
+
+
+@dataclass
+class _Entry(Generic[V]):
+    value: V
+    fresh_until: float
+    stale_until: float
+
+
+class TTLCache(Generic[V]):
+    """
+    读穿缓存, 支持 stale-while-revalidate
+
+    * ttl 内直接返回缓存值
+    * 过期后 stale_ttl 内先返回旧值, 并在后台刷新
+    * 同一个 key 的并发加载只会调用一次 loader
+    """
+
+    def __init__(self, name: str, ttl: float, stale_ttl: float = 0):
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.metrics = CacheMetrics()
+
+        self._entries: dict[Hashable, _Entry[V]] = {}
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+        self._versions: dict[Hashable, int] = {}  # 失效时递增, 避免失效前发起的加载覆盖新值
+
+    async def get(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> V:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None and now < entry.fresh_until:
+            self.metrics.hits += 1
+            return entry.value
+
+        if entry is not None and now < entry.stale_until:
+            self.metrics.stale_hits += 1
+            # 后台刷新不返回 shield, 失败由 _done 记录并取走异常
+            self._start(key, loader)
+            return entry.value
+
+        self.metrics.misses += 1
+        return await self._load(key, loader)
+
+    def set(self, key: Hashable, value: V) -> None:
+        now = time.monotonic()
+        self._entries[key] = _Entry(value, now + self.ttl, now + self.ttl + self.stale_ttl)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+        self._inflight.pop(key, None)
+        self._versions[key] = self._versions.get(key, 0) + 1
+
+    def clear(self) -> None:
+        for key in list(self._entries):
+            self.invalidate(key)
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'size': len(self._entries)}
+
+    def _load(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> Awaitable[V]:
+        return asyncio.shield(self._start(key, loader))
+
+    def _start(self, key: Hashable, loader: Callable[[], Awaitable[V]]) -> asyncio.Task:
+        if (task := self._inflight.get(key)) is None:
+            task = asyncio.create_task(self._do_load(key, loader, self._versions.get(key, 0)))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    async def _do_load(self, key: Hashable, loader: Callable[[], Awaitable[V]], version: int) -> V:
+        self.metrics.loads += 1
+        value = await loader()
+        if version == self._versions.get(key, 0):
+            self.set(key, value)
+        return value
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            self._inflight.pop(key)
+        if task.cancelled():
+            return
+        if (err := task.exception()) is not None:
+            self.metrics.failures += 1
+            logging.warning('%s 缓存加载失败 %s: %s', self.name, key, err)
+
+
+class LRUCache(Generic[V]):
+    """有容量上限的 LRU 缓存, 每个条目在 ttl 秒后过期"""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Hashable, tuple[V, float]] = OrderedDict()
+
+    def get_many(self, keys: Iterable[Hashable]) -> dict[Hashable, V]:
+        now = time.monotonic()
+        found = {}
+        for key in keys:
+            if (entry := self._entries.get(key)) is None:
+                continue
+            if entry[1] <= now:
+                del self._entries[key]
+                continue
+            self._entries.move_to_end(key)
+            found[key] = entry[0]
+        return found
+
+    def set_many(self, items: dict[Hashable, V]) -> None:
+        expires_at = time.monotonic() + self.ttl
+        for key, value in items.items():
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate: Callable[[Hashable, V], bool]) -> None:
+        for key in [key for key, (value, _) in self._entries.items() if predicate(key, value)]:
+            del self._entries[key]
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
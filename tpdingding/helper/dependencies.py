@@ -8,6 +8,8 @@ from fastapi.security import HTTPBasic
 from fastapi.security import HTTPBasicCredentials
 
 from settings import settings
+from tpdingding.helper.session import POSTGRES_SESSION_VAR
+from tpdingding.helper.session import SQLITE_SESSION_VAR
 from tpdingding.model.context import Context
 
 security = HTTPBasic()
@@ -17,6 +19,13 @@ def get_context(request: Request) -> Context:
     return request.state.context
 
 
+def read_only_session() -> None:
+    """声明接口只读: 请求结束时不提交数据库会话, 执行写操作会报错"""
+    for session_var in (POSTGRES_SESSION_VAR, SQLITE_SESSION_VAR):
+        if (session_scope := session_var.get(None)) is not None:
+            session_scope.set_read_only()
+
+
 def login(credentials: HTTPBasicCredentials = Depends(security)):
     current_username_bytes = credentials.username.encode("utf8")
     is_correct_username = secrets.compare_digest(current_username_bytes, settings.dingding_secret_user.encode('utf8'))
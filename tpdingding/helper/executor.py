@@ -0,0 +1,95 @@
+"""
+阻塞任务线程池
+
+回调链路上的 CPU 密集任务 (AES 解密, 签名, JSON 解析) 放到有界线程池中执行, 避免阻塞事件循环上的其他请求。
+任务在调用方的 contextvars 副本中执行, 日志仍带有请求 ID。
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Optional
+from typing import TypeVar
+
+from settings import settings
+
+T = TypeVar('T')
+
+
+@dataclass
+class ExecutorMetrics:
+    submitted: int = 0
+    completed: int = 0
+    failed: int = 0
+    queued: int = 0  # 已提交但还没有线程执行
+    running: int = 0
+    max_queued: int = 0
+    wait_seconds: float = 0.0  # 排队等待的总时长
+    run_seconds: float = 0.0
+
+
+class BlockingExecutor:
+    def __init__(self, name: str, max_workers: int):
+        self.name = name
+        self.max_workers = max_workers
+        self.metrics = ExecutorMetrics()
+        self._lock = threading.Lock()
+        self._pool: Optional[ThreadPoolExecutor] = None
+
+    @property
+    def pool(self) -> ThreadPoolExecutor:
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix=self.name)
+        return self._pool
+
+    async def run(self, func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+        metrics = self.metrics
+        with self._lock:
+            metrics.submitted += 1
+            metrics.queued += 1
+            metrics.max_queued = max(metrics.max_queued, metrics.queued)
+        submitted_at = time.perf_counter()
+
+        def call() -> T:
+            started_at = time.perf_counter()
+            with self._lock:
+                metrics.queued -= 1
+                metrics.running += 1
+                metrics.wait_seconds += started_at - submitted_at
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self._lock:
+                    metrics.running -= 1
+                    metrics.run_seconds += time.perf_counter() - started_at
+
+        context = contextvars.copy_context()
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.pool, functools.partial(context.run, call))
+        except BaseException:
+            with self._lock:
+                metrics.failed += 1
+            raise
+        with self._lock:
+            metrics.completed += 1
+        return result
+
+    def report(self) -> dict[str, Any]:
+        with self._lock:
+            return {**asdict(self.metrics), 'max_workers': self.max_workers}
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+            logging.info('%s 线程池已关闭', self.name)
+
+
+BLOCKING_EXECUTOR = BlockingExecutor('blocking', settings.blocking_executor_workers)
@@ -0,0 +1,80 @@
+"""
+应用级别的 httpx.AsyncClient 注册表
+
+每个上游（钉钉开放平台、云端服务、IAM、本地部署）各自持有一个连接池，
+在应用启动时创建，关闭时释放，避免每次请求都重新建立 TCP + TLS 连接。
+"""
+import logging
+from typing import Optional
+
+import httpx
+
+from settings import Settings
+from settings import settings
+
+
+class HttpClients:
+    def __init__(self, config: Settings):
+        self.config = config
+        self._dingding: Optional[httpx.AsyncClient] = None
+        self._cloud: Optional[httpx.AsyncClient] = None
+        self._iam: Optional[httpx.AsyncClient] = None
+        self._local: Optional[httpx.AsyncClient] = None
+
+    def _build(self, base_url: str = '') -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            base_url=base_url,
+            http2=self.config.http2_enabled,
+            limits=httpx.Limits(
+                max_connections=self.config.http_max_connections,
+                max_keepalive_connections=self.config.http_max_keepalive_connections,
+                keepalive_expiry=self.config.http_keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(
+                self.config.http_timeout,
+                connect=self.config.http_connect_timeout,
+                pool=self.config.http_pool_timeout,
+            ),
+        )
+
+    @property
+    def dingding(self) -> httpx.AsyncClient:
+        """钉钉开放平台 oapi.dingtalk.com"""
+        if self._dingding is None:
+            self._dingding = self._build()
+        return self._dingding
+
+    @property
+    def cloud(self) -> httpx.AsyncClient:
+        """云端部署的 dingding-be 服务"""
+        if self._cloud is None:
+            self._cloud = self._build(self.config.dingding_cloud_host)
+        return self._cloud
+
+    @property
+    def iam(self) -> httpx.AsyncClient:
+        """IAM 服务"""
+        if self._iam is None:
+            self._iam = self._build(self.config.iam_host)
+        return self._iam
+
+    @property
+    def local(self) -> httpx.AsyncClient:
+        """本地部署的 dingding-be 服务, 云端部署通知本地部署时使用"""
+        if self._local is None:
+            self._local = self._build()
+        return self._local
+
+    def start(self) -> None:
+        logging.info('初始化 HTTP 连接池, http2: %s', self.config.http2_enabled)
+        _ = self.dingding, self.cloud, self.iam, self.local
+
+    async def close(self) -> None:
+        for client in (self._dingding, self._cloud, self._iam, self._local):
+            if client is not None:
+                await client.aclose()
+        self._dingding = self._cloud = self._iam = self._local = None
+        logging.info('HTTP 连接池已关闭')
+
+
+HTTP_CLIENTS = HttpClients(settings)
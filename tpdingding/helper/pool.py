@@ -0,0 +1,78 @@
+"""
+数据库连接池指标与预热
+
+MeteredQueuePool 记录连接获取次数和等待时间, 启动时 warm_up 预先建立连接,
+避免部署后的第一波请求排队等待建立连接。
+"""
+import asyncio
+import logging
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+
+from sqlalchemy import exc
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from sqlalchemy.pool import ConnectionPoolEntry
+
+
+@dataclass
+class PoolMetrics:
+    checkouts: int = 0
+    connects: int = 0  # 新建立的数据库连接
+    timeouts: int = 0
+    wait_seconds: float = 0.0  # 获取连接的等待总时长, 包含新建连接的耗时
+    max_wait_seconds: float = 0.0
+
+
+class MeteredQueuePool(AsyncAdaptedQueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self) -> ConnectionPoolEntry:
+        started_at = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        finally:
+            wait = time.perf_counter() - started_at
+            self.metrics.checkouts += 1
+            self.metrics.wait_seconds += wait
+            self.metrics.max_wait_seconds = max(self.metrics.max_wait_seconds, wait)
+
+    def _create_connection(self) -> ConnectionPoolEntry:
+        self.metrics.connects += 1
+        return super()._create_connection()
+
+    def report(self) -> dict[str, Any]:
+        return {
+            **asdict(self.metrics),
+            'size': self.size(),
+            'checked_in': self.checkedin(),
+            'checked_out': self.checkedout(),
+            'overflow': self.overflow(),
+        }
+
+
+async def warm_up(engine: AsyncEngine, connections: int) -> None:
+    """同时打开 connections 个连接并执行健康检查, 之后连接归还连接池保留"""
+    if connections <= 0:
+        return
+
+    async def check() -> None:
+        async with engine.connect() as conn:
+            await conn.execute(text('SELECT 1'))
+
+    started_at = time.perf_counter()
+    await asyncio.gather(*(check() for _ in range(connections)))
+    logging.info('数据库连接池预热完成, 连接数: %s, 耗时 %.3f 秒', connections, time.perf_counter() - started_at)
+
+
+def pool_metrics(engine: AsyncEngine) -> dict[str, Any]:
+    pool = engine.pool
+    return pool.report() if isinstance(pool, MeteredQueuePool) else {'status': pool.status()}
@@ -0,0 +1,175 @@
+"""
+钉钉接口的令牌桶限流
+
+每次调用会同时消耗 全局 / 接口 / 企业 三个维度的令牌, 令牌不足时等待而不是失败。
+令牌桶可以保存在进程内存中, 也可以保存在本地 sqlite 文件中, 供同一台机器上的多个 gunicorn worker 共享。
+"""
+import asyncio
+import sqlite3
+import threading
+import time
+from abc import ABC
+from abc import abstractmethod
+from dataclasses import asdict
+from dataclasses import dataclass
+from enum import Enum
+from pathlib import Path
+from typing import Any
+from typing import Optional
+
+from settings import Settings
+
+# (key, 每秒令牌数, 桶容量)
+Bucket = tuple[str, float, float]
+
+
+class RateLimitEndpoint(str, Enum):
+    SEND_MESSAGE = 'send_message'
+    GET_CORP_TOKEN = 'get_corp_token'
+    GET_BY_UNIONID = 'getbyunionid'
+    LIST_DEPARTMENT = 'list_department'
+    LIST_USER = 'list_user'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class BucketBackend(ABC):
+    @abstractmethod
+    async def take(self, buckets: list[Bucket]) -> float:
+        """所有桶都有令牌时各取一个并返回 0, 否则不取令牌, 返回需要等待的秒数"""
+
+
+class MemoryBucketBackend(BucketBackend):
+    def __init__(self):
+        self._buckets: dict[str, tuple[float, float]] = {}
+
+    async def take(self, buckets: list[Bucket]) -> float:
+        now = time.monotonic()
+        refilled = {}
+        wait = 0.0
+        for key, rate, capacity in buckets:
+            tokens, updated_at = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            refilled[key] = tokens
+            wait = max(wait, (1 - tokens) / rate)
+
+        if wait <= 0:
+            for key, tokens in refilled.items():
+                self._buckets[key] = (tokens - 1, now)
+        return wait
+
+
+class SQLiteBucketBackend(BucketBackend):
+    """令牌桶保存在 sqlite 文件中, 同一台机器上的进程通过 BEGIN IMMEDIATE 互斥"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+
+    async def take(self, buckets: list[Bucket]) -> float:
+        return await asyncio.to_thread(self._take, buckets)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=OFF')
+            conn.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL, updated_at REAL)')
+            self._conn = conn
+        return self._conn
+
+    def _take(self, buckets: list[Bucket]) -> float:
+        with self._lock:
+            conn = self._connect()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                refilled = {}
+                wait = 0.0
+                for key, rate, capacity in buckets:
+                    row = conn.execute('SELECT tokens, updated_at FROM bucket WHERE key = ?', (key,)).fetchone()
+                    tokens, updated_at = row if row else (capacity, now)
+                    tokens = min(capacity, tokens + max(now - updated_at, 0) * rate)
+                    refilled[key] = tokens
+                    wait = max(wait, (1 - tokens) / rate)
+
+                if wait <= 0:
+                    conn.executemany(
+                        'INSERT OR REPLACE INTO bucket (key, tokens, updated_at) VALUES (?, ?, ?)',
+                        [(key, tokens - 1, now) for key, tokens in refilled.items()],
+                    )
+                conn.execute('COMMIT')
+                return wait
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+
+@dataclass
+class RateLimitMetrics:
+    acquired: int = 0
+    throttled: int = 0
+    waited_seconds: float = 0.0
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        backend: BucketBackend,
+        global_rate: float,
+        corp_rate: float,
+        endpoint_rates: dict[RateLimitEndpoint, float],
+        burst: float = 1.0,
+    ):
+        """rate 为每秒令牌数, 小于等于 0 表示不限制; 桶容量为 rate * burst"""
+        self.backend = backend
+        self.global_rate = global_rate
+        self.corp_rate = corp_rate
+        self.endpoint_rates = endpoint_rates
+        self.burst = burst
+        self.metrics = RateLimitMetrics()
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> 'RateLimiter':
+        backend = (
+            SQLiteBucketBackend(config.rate_limit_sqlite_path)
+            if config.rate_limit_backend == 'sqlite'
+            else MemoryBucketBackend()
+        )
+        return cls(
+            backend=backend,
+            global_rate=config.rate_limit_global_qps,
+            corp_rate=config.rate_limit_corp_qps,
+            endpoint_rates={
+                RateLimitEndpoint.SEND_MESSAGE: config.rate_limit_send_message_qps,
+                RateLimitEndpoint.GET_CORP_TOKEN: config.rate_limit_corp_token_qps,
+                RateLimitEndpoint.GET_BY_UNIONID: config.rate_limit_getbyunionid_qps,
+                RateLimitEndpoint.LIST_DEPARTMENT: config.rate_limit_list_department_qps,
+                RateLimitEndpoint.LIST_USER: config.rate_limit_list_user_qps,
+            },
+            burst=config.rate_limit_burst,
+        )
+
+    async def acquire(self, endpoint: RateLimitEndpoint, corp_id: Optional[str] = None) -> None:
+        buckets = [
+            (key, rate, max(rate * self.burst, 1.0))
+            for key, rate in (
+                ('global', self.global_rate),
+                (f'endpoint:{endpoint}', self.endpoint_rates.get(endpoint, 0)),
+                (f'corp:{corp_id}', self.corp_rate if corp_id else 0),
+            )
+            if rate > 0
+        ]
+        if not buckets:
+            return
+
+        while (wait := await self.backend.take(buckets)) > 0:
+            self.metrics.throttled += 1
+            self.metrics.waited_seconds += wait
+            await asyncio.sleep(wait)
+        self.metrics.acquired += 1
+
+    def report(self) -> dict[str, Any]:
+        return asdict(self.metrics)
@@ -0,0 +1,129 @@
+"""
+钉钉与云端接口的重试
+
+根据 HTTP 状态码与钉钉 errcode 区分可重试 / 不可重试的错误,
+可重试的错误按带抖动的指数退避重试, 每次调用有总的截止时间;
+access_token 失效时刷新 token 后重试一次。
+"""
+import asyncio
+import logging
+import random
+import time
+from collections.abc import Awaitable
+from collections.abc import Callable
+from dataclasses import dataclass
+from typing import Any
+from typing import Optional
+from typing import TypeVar
+
+import httpx
+
+from settings import Settings
+from settings import settings
+from tpdingding.exception import DingDingException
+from tpdingding.exception import RetryableException
+from tpdingding.exception import TokenInvalidException
+
+T = TypeVar('T')
+
+# https://open.dingtalk.com/document/orgapp/server-api-error-codes-1
+RETRYABLE_ERRCODES = {
+    -1,  # 系统繁忙
+    90002,  # 服务器繁忙
+    90006,  # 调用频率超过每分钟限流
+    90018,  # 调用频率超过每秒限流
+    90019,  # 调用频率超过每秒限流
+}
+TOKEN_INVALID_ERRCODES = {
+    40001,  # 获取 access_token 时 Secret 错误, 或者 access_token 无效
+    40014,  # 不合法的 access_token
+    42001,  # access_token 超时
+}
+
+# 请求没有发出的连接阶段错误, 非幂等接口 (发送消息) 只重试这些错误与 access_token 失效,
+# 读超时, 5xx 与系统繁忙时钉钉可能已经处理了请求, 由调用方记录在发送结果中
+CONNECT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+RETRYABLE_ERRORS = (RetryableException, httpx.TransportError)  # TransportError 包含超时与连接错误
+
+
+def check_response(response: httpx.Response, message: str) -> dict[str, Any]:
+    """校验接口返回, 按照状态码与 errcode 抛出对应的异常, 成功时返回 json 内容"""
+    status_code = response.status_code
+    if status_code == httpx.codes.TOO_MANY_REQUESTS or status_code >= httpx.codes.INTERNAL_SERVER_ERROR:
+        raise RetryableException(f"{message}, 状态码:{status_code}, 返回内容:{response.text}")
+    if status_code != httpx.codes.OK:
+        raise DingDingException(f"{message}, 状态码:{status_code}, 返回内容:{response.text}")
+
+    data = response.json()
+    if not isinstance(data, dict):
+        return data
+
+    errcode = data.get('errcode') or 0
+    if errcode == 0:
+        return data
+
+    sub_code = str(data.get('sub_code') or '')
+    if errcode in TOKEN_INVALID_ERRCODES or (sub_code.isdigit() and int(sub_code) in TOKEN_INVALID_ERRCODES):
+        raise TokenInvalidException(f"{message}, access_token 无效, 返回内容:{response.text}", errcode)
+    if errcode in RETRYABLE_ERRCODES:
+        raise RetryableException(f"{message}, 返回内容:{response.text}", errcode)
+    raise DingDingException(f"{message}, 返回内容:{response.text}", errcode)
+
+
+@dataclass
+class RetryPolicy:
+    max_attempts: int = 4
+    base_delay: float = 0.2
+    max_delay: float = 5.0
+    deadline: float = 20.0  # 单次调用(包含所有重试)的截止时间, 单位秒
+
+    @classmethod
+    def from_settings(cls, config: Settings) -> 'RetryPolicy':
+        return cls(
+            max_attempts=config.retry_max_attempts,
+            base_delay=config.retry_base_delay,
+            max_delay=config.retry_max_delay,
+            deadline=config.retry_deadline,
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """full jitter: 在 [0, min(max_delay, base_delay * 2 ^ attempt)] 中随机取值"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+async def retry(
+    func: Callable[[], Awaitable[T]],
+    policy: RetryPolicy,
+    name: str,
+    on_token_invalid: Optional[Callable[[], None]] = None,
+    retry_on: tuple[type[Exception], ...] = RETRYABLE_ERRORS,
+) -> T:
+    """
+    调用 func, retry_on 中的错误按 policy 重试
+
+    on_token_invalid 不为空时, access_token 失效会调用它使 token 失效, 然后立即重试一次
+    """
+    deadline = time.monotonic() + policy.deadline
+    attempt, token_refreshed = 0, False
+    while True:
+        attempt += 1
+        remaining = deadline - time.monotonic()
+        try:
+            return await asyncio.wait_for(func(), timeout=remaining)
+        except asyncio.TimeoutError as err:
+            raise DingDingException(f"{name} 超过截止时间 {policy.deadline} 秒, 已尝试 {attempt} 次") from err
+        except TokenInvalidException:
+            if on_token_invalid is None or token_refreshed:
+                raise
+            logging.warning("%s access_token 无效, 刷新后重试", name)
+            on_token_invalid()
+            token_refreshed = True
+        except retry_on as err:
+            delay = policy.backoff(attempt)
+            if attempt >= policy.max_attempts or time.monotonic() + delay >= deadline:
+                raise
+            logging.warning("%s 第 %s 次调用失败, %.2f 秒后重试: %r", name, attempt, delay, err)
+            await asyncio.sleep(delay)
+
+
+RETRY_POLICY = RetryPolicy.from_settings(settings)
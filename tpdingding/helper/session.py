@@ -1,21 +1,133 @@
+from collections.abc import AsyncIterator
+from collections.abc import Callable
+from contextlib import asynccontextmanager
 from contextvars import ContextVar
+from typing import Optional
 from typing import Protocol
 
-from sqlalchemy import create_engine
+from sqlalchemy import event
+from sqlalchemy import make_url
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.orm import ORMExecuteState
+from sqlalchemy.orm import Session
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.orm.session import Session
 
 from settings import settings
+from tpdingding.exception import MissingSessionException
+from tpdingding.exception import ReadOnlySessionException
+from tpdingding.helper.pool import MeteredQueuePool
 
-POSTGRES_SESSION_VAR: ContextVar[AsyncSession] = ContextVar('PostgresSession')
-POSTGRES_ENGINE = create_async_engine(settings.database_url)
+POSTGRES_SESSION_VAR: ContextVar['SessionScope'] = ContextVar('PostgresSession')
+POSTGRES_ENGINE = create_async_engine(
+    settings.database_url,
+    poolclass=MeteredQueuePool,
+    pool_size=settings.pg_pool_size,
+    max_overflow=settings.pg_max_overflow,
+    pool_timeout=settings.pg_pool_timeout,
+    pool_recycle=settings.pg_pool_recycle,
+    pool_pre_ping=settings.pg_pool_pre_ping,
+    connect_args={'statement_cache_size': settings.pg_statement_cache_size},
+)
 PostgresSession = sessionmaker(POSTGRES_ENGINE, class_=AsyncSession)
 
-SQLITE_SESSION_VAR: ContextVar[Session] = ContextVar('SqlLiteSession')
-SQLITE_ENGINE = create_engine(settings.sqlite_database_url)
-SqliteSession = sessionmaker(SQLITE_ENGINE)
+SQLITE_SESSION_VAR: ContextVar['SessionScope'] = ContextVar('SqlLiteSession')
+# 云端部署的多个 gunicorn worker 共享同一个 sqlite 文件, 每个进程各自持有连接池,
+# 进程之间依靠 WAL 和 busy_timeout 协调读写
+SQLITE_ENGINE = create_async_engine(
+    make_url(settings.sqlite_database_url).set(drivername='sqlite+aiosqlite'),
+    poolclass=MeteredQueuePool,
+    pool_size=settings.sqlite_pool_size,
+    max_overflow=settings.sqlite_max_overflow,
+    pool_timeout=settings.sqlite_pool_timeout,
+)
+SqliteSession = sessionmaker(SQLITE_ENGINE, class_=AsyncSession)
+
+
+@event.listens_for(SQLITE_ENGINE.sync_engine, 'connect')
+def _set_sqlite_pragma(dbapi_connection, _):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f'PRAGMA mmap_size={int(settings.sqlite_mmap_size)}')
+    cursor.execute(f'PRAGMA busy_timeout={int(settings.sqlite_busy_timeout)}')
+    cursor.close()
+
+
+class SessionScope:
+    """
+    请求级别的数据库会话
+
+    第一次使用时才创建会话, 不访问数据库的请求不会占用连接;
+    结束时只有执行过写操作才提交, 只读会话执行写操作会抛出 ReadOnlySessionException
+    """
+
+    def __init__(self, factory: Callable[[], AsyncSession], read_only: bool = False):
+        self.factory = factory
+        self.read_only = read_only
+        self.session: Optional[AsyncSession] = None
+
+    def get(self) -> AsyncSession:
+        if self.session is None:
+            self.session = self.factory()
+            self.session.info['read_only'] = self.read_only
+        return self.session
+
+    def set_read_only(self) -> None:
+        self.read_only = True
+        if self.session is not None:
+            self.session.info['read_only'] = True
+
+    @property
+    def has_writes(self) -> bool:
+        return self.session is not None and self.session.info.get('has_writes', False)
+
+    async def commit(self) -> None:
+        if self.has_writes:
+            await self.session.commit()
+            self.session.info['has_writes'] = False
+
+    async def close(self) -> None:
+        if self.session is not None:
+            await self.session.close()
+
+
+@asynccontextmanager
+async def background_session(
+    session_var: ContextVar[SessionScope], factory: Callable[[], AsyncSession]
+) -> AsyncIterator[AsyncSession]:
+    """后台任务没有请求的会话作用域: 设置一个新的作用域并开启事务, 正常退出时提交, 抛出异常时回滚"""
+    session_scope = SessionScope(factory)
+    token = session_var.set(session_scope)
+    try:
+        async with session_scope.get().begin():
+            yield session_scope.get()
+    finally:
+        await session_scope.close()
+        session_var.reset(token)
+
+
+def after_commit(session: AsyncSession, callback: Callable[[], None]) -> None:
+    """会话下一次提交成功后调用 callback, 回滚时不调用"""
+    event.listen(session.sync_session, 'after_commit', lambda _: callback(), once=True)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_writes(state: ORMExecuteState):
+    if state.is_select:
+        return
+    if state.session.info.get('read_only'):
+        raise ReadOnlySessionException(f'只读会话不能执行 {state.statement}')
+    state.session.info['has_writes'] = True
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_flush(session: Session, *_):
+    if not (session.new or session.dirty or session.deleted):
+        return
+    if session.info.get('read_only'):
+        raise ReadOnlySessionException('只读会话不能写入')
+    session.info['has_writes'] = True
 
 
 class PGSessionMaker(Protocol):
@@ -24,23 +136,19 @@ class PGSessionMaker(Protocol):
 
 
 class SQLiteSessionMaker(Protocol):
-    def __call__(self) -> PostgresSession:
+    def __call__(self) -> SqliteSession:
         ...
 
 
 def pg_session_maker() -> PostgresSession:
     try:
-        return POSTGRES_SESSION_VAR.get()
-    except LookupError:
-        session = PostgresSession()
-        POSTGRES_SESSION_VAR.set(session)
-        return session
+        return POSTGRES_SESSION_VAR.get().get()
+    except LookupError as err:
+        raise MissingSessionException('没有 Postgres 会话作用域, 后台任务需要使用 background_session') from err
 
 
 def sqlite_session_maker() -> SqliteSession:
     try:
-        return SQLITE_SESSION_VAR.get()
-    except LookupError:
-        session = SqliteSession()
-        SQLITE_SESSION_VAR.set(session)
-        return session
+        return SQLITE_SESSION_VAR.get().get()
+    except LookupError as err:
+        raise MissingSessionException('没有 SQLite 会话作用域, 后台任务需要使用 background_session') from err
@@ -1,30 +1,127 @@
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.requests import Request
-from starlette.responses import Response
+from starlette.types import ASGIApp
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
 
+from settings import DeployMode
 from settings import settings
+from tpdingding.helper.http import HTTP_CLIENTS
+from tpdingding.helper.ratelimit import RateLimiter
+from tpdingding.helper.retry import RETRY_POLICY
+from tpdingding.helper.session import POSTGRES_ENGINE
 from tpdingding.middleware.deploy import REPO
+from tpdingding.middleware.deploy import SESSION
 from tpdingding.model.context import Context
+from tpdingding.persistence.postgres import PostgresRepository
+from tpdingding.persistence.sqlite import SQLiteRepository
+from tpdingding.service.cache_bus import CacheBus
+from tpdingding.service.cache_bus import PostgresCacheBus
+from tpdingding.service.cache_bus import SQLiteCacheBus
+from tpdingding.service.dedup import EventDeduplicator
 from tpdingding.service.dingding import DingDingService
+from tpdingding.service.directory import DirectorySyncService
 from tpdingding.service.iam import IAMService
+from tpdingding.service.invalidation import InvalidationNotifier
+from tpdingding.service.message import MessageService
+from tpdingding.service.resolver import StaffResolver
+from tpdingding.service.suite_ticket import SuiteTicketStore
+
+if not settings.cache_bus_enabled:
+    CACHE_BUS = CacheBus()
+elif settings.dingding_deploy_mode == DeployMode.CLOUD:
+    assert isinstance(REPO, SQLiteRepository), '云端部署使用 SQLiteRepository'
+    CACHE_BUS = SQLiteCacheBus(
+        repo=REPO,
+        session=SESSION,
+        poll_interval=settings.cache_bus_poll_interval,
+        retention=settings.cache_bus_retention,
+    )
+else:
+    CACHE_BUS = PostgresCacheBus(
+        engine=POSTGRES_ENGINE,
+        channel=settings.cache_bus_channel,
+        keepalive=settings.cache_bus_keepalive,
+    )
+if isinstance(REPO, PostgresRepository):
+    CACHE_BUS.subscribe(REPO.apply_cache_event)
 
 DINGDING_SRV = DingDingService(
     suite_key=settings.dingding_suit_key,
     suite_secret=settings.dingding_suite_secret,
     repo=REPO,
+    session=SESSION,
     corp_token_url=settings.dingding_corp_token_url,
     send_message_url=settings.dingding_send_message_url,
     template_id=settings.dingding_template_id,
+    http=HTTP_CLIENTS,
+    token_expiry_margin=settings.dingding_token_expiry_margin,
+    token_refresh_ahead=settings.dingding_token_refresh_ahead,
+    max_users_per_message=settings.dingding_send_message_max_users,
+    corp_concurrency=settings.dingding_send_message_corp_concurrency,
+    rate_limiter=RateLimiter.from_settings(settings),
+    retry_policy=RETRY_POLICY,
+    cache_bus=CACHE_BUS,
+)
+IAM_SRV = IAMService(http=HTTP_CLIENTS)
+STAFF_RESOLVER = StaffResolver(
+    repo=REPO,
+    iam_srv=IAM_SRV,
+    maxsize=settings.staff_resolver_maxsize,
+    ttl=settings.staff_resolver_ttl,
+    cache_bus=CACHE_BUS,
+)
+MESSAGE_SRV = MessageService(resolver=STAFF_RESOLVER, http=HTTP_CLIENTS)
+NOTIFIER = InvalidationNotifier(http=HTTP_CLIENTS, local_hosts=settings.dingding_local_hosts)
+EVENT_DEDUP = EventDeduplicator(
+    repo=REPO,
+    ttl=settings.event_dedup_ttl,
+    maxsize=settings.event_dedup_maxsize,
+    purge_interval=settings.event_dedup_purge_interval,
+)
+SUITE_TICKET_STORE = SuiteTicketStore(
+    dingding_srv=DINGDING_SRV,
+    repo=REPO,
+    notifier=NOTIFIER,
+    session=SESSION,
+    flush_interval=settings.suite_ticket_flush_interval,
+)
+DIRECTORY_SRV = DirectorySyncService(
+    dingding_srv=DINGDING_SRV,
+    repo=REPO,
+    page_size=settings.directory_sync_page_size,
+    batch_size=settings.directory_sync_batch_size,
+    corp_concurrency=settings.directory_sync_corp_concurrency,
+    dept_concurrency=settings.directory_sync_dept_concurrency,
+    interval=settings.directory_sync_interval,
+    lease=settings.directory_sync_lease,
 )
-IAM_SRV = IAMService(host=settings.iam_host)
-
-
-class ContextMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next) -> Response:
-        request.state.context = Context(
-            repo=REPO,
-            suite_key=settings.dingding_suit_key,
-            dingding_srv=DINGDING_SRV,
-            iam_srv=IAM_SRV,
-        )
-        return await call_next(request)
+
+
+# Context 只包含进程级别的单例, 启动时构造一次, 所有请求共享
+CONTEXT = Context(
+    repo=REPO,
+    suite_key=settings.dingding_suit_key,
+    dingding_srv=DINGDING_SRV,
+    iam_srv=IAM_SRV,
+    message_srv=MESSAGE_SRV,
+    staff_resolver=STAFF_RESOLVER,
+    http=HTTP_CLIENTS,
+    notifier=NOTIFIER,
+    directory_srv=DIRECTORY_SRV,
+    event_dedup=EVENT_DEDUP,
+    suite_ticket_store=SUITE_TICKET_STORE,
+    cache_bus=CACHE_BUS,
+)
+
+
+class ContextMiddleware:
+    """纯 ASGI 中间件: 把预先构造的 Context 放入 request.state"""
+
+    def __init__(self, app: ASGIApp, context: Context = CONTEXT):
+        self.app = app
+        self.context = context
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] == 'http':
+            scope.setdefault('state', {})['context'] = self.context
+        await self.app(scope, receive, send)
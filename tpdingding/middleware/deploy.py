@@ -1,9 +1,21 @@
-from starlette.middleware.base import RequestResponseEndpoint
-from starlette.requests import Request
-from starlette.responses import Response
+from collections.abc import Callable
+from contextvars import ContextVar
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.types import ASGIApp
+from starlette.types import Message
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
 
 from settings import DeployMode
 from settings import settings
+from tpdingding.helper.http import HTTP_CLIENTS
+from tpdingding.helper.session import POSTGRES_SESSION_VAR
+from tpdingding.helper.session import SQLITE_SESSION_VAR
+from tpdingding.helper.session import PostgresSession
+from tpdingding.helper.session import SessionScope
+from tpdingding.helper.session import SqliteSession
 from tpdingding.helper.session import pg_session_maker
 from tpdingding.helper.session import sqlite_session_maker
 from tpdingding.persistence.debug import HybridRepository
@@ -11,30 +23,58 @@ from tpdingding.persistence.postgres import PostgresRepository
 from tpdingding.persistence.sqlite import SQLiteRepository
 
 
-async def __cloud_dispatch___(_, request: Request, call_next: RequestResponseEndpoint) -> Response:
-    with sqlite_session_maker() as session:
-        try:
-            response = await call_next(request)
-            session.commit()
-            return response
-        finally:
-            session.close()
+async def __dispatch__(
+    session_var: ContextVar[SessionScope],
+    factory: Callable[[], AsyncSession],
+    app: ASGIApp,
+    scope: Scope,
+    receive: Receive,
+    send: Send,
+) -> None:
+    """每个请求一个会话作用域, 会话在第一次使用时才创建, 有写操作时在响应头发送之前提交"""
+    session_scope = SessionScope(factory)
+    token = session_var.set(session_scope)
+
+    async def send_after_commit(message: Message) -> None:
+        if message['type'] == 'http.response.start':
+            await session_scope.commit()
+        await send(message)
+
+    try:
+        await app(scope, receive, send_after_commit)
+    finally:
+        await session_scope.close()
+        session_var.reset(token)
+
 
+async def __cloud_dispatch___(app: ASGIApp, scope: Scope, receive: Receive, send: Send) -> None:
+    await __dispatch__(SQLITE_SESSION_VAR, SqliteSession, app, scope, receive, send)
 
-async def __local_dispatch__(_, request: Request, call_next: RequestResponseEndpoint) -> Response:
-    async with pg_session_maker() as session:
-        try:
-            response = await call_next(request)
-            await session.commit()
-            return response
-        finally:
-            await session.close()
+
+async def __local_dispatch__(app: ASGIApp, scope: Scope, receive: Receive, send: Send) -> None:
+    await __dispatch__(POSTGRES_SESSION_VAR, PostgresSession, app, scope, receive, send)
 
 
 REPO_MAP = {
-    DeployMode.CLOUD: SQLiteRepository(sqlite_session_maker),
-    DeployMode.LOCAL: PostgresRepository(pg_session_maker),
-    DeployMode.DEV_DEBUG: HybridRepository(pg_session_maker),
+    DeployMode.CLOUD: SQLiteRepository(
+        sqlite_session_maker,
+        auth_code_ttl=settings.auth_code_ttl,
+        auth_code_max_entries=settings.auth_code_max_entries,
+    ),
+    DeployMode.LOCAL: PostgresRepository(
+        pg_session_maker,
+        HTTP_CLIENTS,
+        cache_ttl=settings.cloud_cache_ttl,
+        cache_stale_ttl=settings.cloud_cache_stale_ttl,
+        persist_cache=settings.cloud_cache_persist,
+        upsert_chunk_size=settings.dingding_user_upsert_chunk_size,
+    ),
+    DeployMode.DEV_DEBUG: HybridRepository(
+        pg_session_maker,
+        HTTP_CLIENTS,
+        auth_code_ttl=settings.auth_code_ttl,
+        auth_code_max_entries=settings.auth_code_max_entries,
+    ),
 }
 
 DISPATCH_MAP = {
@@ -43,5 +83,13 @@ DISPATCH_MAP = {
     DeployMode.DEV_DEBUG: __local_dispatch__,
 }
 
+# 后台任务 (收件箱 worker 等) 使用的会话作用域, 与同一部署模式下请求使用的数据库相同
+SESSION_MAP: dict[DeployMode, tuple[ContextVar[SessionScope], Callable[[], AsyncSession]]] = {
+    DeployMode.CLOUD: (SQLITE_SESSION_VAR, SqliteSession),
+    DeployMode.LOCAL: (POSTGRES_SESSION_VAR, PostgresSession),
+    DeployMode.DEV_DEBUG: (POSTGRES_SESSION_VAR, PostgresSession),
+}
+
 DISPATCH = DISPATCH_MAP[settings.dingding_deploy_mode]
+SESSION = SESSION_MAP[settings.dingding_deploy_mode]
 REPO = REPO_MAP[settings.dingding_deploy_mode]
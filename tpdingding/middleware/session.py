@@ -1,7 +1,23 @@
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
 
 from tpdingding.middleware.deploy import DISPATCH
 
 
-class DBSessionMiddleware(BaseHTTPMiddleware):
-    dispatch = DISPATCH
+class DBSessionMiddleware:
+    """
+    纯 ASGI 中间件: 每个请求使用一个数据库会话
+
+    会话在响应头发送之前提交, 流式响应的响应体在提交之后继续发送
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        await DISPATCH(self.app, scope, receive, send)
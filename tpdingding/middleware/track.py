@@ -1,50 +1,122 @@
 import json
+import queue
+import time
 import uuid
 from contextvars import ContextVar
-from dataclasses import dataclass
-from dataclasses import field
 from logging import Formatter
 from logging import LogRecord
+from logging import StreamHandler
 from logging import setLogRecordFactory
 from logging.config import dictConfig
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from typing import Any
+from typing import Optional
+from typing import TextIO
 
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.middleware.base import DispatchFunction
-from starlette.middleware.base import RequestResponseEndpoint
-from starlette.requests import Request
-from starlette.responses import Response
+from starlette.datastructures import Headers
 from starlette.types import ASGIApp
+from starlette.types import Message
+from starlette.types import Receive
+from starlette.types import Scope
+from starlette.types import Send
 
 from settings import Settings
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 REQUEST_ID_HEADER = 'x-request-id'
 USER_ID_HEADER = 'x-authenticated-userid'
 REQUEST_ID_CTX = ContextVar('request_id', default='N/A')
 USER_ACCOUNT_CTX = ContextVar('user_account', default='N/A')
+LOG_QUEUE_HANDLER = 'tpdingding.middleware.track.LogQueueHandler'
+
+
+def _dumps_json(data: dict[str, Any]) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def _dumps_orjson(data: dict[str, Any]) -> str:
+    return orjson.dumps(data, default=str).decode()
 
 
 class JSONFormatter(Formatter):
-    default_time_format = '%Y-%m-%d %H:%M:%S.%%03d %z'
-    attrs = ['request_id', 'user_account', 'name', 'levelname', 'process']
+    """单行 JSON 日志, 安装了 orjson 时使用 orjson 序列化"""
+
+    def __init__(self, *args, backend: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        backend = backend or ('orjson' if orjson is not None else 'json')
+        self.dumps = _dumps_orjson if backend == 'orjson' else _dumps_json
+        self._second: tuple[int, str, str] = (-1, '', '')  # 同一秒内的日志复用格式化好的时间
 
     def format(self, record: LogRecord) -> str:
-        data = {attr: record.__dict__.get(attr) for attr in self.attrs}
-        data['message'] = record.getMessage()
-        data['asctime'] = self.formatTime(record, self.default_time_format) % record.msecs
+        attrs = record.__dict__
+        data = {
+            'request_id': attrs.get('request_id'),
+            'user_account': attrs.get('user_account'),
+            'name': record.name,
+            'levelname': record.levelname,
+            'process': record.process,
+            'message': record.getMessage(),
+            'asctime': self._asctime(record),
+        }
         if record.exc_info:
             data['exc_text'] = self.formatException(record.exc_info).splitlines()
         if record.stack_info:
             data['stack_info'] = self.formatStack(record.stack_info)
-        return json.dumps(data, ensure_ascii=False, indent=2)
+        return self.dumps(data)
+
+    def _asctime(self, record: LogRecord) -> str:
+        second, prefix, suffix = self._second
+        if second != int(record.created):
+            second = int(record.created)
+            converted = self.converter(second)
+            prefix, suffix = time.strftime('%Y-%m-%d %H:%M:%S', converted), time.strftime('%z', converted)
+            self._second = (second, prefix, suffix)
+        return f'{prefix}.{int(record.msecs):03d} {suffix}'
 
 
 class LogExtraFactory(LogRecord):
+    """创建日志记录时读取请求上下文, 日志可能在 QueueListener 的线程中格式化, 那里读不到 ContextVar"""
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        request_id = REQUEST_ID_CTX.get() or 'N/A'
-        user_account = USER_ACCOUNT_CTX.get() or 'N/A'
-        self.__dict__['request_id'] = request_id
-        self.__dict__['user_account'] = user_account
+        self.request_id = REQUEST_ID_CTX.get()
+        self.user_account = USER_ACCOUNT_CTX.get()
+
+
+class LogQueueHandler(QueueHandler):
+    """
+    非阻塞的日志 handler
+
+    调用方的线程只合并 msg 与 args 并放入进程内队列, 格式化与写入 stream 都在 QueueListener 的线程中完成;
+    logging 关闭或重新配置时 close 会等待队列中的日志写完
+    """
+
+    def __init__(self, stream: Optional[TextIO] = None):
+        super().__init__(queue.SimpleQueue())
+        self.target = StreamHandler(stream)
+        self.listener: Optional[QueueListener] = QueueListener(self.queue, self.target)
+        self.listener.start()
+
+    def setFormatter(self, fmt: Optional[Formatter]) -> None:
+        super().setFormatter(fmt)
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # 队列在进程内, 不需要像默认实现那样预先格式化并去掉 exc_info, 只需要在参数被修改之前固定消息内容
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def close(self) -> None:
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+            self.target.close()
+        super().close()
 
 
 def init_logger(settings: Settings):
@@ -73,7 +145,12 @@ def init_logger(settings: Settings):
                 },
             },
         },
-        'handlers': {'console': {'class': 'logging.StreamHandler', 'formatter': settings.log_formatter}},
+        'handlers': {
+            'console': {
+                'class': LOG_QUEUE_HANDLER if settings.log_async else 'logging.StreamHandler',
+                'formatter': settings.log_formatter,
+            },
+        },
         'root': {'level': settings.log_level, 'handlers': ['console']},
         'loggers': {
             'tpdingding': {'level': settings.log_level, 'handlers': ['console'], 'propagate': False},
@@ -89,26 +166,38 @@ def init_logger(settings: Settings):
     return config
 
 
-@dataclass
-class RequestIdMiddleware(BaseHTTPMiddleware):
-    app: ASGIApp
-    id_header: str = REQUEST_ID_HEADER
-    dispatch_func: DispatchFunction = field(init=False)
+class RequestIdMiddleware:
+    """纯 ASGI 中间件: 设置请求 ID 和用户账号, 并在响应头中返回请求 ID"""
+
+    def __init__(self, app: ASGIApp, id_header: str = REQUEST_ID_HEADER):
+        self.app = app
+        self.id_header = id_header
+        self._raw_id_header = id_header.encode('latin-1')
 
-    def __post_init__(self):
-        self.dispatch_func = self.dispatch
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next: RequestResponseEndpoint) -> Response:
-        request_id = request.headers.get(self.id_header, str(uuid.uuid4()))
-        REQUEST_ID_CTX.set(request_id)
+        headers = Headers(scope=scope)
+        request_id = headers.get(self.id_header, str(uuid.uuid4()))
+        request_id_token = REQUEST_ID_CTX.set(request_id)
 
-        user_info = request.headers.get(USER_ID_HEADER)
+        user_info = headers.get(USER_ID_HEADER)
         if (not user_info) or (user_info == 'undefined'):
             user_info = '{}'
-        account = json.loads(user_info).get('account')
-        USER_ACCOUNT_CTX.set(account)
-
-        response = await call_next(request)
-        response.headers[self.id_header] = request_id
-
-        return response
+        account = json.loads(user_info).get('account') or 'N/A'
+        user_account_token = USER_ACCOUNT_CTX.set(account)
+
+        async def send_with_request_id(message: Message) -> None:
+            if message['type'] == 'http.response.start':
+                raw_headers = [(k, v) for k, v in message.get('headers', []) if k.lower() != self._raw_id_header]
+                raw_headers.append((self._raw_id_header, request_id.encode('latin-1')))
+                message['headers'] = raw_headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            REQUEST_ID_CTX.reset(request_id_token)
+            USER_ACCOUNT_CTX.reset(user_account_token)
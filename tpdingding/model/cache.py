@@ -0,0 +1,32 @@
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic import Field
+
+
+class CacheKind(str, Enum):
+    SUITE = 'SUITE'
+    CORP_AUTH = 'CORP_AUTH'
+    CORP_TOKEN = 'CORP_TOKEN'
+    STAFF_BINDING = 'STAFF_BINDING'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class CacheInvalidation(BaseModel):
+    kind: CacheKind = Field(description='缓存类型')
+    key: str = Field(
+        description='SUITE 为 suite_key, CORP_AUTH 与 CORP_TOKEN 为 corp_id, '
+        'STAFF_BINDING 为 [tenant_id, staff_id, user_id] 的 json, * 表示全部'
+    )
+
+
+class CacheEvent(BaseModel):
+    """在 gunicorn worker 之间广播的缓存变化"""
+
+    kind: CacheKind
+    key: str
+    value: Optional[str] = Field(description='刷新后的值 (json), 为空时表示缓存失效')
+    origin: str = Field(description='发布事件的进程, 进程收到自己发布的事件时跳过')
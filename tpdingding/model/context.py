@@ -1,15 +1,32 @@
 from pydantic import BaseModel
 
+from tpdingding.helper.http import HttpClients
 from tpdingding.persistence.abstract import Repository
+from tpdingding.service.cache_bus import CacheBus
+from tpdingding.service.dedup import EventDeduplicator
 from tpdingding.service.dingding import DingDingService
+from tpdingding.service.directory import DirectorySyncService
 from tpdingding.service.iam import IAMService
+from tpdingding.service.invalidation import InvalidationNotifier
+from tpdingding.service.message import MessageService
+from tpdingding.service.resolver import StaffResolver
+from tpdingding.service.suite_ticket import SuiteTicketStore
 
 
 class Context(BaseModel):
     repo: Repository
     dingding_srv: DingDingService
     iam_srv: IAMService
+    message_srv: MessageService
+    staff_resolver: StaffResolver
+    http: HttpClients
+    notifier: InvalidationNotifier
+    directory_srv: DirectorySyncService
+    event_dedup: EventDeduplicator
+    suite_ticket_store: SuiteTicketStore
+    cache_bus: CacheBus
     suite_key: str
 
     class Config:
         arbitrary_types_allowed = True
+        frozen = True
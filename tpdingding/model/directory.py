@@ -0,0 +1,40 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic import Field
+
+from tpdingding.model.entity import CorpId
+
+
+class DirectorySyncStatus(str, Enum):
+    RUNNING = 'RUNNING'
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class DirectorySyncInput(BaseModel):
+    corp_ids: Optional[list[CorpId]] = Field(description='需要同步的企业, 为空时同步所有已知的企业')
+    force: bool = Field(False, description='忽略同步间隔, 已完成的企业也重新同步')
+
+
+class DirectorySyncAccepted(BaseModel):
+    corp_ids: list[CorpId] = Field(description='开始在后台同步的企业')
+
+
+class DirectorySyncState(BaseModel):
+    corp_id: CorpId
+    status: DirectorySyncStatus
+    cursor: Optional[str] = Field(description='未完成的同步中尚未写入的部门 ID 列表 (json), 下次同步从这里继续')
+    synced_users: int = Field(description='本次同步已写入的用户数')
+    started_at: Optional[datetime]
+    finished_at: Optional[datetime] = Field(description='最近一次同步完成的时间')
+    last_error: Optional[str]
+    updated_at: datetime
+
+    class Config:
+        orm_mode = True
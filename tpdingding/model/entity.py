@@ -1,3 +1,4 @@
+from enum import Enum
 from typing import Optional
 
 from pydantic import BaseModel
@@ -98,6 +99,23 @@ class DingDingUser(BaseModel):
         orm_mode = True
 
 
+class DingDingUserImportInput(BaseModel):
+    users: list[DingDingUser] = Field(description='钉钉用户, 按 (corp_id, user_id) 写入或更新')
+
+
+class DingDingUserImportResult(BaseModel):
+    imported: int = Field(description='写入或更新的用户数')
+    skipped: int = Field(description='没有 user_id 或重复而跳过的用户数')
+
+
+class DingDingRecipient(BaseModel):
+    """IAM 平台的 staff 对应的钉钉用户"""
+
+    staff_id: StaffId
+    user_id: UserId
+    corp_id: CorpId
+
+
 class SendMessageInput(BaseModel):
     staff_ids: list[StaffId] = Field(description='IAM 平台的 StaffId')
     tenant_id: TenantId = Field(description='IAM 平台的 TenantId')
@@ -115,3 +133,40 @@ class CloudSendMessageInput(BaseModel):
     corp_id: CorpId = Field(description='钉钉企业 ID')
     user_ids: list[UserId] = Field(description='钉钉用户 ID')
     message: str = Field(description='消息内容')
+
+
+class CloudBatchSendMessageInput(BaseModel):
+    jobs: list[CloudSendMessageInput] = Field(description='发送任务, 每个任务会按照钉钉接收人上限拆分为多个分片')
+
+
+class SendMessageChunkResult(BaseModel):
+    corp_id: CorpId = Field(description='钉钉企业 ID')
+    user_ids: list[UserId] = Field(description='本分片的钉钉用户 ID')
+    success: bool = Field(description='是否发送成功')
+    task_id: Optional[int] = Field(description='钉钉返回的异步发送任务 ID')
+    errmsg: Optional[str] = Field(description='失败原因')
+
+
+class DeliveryStatus(str, Enum):
+    SENT = 'SENT'
+    FAILED = 'FAILED'
+    NOT_FOUND = 'NOT_FOUND'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class RecipientDelivery(BaseModel):
+    staff_id: StaffId = Field(description='IAM 平台的 StaffId')
+    status: DeliveryStatus = Field(description='发送状态')
+    user_id: Optional[UserId] = Field(description='钉钉用户 ID, 未找到绑定的钉钉用户时为空')
+    corp_id: Optional[CorpId] = Field(description='钉钉企业 ID, 未找到绑定的钉钉用户时为空')
+    task_id: Optional[int] = Field(description='钉钉返回的异步发送任务 ID')
+    errmsg: Optional[str] = Field(description='失败原因')
+
+
+class SendMessageReport(BaseModel):
+    recipients: list[RecipientDelivery] = Field(description='每个接收人的发送结果')
+
+    def of_status(self, status: DeliveryStatus) -> list[RecipientDelivery]:
+        return [recipient for recipient in self.recipients if recipient.status == status]
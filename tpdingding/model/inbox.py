@@ -0,0 +1,30 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic import Field
+
+
+class InboxStatus(str, Enum):
+    PENDING = 'PENDING'
+    FAILED = 'FAILED'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class InboxEvent(BaseModel):
+    id: int
+    event_type: str
+    payload: str = Field(description='解密后的事件 json')
+    status: InboxStatus
+    attempts: int = Field(description='已领取处理的次数')
+    last_error: Optional[str]
+    next_attempt_at: datetime
+    claim_id: Optional[str] = Field(description='领取时生成的随机值, 删除与更新时校验, 租约过期后被重新领取的事件不会被覆盖')
+    order_key: Optional[str]
+    created_at: datetime
+
+    class Config:
+        orm_mode = True
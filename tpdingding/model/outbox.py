@@ -0,0 +1,40 @@
+from datetime import datetime
+from enum import Enum
+from typing import Optional
+
+from pydantic import BaseModel
+from pydantic import Field
+
+
+class OutboxStatus(str, Enum):
+    PENDING = 'PENDING'
+    RUNNING = 'RUNNING'
+    SUCCEEDED = 'SUCCEEDED'
+    FAILED = 'FAILED'
+
+    def __str__(self):
+        return str(self.value)
+
+
+class OutboxAccepted(BaseModel):
+    id: int = Field(description='发件箱消息 ID, 可用于查询发送状态')
+
+
+class OutboxMessage(BaseModel):
+    id: int
+    status: OutboxStatus
+    attempts: int = Field(description='已尝试发送的次数')
+    last_error: Optional[str] = Field(description='最近一次发送失败的原因')
+    next_attempt_at: datetime
+    created_at: datetime
+    updated_at: datetime
+
+    class Config:
+        orm_mode = True
+
+
+class OutboxEntry(OutboxMessage):
+    """worker 领取的发件箱消息"""
+
+    payload: str = Field(description='SendMessageInput json')
+    report: Optional[str] = Field(description='之前各次发送合并后的 SendMessageReport json')
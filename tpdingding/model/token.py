@@ -15,5 +15,15 @@ class AccessToken:
     def __post_init__(self):
         self.expires_at = datetime.now() + timedelta(seconds=self.expires_in)
 
-    def is_expired(self) -> bool:
-        return self.expires_at < datetime.now()
+    def is_expired(self, margin: int = 0) -> bool:
+        """margin 为安全余量(秒), 避免 token 在请求途中过期"""
+        return self.expires_at < datetime.now() + timedelta(seconds=margin)
+
+
+@dataclass
+class TokenMetrics:
+    hits: int = 0
+    misses: int = 0
+    refreshes: int = 0
+    background_refreshes: int = 0
+    failures: int = 0
@@ -29,6 +29,14 @@ class Repository(ABC):
     async def relieve_org_suite_auth_info(self, corp_id: str) -> bool:
         ...
 
+    @abstractmethod
+    async def save_org_suite_auth_infos(self, data: dict[str, dict[str, Any]]) -> bool:
+        ...
+
+    @abstractmethod
+    async def relieve_org_suite_auth_infos(self, corp_ids: list[str]) -> bool:
+        ...
+
     @abstractmethod
     async def get_org_suite_auth_info(self, corp_id: str) -> Optional[CorpAuth]:
         ...
@@ -37,10 +45,18 @@ class Repository(ABC):
     async def of_user_ids(self, user_ids: list[str]) -> list[DingDingUser]:
         ...
 
+    @abstractmethod
+    async def of_staff_ids(self, tenant_id: str, staff_ids: list[str]) -> list[DingDingUser]:
+        ...
+
     @abstractmethod
     async def save_user(self, auth_code: str, user: DingDingUser) -> bool:
         ...
 
+    @abstractmethod
+    async def save_users(self, users: list[DingDingUser]) -> int:
+        ...
+
     @abstractmethod
     async def get_user_by_auth_code(self, auth_code: str) -> DingDingUser:
         ...
@@ -0,0 +1,63 @@
+import logging
+from collections.abc import Callable
+from datetime import timedelta
+
+import pendulum
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tpdingding.exception import DingDingException
+from tpdingding.model.entity import DingDingUser
+from tpdingding.persistence.model.orm import AuthCodeOrm
+
+
+class AuthCodeMixIn:
+    """
+    auth_code 对应的用户信息保存在数据库中, 多个 worker 共享
+
+    * 每个 auth_code 只能被消费一次: 消费时把 expires_at 改为当前时间, 并发消费时只有一个 UPDATE 命中
+    * 超过 auth_code_ttl 秒没有被消费的记录, 以及超过 auth_code_max_entries 条的最早的记录在写入时清理
+    """
+
+    session_maker: Callable[[], AsyncSession]
+    auth_code_ttl: float
+    auth_code_max_entries: int
+
+    async def save_auth_code(self, auth_code: str, user: DingDingUser) -> None:
+        # sqlite 与 postgres 共用, 不使用方言相关的 ON CONFLICT, 同一个 auth_code 重复回调时先删除旧记录
+        now = pendulum.now('UTC')
+        session = self.session_maker()
+        await session.execute(delete(AuthCodeOrm).where(AuthCodeOrm.expires_at <= now))
+        await session.execute(delete(AuthCodeOrm).where(AuthCodeOrm.auth_code == auth_code))
+        await session.execute(
+            insert(AuthCodeOrm).values(
+                auth_code=auth_code,
+                payload=user.json(),
+                expires_at=now + timedelta(seconds=self.auth_code_ttl),
+                created_at=now,
+                updated_at=now,
+            )
+        )
+        max_id = select(func.max(AuthCodeOrm.id)).scalar_subquery()  # pylint: disable=not-callable
+        await session.execute(delete(AuthCodeOrm).where(AuthCodeOrm.id <= max_id - self.auth_code_max_entries))
+
+    async def consume_auth_code(self, auth_code: str) -> DingDingUser:
+        now = pendulum.now('UTC')
+        session = self.session_maker()
+        stmt = (
+            update(AuthCodeOrm)
+            .where(AuthCodeOrm.auth_code == auth_code, AuthCodeOrm.expires_at > now)
+            .values(expires_at=now, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        if (await session.execute(stmt)).rowcount != 1:
+            raise DingDingException(f"auth_code {auth_code} 不存在, 已过期或已被消费")
+
+        stmt = select(AuthCodeOrm.payload).where(AuthCodeOrm.auth_code == auth_code)
+        payload = (await session.execute(stmt)).scalar_one()
+        logging.warning("AuthCode %s 对应的用户信息已经被消费，不可重复使用", auth_code)
+        return DingDingUser.parse_raw(payload)
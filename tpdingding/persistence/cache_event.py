@@ -0,0 +1,44 @@
+from collections.abc import Callable
+from datetime import timedelta
+
+import pendulum
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tpdingding.model.cache import CacheEvent
+from tpdingding.persistence.model.orm import CacheEventOrm
+
+
+class CacheEventMixIn:
+    """云端部署的缓存变化日志, 保存在 sqlite 中, 同一台机器上的 gunicorn worker 轮询读取"""
+
+    session_maker: Callable[[], AsyncSession]
+
+    async def append_cache_event(self, event: CacheEvent) -> bool:
+        now = pendulum.now('UTC')
+        stmt = insert(CacheEventOrm).values(**event.dict(), created_at=now, updated_at=now)
+        await self.session_maker().execute(stmt)
+        return True
+
+    async def list_cache_events(self, after_id: int, limit: int) -> list[tuple[int, CacheEvent]]:
+        stmt = select(CacheEventOrm).where(CacheEventOrm.id > after_id).order_by(CacheEventOrm.id).limit(limit)
+        result = await self.session_maker().execute(stmt)
+        return [
+            (row.id, CacheEvent(kind=row.kind, key=row.key, value=row.value, origin=row.origin))
+            for row in result.scalars()
+        ]
+
+    async def last_cache_event_id(self) -> int:
+        stmt = select(func.max(CacheEventOrm.id))  # pylint: disable=not-callable
+        result = await self.session_maker().execute(stmt)
+        return result.scalar() or 0
+
+    async def purge_cache_events(self, retention: float) -> int:
+        stmt = delete(CacheEventOrm).where(
+            CacheEventOrm.created_at <= pendulum.now('UTC') - timedelta(seconds=retention)
+        )
+        result = await self.session_maker().execute(stmt)
+        return result.rowcount
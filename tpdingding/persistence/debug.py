@@ -1,6 +1,5 @@
 """This Repository is a hybrid of the two repositories <Postgres & Sqlite>, which is used to debug the application."""
 import json
-import logging
 from typing import Any
 from typing import Optional
 
@@ -9,35 +8,45 @@ from sqlalchemy import delete
 from sqlalchemy import select
 from sqlalchemy.dialects.postgresql import insert
 
+from tpdingding.helper.http import HttpClients
 from tpdingding.helper.session import PGSessionMaker
 from tpdingding.model.entity import CorpAuth
 from tpdingding.model.entity import DingDingUser
 from tpdingding.model.entity import Suite
+from tpdingding.persistence.auth_code import AuthCodeMixIn
+from tpdingding.persistence.dedup import SeenEventMixIn
+from tpdingding.persistence.inbox import EventInboxMixIn
 from tpdingding.persistence.model.orm import CorpAuthOrm
 from tpdingding.persistence.model.orm import SuiteOrm
 from tpdingding.persistence.postgres import PostgresRepository
 
 
-class HybridRepository(PostgresRepository):
-    def __init__(self, maker: PGSessionMaker):
-        super().__init__(maker)
-        self.cache = {}
+class HybridRepository(AuthCodeMixIn, EventInboxMixIn, SeenEventMixIn, PostgresRepository):
+    def __init__(
+        self,
+        maker: PGSessionMaker,
+        http: HttpClients,
+        auth_code_ttl: float = 300,
+        auth_code_max_entries: int = 10000,
+    ):
+        super().__init__(maker, http)
+        self.auth_code_ttl = auth_code_ttl
+        self.auth_code_max_entries = auth_code_max_entries
 
     async def save_suite_ticket(self, suite: Suite) -> bool:
-        stmt = (
-            insert(SuiteOrm)
-            .values(
-                suite_ticket=suite.suite_ticket,
-                corp_id=suite.corp_id,
-                suite_key=suite.suite_key,
-            )
-            .on_conflict_do_update(
-                constraint=SuiteOrm.uq_suite_ticket_corp_id,
-                set_={
-                    'suite_ticket': suite.suite_ticket,
-                    'updated_at': pendulum.now(),
-                },
-            )
+        stmt = insert(SuiteOrm).values(
+            suite_ticket=suite.suite_ticket,
+            corp_id=suite.corp_id,
+            suite_key=suite.suite_key,
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint=SuiteOrm.uq_suite_ticket_corp_id,
+            set_={
+                'suite_ticket': stmt.excluded.suite_ticket,
+                'updated_at': pendulum.now(),
+            },
+            # ticket 没有变化时不改写 updated_at
+            where=SuiteOrm.suite_ticket != stmt.excluded.suite_ticket,
         )
         await self.session_maker().execute(stmt)
         return True
@@ -50,27 +59,35 @@ class HybridRepository(PostgresRepository):
         return Suite.from_orm(data) if data else None
 
     async def save_org_suite_auth_info(self, corp_id: str, data: dict[str, Any]) -> bool:
-        stmt = (
-            insert(CorpAuthOrm)
-            .values(
-                corp_id=corp_id,
-                permanent_code=data['permanent_code'],
-                raw=json.dumps(data),
-            )
-            .on_conflict_do_update(
-                constraint=CorpAuthOrm.uq_corp_auth_corp_id,
-                set_={
-                    'raw': json.dumps(data, ensure_ascii=False),
-                    'permanent_code': data['permanent_code'],
-                    'updated_at': pendulum.now(),
-                },
-            )
+        return await self.save_org_suite_auth_infos({corp_id: data})
+
+    async def relieve_org_suite_auth_info(self, corp_id: str) -> bool:
+        return await self.relieve_org_suite_auth_infos([corp_id])
+
+    async def save_org_suite_auth_infos(self, data: dict[str, dict[str, Any]]) -> bool:
+        stmt = insert(CorpAuthOrm).values(
+            [
+                {
+                    'corp_id': corp_id,
+                    'permanent_code': auth['permanent_code'],
+                    'raw': json.dumps(auth, ensure_ascii=False),
+                }
+                for corp_id, auth in data.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            constraint=CorpAuthOrm.uq_corp_auth_corp_id,
+            set_={
+                'raw': stmt.excluded.raw,
+                'permanent_code': stmt.excluded.permanent_code,
+                'updated_at': pendulum.now(),
+            },
         )
         await self.session_maker().execute(stmt)
         return True
 
-    async def relieve_org_suite_auth_info(self, corp_id: str) -> bool:
-        stmt = delete(CorpAuthOrm).where(CorpAuthOrm.corp_id == corp_id)
+    async def relieve_org_suite_auth_infos(self, corp_ids: list[str]) -> bool:
+        stmt = delete(CorpAuthOrm).where(CorpAuthOrm.corp_id.in_(corp_ids))
         await self.session_maker().execute(stmt)
         return True
 
@@ -81,13 +98,8 @@ class HybridRepository(PostgresRepository):
 
     async def save_user(self, auth_code: str, user: DingDingUser) -> bool:
         await super().save_user(auth_code, user)
-        self.cache[auth_code] = user
+        await self.save_auth_code(auth_code, user)
         return True
 
     async def get_user_by_auth_code(self, auth_code: str) -> DingDingUser:
-        if auth_code not in self.cache:
-            raise ValueError(f"auth_code {auth_code} 不存在")
-        user = self.cache[auth_code]
-        self.cache.pop(auth_code, None)
-        logging.warning("AuthCode  %s 对应的用户信息已经被消费，不可重复使用", auth_code)
-        return user
+        return await self.consume_auth_code(auth_code)
@@ -0,0 +1,39 @@
+from collections.abc import Callable
+from datetime import timedelta
+
+import pendulum
+from sqlalchemy import delete
+from sqlalchemy import exists
+from sqlalchemy import insert
+from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tpdingding.persistence.model.orm import SeenEventOrm
+
+
+class SeenEventMixIn:
+    """已处理的钉钉推送数据, 云端部署保存在 sqlite 中, DEV_DEBUG 保存在 Postgres 中"""
+
+    session_maker: Callable[[], AsyncSession]
+
+    async def mark_event_seen(self, event_key: str, ttl: float) -> bool:
+        """记录 event_key, 第一次出现时返回 True, 已经记录过时返回 False"""
+        # INSERT ... SELECT ... WHERE NOT EXISTS 先写后读, sqlite 中不会因为读快照过期而写失败
+        now = pendulum.now('UTC')
+        stmt = insert(SeenEventOrm).from_select(
+            ['event_key', 'expires_at', 'created_at', 'updated_at'],
+            select(
+                literal(event_key),
+                literal(now + timedelta(seconds=ttl), SeenEventOrm.expires_at.type),
+                literal(now, SeenEventOrm.created_at.type),
+                literal(now, SeenEventOrm.updated_at.type),
+            ).where(~exists().where(SeenEventOrm.event_key == event_key)),
+        )
+        result = await self.session_maker().execute(stmt)
+        return result.rowcount == 1
+
+    async def purge_seen_events(self) -> int:
+        stmt = delete(SeenEventOrm).where(SeenEventOrm.expires_at <= pendulum.now('UTC'))
+        result = await self.session_maker().execute(stmt)
+        return result.rowcount
@@ -0,0 +1,113 @@
+import uuid
+from collections.abc import Callable
+from datetime import datetime
+from datetime import timedelta
+from typing import Optional
+
+import pendulum
+from sqlalchemy import delete
+from sqlalchemy import insert
+from sqlalchemy import not_
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from tpdingding.model.inbox import InboxEvent
+from tpdingding.model.inbox import InboxStatus
+from tpdingding.persistence.model.orm import EventInboxOrm
+
+
+class EventInboxMixIn:
+    """
+    钉钉事件回调的收件箱, 云端部署保存在 sqlite 中, DEV_DEBUG 保存在 Postgres 中
+
+    sqlite 没有 SELECT ... FOR UPDATE SKIP LOCKED, 领取事件使用带条件的 UPDATE:
+    把到期事件的 next_attempt_at 推迟 lease 秒并写入随机的 claim_id, 再按 claim_id 查询领取到的事件。
+    UPDATE 的条件中包含 next_attempt_at, 并发领取同一个事件时只有一个 worker 命中。
+
+    同一企业的推送按顺序处理: 存在更早的未完成 (PENDING, 包括已领取与等待重试) 且 order_key 冲突的事件时不领取,
+    避免重试的旧授权覆盖之后的解除授权; 超过次数上限标记为 FAILED 的事件不再阻塞后面的事件。
+    删除与更新都校验 claim_id, 租约过期的 worker 不会删除或覆盖其他 worker 新的领取
+    """
+
+    session_maker: Callable[[], AsyncSession]
+
+    async def enqueue_event(self, event_type: str, payload: str, order_key: Optional[str] = None) -> int:
+        now = pendulum.now('UTC')
+        stmt = insert(EventInboxOrm).values(
+            event_type=event_type,
+            payload=payload,
+            order_key=order_key,
+            status=InboxStatus.PENDING.value,
+            attempts=0,
+            next_attempt_at=now,
+            created_at=now,
+            updated_at=now,
+        )
+        result = await self.session_maker().execute(stmt)
+        return result.inserted_primary_key[0]
+
+    async def claim_event(self, lease: float) -> Optional[InboxEvent]:
+        now = pendulum.now('UTC')
+        claim_id = uuid.uuid4().hex
+        due = (EventInboxOrm.status == InboxStatus.PENDING.value, EventInboxOrm.next_attempt_at <= now)
+        older = aliased(EventInboxOrm)
+        blocked = (
+            select(older.id)
+            .where(
+                older.id < EventInboxOrm.id,
+                older.status == InboxStatus.PENDING.value,
+                or_(older.order_key == EventInboxOrm.order_key, older.order_key == '*', EventInboxOrm.order_key == '*'),
+            )
+            .exists()
+        )
+        next_id = (
+            select(EventInboxOrm.id)
+            .where(*due, or_(EventInboxOrm.order_key.is_(None), not_(blocked)))
+            .order_by(EventInboxOrm.next_attempt_at, EventInboxOrm.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(EventInboxOrm)
+            .where(EventInboxOrm.id == next_id, *due)
+            .values(
+                attempts=EventInboxOrm.attempts + 1,
+                next_attempt_at=now + timedelta(seconds=lease),
+                claim_id=claim_id,
+                updated_at=now,
+            )
+            .execution_options(synchronize_session=False)
+        )
+        session = self.session_maker()
+        if (await session.execute(stmt)).rowcount != 1:
+            return None
+
+        result = await session.execute(select(EventInboxOrm).where(EventInboxOrm.claim_id == claim_id))
+        return InboxEvent.from_orm(result.scalar_one())
+
+    async def delete_event(self, event_id: int, claim_id: str) -> bool:
+        """事件已经被其他 worker 重新领取时不删除, 返回 False"""
+        stmt = delete(EventInboxOrm).where(EventInboxOrm.id == event_id, EventInboxOrm.claim_id == claim_id)
+        return (await self.session_maker().execute(stmt)).rowcount == 1
+
+    async def update_event(
+        self,
+        event_id: int,
+        claim_id: str,
+        status: InboxStatus,
+        last_error: Optional[str] = None,
+        next_attempt_at: Optional[datetime] = None,
+    ) -> bool:
+        values = {'status': status.value, 'last_error': last_error, 'updated_at': pendulum.now('UTC')}
+        if next_attempt_at is not None:
+            values['next_attempt_at'] = next_attempt_at
+        stmt = (
+            update(EventInboxOrm)
+            .where(EventInboxOrm.id == event_id, EventInboxOrm.claim_id == claim_id)
+            .values(values)
+            .execution_options(synchronize_session=False)
+        )
+        return (await self.session_maker().execute(stmt)).rowcount == 1
@@ -1,14 +1,21 @@
 from sqlalchemy import Column
 from sqlalchemy import DateTime
+from sqlalchemy import Index
 from sqlalchemy import Integer
 from sqlalchemy import String
 from sqlalchemy import UniqueConstraint
 from sqlalchemy import func
 from sqlalchemy.orm import declarative_base
 
+from tpdingding.model.directory import DirectorySyncState
+from tpdingding.model.directory import DirectorySyncStatus
 from tpdingding.model.entity import CorpAuth
 from tpdingding.model.entity import DingDingUser
 from tpdingding.model.entity import Suite
+from tpdingding.model.inbox import InboxEvent
+from tpdingding.model.inbox import InboxStatus
+from tpdingding.model.outbox import OutboxMessage
+from tpdingding.model.outbox import OutboxStatus
 
 BaseOrm = declarative_base()
 
@@ -78,4 +85,138 @@ class DingDingUserOrm(BaseOrm, IDMixIn, TimeMixIn):
         'user_id',
         name='uq_dingding_user_corp_id_union_id',
     )
-    __table_args__ = (uq_dingding_user_corp_id_user_id,)
+    # 发送消息时按 user_id / (tenant_id, staff_id) 批量查询, 唯一约束的首列是 corp_id 无法使用
+    ix_dingding_user_user_id = Index('ix_dingding_user_user_id', 'user_id')
+    ix_dingding_user_union_id = Index('ix_dingding_user_union_id', 'union_id')
+    ix_dingding_user_tenant_id_staff_id = Index('ix_dingding_user_tenant_id_staff_id', 'tenant_id', 'staff_id')
+    __table_args__ = (
+        uq_dingding_user_corp_id_user_id,
+        ix_dingding_user_user_id,
+        ix_dingding_user_union_id,
+        ix_dingding_user_tenant_id_staff_id,
+    )
+
+
+class AuthCodeOrm(BaseOrm, IDMixIn, TimeMixIn):
+    """用户授权回调获取的用户信息, 等待本地部署通过 auth_code 取走, 只能取一次"""
+
+    __tablename__ = 'auth_code'
+
+    auth_code = Column(String, nullable=False)
+    payload = Column(String, nullable=False)  # DingDingUser json
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    uq_auth_code_auth_code = UniqueConstraint(
+        'auth_code',
+        name='uq_auth_code_auth_code',
+    )
+    ix_auth_code_expires_at = Index('ix_auth_code_expires_at', 'expires_at')
+    __table_args__ = (uq_auth_code_auth_code, ix_auth_code_expires_at)
+
+
+class MessageOutboxOrm(BaseOrm, IDMixIn, TimeMixIn):
+    """本地部署的消息发件箱, 由后台 worker 通过 FOR UPDATE SKIP LOCKED 领取, RUNNING 状态的 next_attempt_at 为租约到期时间"""
+
+    __tablename__ = 'message_outbox'
+    __pydantic_model__ = OutboxMessage
+
+    payload = Column(String, nullable=False)  # SendMessageInput json
+    status = Column(String, nullable=False, default=OutboxStatus.PENDING.value)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(
+        DateTime(timezone=True), nullable=False, server_default=func.now()  # pylint: disable=not-callable
+    )
+    last_error = Column(String, nullable=True)
+    report = Column(String, nullable=True)  # SendMessageReport json, 重试时只发送给其中失败的接收人
+
+    ix_message_outbox_status_next_attempt_at = Index(
+        'ix_message_outbox_status_next_attempt_at',
+        'status',
+        'next_attempt_at',
+    )
+    __table_args__ = (ix_message_outbox_status_next_attempt_at,)
+
+
+class DirectorySyncOrm(BaseOrm, IDMixIn, TimeMixIn):
+    """本地部署: 每个企业的通讯录同步进度, updated_at 同时作为 RUNNING 状态的租约心跳"""
+
+    __tablename__ = 'directory_sync'
+    __pydantic_model__ = DirectorySyncState
+
+    corp_id = Column(String, nullable=False)
+    status = Column(String, nullable=False, default=DirectorySyncStatus.RUNNING.value)
+    cursor = Column(String, nullable=True)  # 尚未写入的部门 ID 列表 json, 同步完成后清空
+    synced_users = Column(Integer, nullable=False, default=0)
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    last_error = Column(String, nullable=True)
+
+    uq_directory_sync_corp_id = UniqueConstraint(
+        'corp_id',
+        name='uq_directory_sync_corp_id',
+    )
+    __table_args__ = (uq_directory_sync_corp_id,)
+
+
+class EventInboxOrm(BaseOrm, IDMixIn, TimeMixIn):
+    """
+    钉钉事件回调的收件箱, 回调写入后立即返回, 由后台 worker 处理
+
+    领取时把 next_attempt_at 推迟一个租约时间, 处理成功后删除; 处理失败超过次数上限的事件保留为 FAILED。
+    order_key 相同的事件按 id 顺序处理, * 与所有带 order_key 的事件互斥
+    """
+
+    __tablename__ = 'event_inbox'
+    __pydantic_model__ = InboxEvent
+
+    event_type = Column(String, nullable=False)
+    payload = Column(String, nullable=False)  # 解密后的事件 json
+    status = Column(String, nullable=False, default=InboxStatus.PENDING.value)
+    attempts = Column(Integer, nullable=False, default=0)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False)
+    claim_id = Column(String, nullable=True)  # 最近一次领取的 worker 生成的随机值, 用于查询与更新领取到的事件
+    order_key = Column(String, nullable=True)  # 推送只涉及一个企业时为 corp_id, 涉及多个企业时为 *
+    last_error = Column(String, nullable=True)
+
+    ix_event_inbox_status_next_attempt_at = Index(
+        'ix_event_inbox_status_next_attempt_at',
+        'status',
+        'next_attempt_at',
+    )
+    ix_event_inbox_claim_id = Index('ix_event_inbox_claim_id', 'claim_id')
+    ix_event_inbox_order_key_status = Index('ix_event_inbox_order_key_status', 'order_key', 'status')
+    __table_args__ = (ix_event_inbox_status_next_attempt_at, ix_event_inbox_claim_id, ix_event_inbox_order_key_status)
+
+
+class SeenEventOrm(BaseOrm, IDMixIn, TimeMixIn):
+    """已处理的钉钉推送数据, 用于跳过钉钉重复推送的 bizData, 过期的记录定期清理"""
+
+    __tablename__ = 'seen_event'
+
+    event_key = Column(String, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+    uq_seen_event_event_key = UniqueConstraint(
+        'event_key',
+        name='uq_seen_event_event_key',
+    )
+    ix_seen_event_expires_at = Index('ix_seen_event_expires_at', 'expires_at')
+    __table_args__ = (uq_seen_event_event_key, ix_seen_event_expires_at)
+
+
+class CacheEventOrm(BaseOrm, IDMixIn, TimeMixIn):
+    """
+    云端部署的缓存变化日志, 同一台机器上的 gunicorn worker 按 id 顺序轮询, 超过保留时间的记录定期清理
+
+    使用 AUTOINCREMENT, 记录清理后 id 也不会被重新使用
+    """
+
+    __tablename__ = 'cache_event'
+
+    kind = Column(String, nullable=False)
+    key = Column(String, nullable=False)
+    value = Column(String, nullable=True)
+    origin = Column(String, nullable=False)
+
+    ix_cache_event_created_at = Index('ix_cache_event_created_at', 'created_at')
+    __table_args__ = (ix_cache_event_created_at, {'sqlite_autoincrement': True})
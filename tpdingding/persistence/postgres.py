@@ -1,25 +1,65 @@
+import asyncio
 import logging
+from datetime import datetime
+from datetime import timedelta
 from typing import Any
 from typing import Optional
-from urllib.parse import urljoin
 
 import httpx
-from httpx import AsyncClient
+import pendulum
+from sqlalchemy import and_
+from sqlalchemy import case
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import not_
+from sqlalchemy import or_
 from sqlalchemy import select
+from sqlalchemy import union
+from sqlalchemy import update
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.sql.functions import coalesce
 
 from settings import BASIC_AUTH
-from settings import settings
 from tpdingding.exception import DingDingException
+from tpdingding.exception import RetryableException
+from tpdingding.helper.cache import TTLCache
+from tpdingding.helper.http import HttpClients
+from tpdingding.helper.retry import RETRY_POLICY
+from tpdingding.helper.retry import RetryPolicy
+from tpdingding.helper.retry import check_response
+from tpdingding.helper.retry import retry
 from tpdingding.helper.session import POSTGRES_ENGINE
 from tpdingding.helper.session import PGSessionMaker
+from tpdingding.helper.session import PostgresSession
+from tpdingding.model.cache import CacheEvent
+from tpdingding.model.cache import CacheKind
+from tpdingding.model.directory import DirectorySyncState
+from tpdingding.model.directory import DirectorySyncStatus
 from tpdingding.model.entity import CorpAuth
+from tpdingding.model.entity import CorpId
 from tpdingding.model.entity import DingDingId
 from tpdingding.model.entity import DingDingUser
+from tpdingding.model.entity import SendMessageInput
+from tpdingding.model.entity import StaffId
 from tpdingding.model.entity import Suite
+from tpdingding.model.entity import TenantId
+from tpdingding.model.outbox import OutboxEntry
+from tpdingding.model.outbox import OutboxMessage
+from tpdingding.model.outbox import OutboxStatus
 from tpdingding.persistence.abstract import Repository
 from tpdingding.persistence.model.orm import BaseOrm
+from tpdingding.persistence.model.orm import CorpAuthOrm
 from tpdingding.persistence.model.orm import DingDingUserOrm
+from tpdingding.persistence.model.orm import DirectorySyncOrm
+from tpdingding.persistence.model.orm import MessageOutboxOrm
+from tpdingding.persistence.model.orm import SuiteOrm
+
+
+def _cloud_unavailable(err: Exception) -> bool:
+    """连接错误, 超时, 5xx 与限流时云端不可用, 可以使用本地副本; 云端明确返回的错误不使用"""
+    if isinstance(err, (RetryableException, httpx.TransportError)):
+        return True
+    return isinstance(err.__cause__, asyncio.TimeoutError)  # retry 超过截止时间
 
 
 class PostgresRepository(Repository):
@@ -27,8 +67,23 @@ class PostgresRepository(Repository):
     部署在本地，用 Postgres 作为持久化存储, 存储用户信息
     """
 
-    def __init__(self, maker: PGSessionMaker):
+    def __init__(
+        self,
+        maker: PGSessionMaker,
+        http: HttpClients,
+        retry_policy: RetryPolicy = RETRY_POLICY,
+        cache_ttl: float = 0,
+        cache_stale_ttl: float = 0,
+        persist_cache: bool = False,
+        upsert_chunk_size: int = 1000,
+    ):
         self.session_maker = maker
+        self.http = http
+        self.retry_policy = retry_policy
+        self.persist_cache = persist_cache
+        self.upsert_chunk_size = upsert_chunk_size
+        self._suites: TTLCache[Optional[Suite]] = TTLCache('suite', cache_ttl, cache_stale_ttl)
+        self._corp_auths: TTLCache[Optional[CorpAuth]] = TTLCache('corp_auth', cache_ttl, cache_stale_ttl)
 
     @classmethod
     async def create_all(cls):
@@ -41,61 +96,378 @@ class PostgresRepository(Repository):
         data = result.scalars().all()
         return [DingDingUser.from_orm(d) for d in data]
 
+    async def of_staff_ids(self, tenant_id: TenantId, staff_ids: list[StaffId]) -> list[DingDingUser]:
+        """按 updated_at 排序, 同一个 staff 有多行时最近绑定的在最后"""
+        stmt = (
+            select(DingDingUserOrm)
+            .where(
+                DingDingUserOrm.tenant_id == tenant_id,
+                DingDingUserOrm.staff_id.in_(staff_ids),
+            )
+            .order_by(DingDingUserOrm.updated_at, DingDingUserOrm.id)
+        )
+        result = await self.session_maker().execute(stmt)
+        return [DingDingUser.from_orm(d) for d in result.scalars().all()]
+
     async def save_user(self, auth_code: str, user: DingDingUser) -> bool:
+        """保存用户授权回调的用户, staff 重新绑定时在同一个事务中解除该 staff 与其他钉钉用户的绑定"""
         logging.info("save_user of auth_code: %s", auth_code)
+        session = self.session_maker()
+        if user.staff_id and user.tenant_id:
+            stmt = (
+                update(DingDingUserOrm)
+                .where(
+                    DingDingUserOrm.tenant_id == user.tenant_id,
+                    DingDingUserOrm.staff_id == user.staff_id,
+                    not_(and_(DingDingUserOrm.corp_id == user.corp_id, DingDingUserOrm.user_id == user.user_id)),
+                )
+                .values(staff_id=None, tenant_id=None, updated_at=func.now())  # pylint: disable=not-callable
+                .execution_options(synchronize_session=False)
+            )
+            await session.execute(stmt)
+
         stmt = (
             insert(DingDingUserOrm)
             .values(user.dict(exclude_unset=True))
             .on_conflict_do_update(
                 constraint=DingDingUserOrm.uq_dingding_user_corp_id_user_id,
-                set_=user.dict(exclude_unset=True),
+                set_={**user.dict(exclude_unset=True), 'updated_at': func.now()},  # pylint: disable=not-callable
             )
         )
-        await self.session_maker().execute(stmt)
+        await session.execute(stmt)
 
         return True
 
-    # ==================== 以下方法 PostgresRepository 向云端数据库获取 ====================
-    async def get_org_suite_auth_info(self, corp_id: str) -> Optional[CorpAuth]:
-        async with AsyncClient() as client:
-            response = await client.get(
-                url=urljoin(
-                    settings.dingding_cloud_host,
-                    f"/dingding/internal/corp/{corp_id}",
+    async def save_users(self, users: list[DingDingUser]) -> int:
+        """
+        批量写入用户, 每 upsert_chunk_size 个用户一条多行 INSERT ... ON CONFLICT
+
+        所有行使用相同的列, 没有 user_id 的用户会被跳过;
+        staff_id / tenant_id 为空时保留已有的 IAM 绑定信息, open_id 为空时保留已有的值 (通讯录接口不返回 open_id);
+        内容没有变化的行不更新, updated_at 即用户信息最近一次变化的时间。返回写入的用户数
+        """
+        rows = {}  # 同一条语句中不能更新同一行两次, 按 (corp_id, user_id) 去重, 保留最后一个
+        for user in users:
+            if not user.user_id:
+                logging.warning("用户 %s 没有 user_id, 跳过", user.union_id)
+                continue
+            rows[(user.corp_id, user.user_id)] = user.dict()
+        rows = list(rows.values())
+
+        session = self.session_maker()
+        for i in range(0, len(rows), self.upsert_chunk_size):
+            stmt = insert(DingDingUserOrm).values(rows[i : i + self.upsert_chunk_size])
+            changes = {
+                'nick': stmt.excluded.nick,
+                'open_id': coalesce(func.nullif(stmt.excluded.open_id, ''), DingDingUserOrm.open_id),
+                'union_id': stmt.excluded.union_id,
+                'email': stmt.excluded.email,
+                'avatar_url': stmt.excluded.avatar_url,
+                'mobile': stmt.excluded.mobile,
+                'staff_id': coalesce(stmt.excluded.staff_id, DingDingUserOrm.staff_id),
+                'tenant_id': coalesce(stmt.excluded.tenant_id, DingDingUserOrm.tenant_id),
+            }
+            stmt = stmt.on_conflict_do_update(
+                constraint=DingDingUserOrm.uq_dingding_user_corp_id_user_id,
+                set_={**changes, 'updated_at': func.now()},  # pylint: disable=not-callable
+                where=or_(*(getattr(DingDingUserOrm, key).is_distinct_from(value) for key, value in changes.items())),
+            )
+            await session.execute(stmt)
+        logging.info("批量写入用户 %s 个, 跳过 %s 个", len(rows), len(users) - len(rows))
+        return len(rows)
+
+    # ==================== 消息发件箱 outbox, 仅本地部署使用 ====================
+    async def enqueue_message(self, message: SendMessageInput) -> int:
+        stmt = (
+            insert(MessageOutboxOrm)
+            .values(payload=message.json(), status=OutboxStatus.PENDING.value, attempts=0)
+            .returning(MessageOutboxOrm.id)
+        )
+        result = await self.session_maker().execute(stmt)
+        return result.scalar_one()
+
+    async def get_outbox_message(self, message_id: int) -> Optional[OutboxMessage]:
+        stmt = select(MessageOutboxOrm).where(MessageOutboxOrm.id == message_id)
+        result = await self.session_maker().execute(stmt)
+        data = result.scalar_one_or_none()
+        return OutboxMessage.from_orm(data) if data else None
+
+    async def claim_outbox_message(self, lease: float) -> Optional[OutboxEntry]:
+        """
+        领取一条到期的待发送消息: 标记为 RUNNING, 把 next_attempt_at 推迟 lease 秒作为租约并增加 attempts
+
+        领取在单独的短事务中提交, 发送时不持有行锁和事务; 多个 worker 通过 FOR UPDATE SKIP LOCKED 互斥。
+        worker 崩溃时消息仍为 RUNNING, 租约到期后会被重新领取 (至少一次)
+        """
+        next_id = (
+            select(MessageOutboxOrm.id)
+            .where(
+                MessageOutboxOrm.status.in_((OutboxStatus.PENDING.value, OutboxStatus.RUNNING.value)),
+                MessageOutboxOrm.next_attempt_at <= func.now(),  # pylint: disable=not-callable
+            )
+            .order_by(MessageOutboxOrm.next_attempt_at)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+            .scalar_subquery()
+        )
+        stmt = (
+            update(MessageOutboxOrm)
+            .where(MessageOutboxOrm.id == next_id)
+            .values(
+                status=OutboxStatus.RUNNING.value,
+                attempts=MessageOutboxOrm.attempts + 1,
+                next_attempt_at=func.now() + timedelta(seconds=lease),  # pylint: disable=not-callable
+                updated_at=func.now(),  # pylint: disable=not-callable
+            )
+            .returning(MessageOutboxOrm)
+            .execution_options(synchronize_session=False)
+        )
+        result = await self.session_maker().execute(stmt)
+        data = result.scalar_one_or_none()
+        return OutboxEntry.from_orm(data) if data else None
+
+    async def update_outbox_message(
+        self,
+        message_id: int,
+        attempts: int,
+        status: OutboxStatus,
+        last_error: Optional[str] = None,
+        next_attempt_at: Optional[datetime] = None,
+        report: Optional[str] = None,
+    ) -> bool:
+        """
+        记录第 attempts 次领取的发送结果
+
+        租约到期后消息被其他 worker 重新领取时 attempts 已经变化, 不覆盖新的领取, 返回 False
+        """
+        values = {
+            'status': status.value,
+            'last_error': last_error,
+            'updated_at': pendulum.now(),
+        }
+        if next_attempt_at is not None:
+            values['next_attempt_at'] = next_attempt_at
+        if report is not None:
+            values['report'] = report
+        stmt = (
+            update(MessageOutboxOrm)
+            .where(
+                MessageOutboxOrm.id == message_id,
+                MessageOutboxOrm.status == OutboxStatus.RUNNING.value,
+                MessageOutboxOrm.attempts == attempts,
+            )
+            .values(values)
+            .execution_options(synchronize_session=False)
+        )
+        result = await self.session_maker().execute(stmt)
+        return result.rowcount == 1
+
+    # ==================== 通讯录同步进度 directory_sync, 仅本地部署使用 ====================
+    async def list_directory_corp_ids(self) -> list[CorpId]:
+        """本地已知的企业: 企业授权信息的本地副本, 已有用户的企业以及同步过的企业"""
+        stmt = union(
+            select(CorpAuthOrm.corp_id),
+            select(DingDingUserOrm.corp_id),
+            select(DirectorySyncOrm.corp_id),
+        )
+        result = await self.session_maker().execute(stmt)
+        return [CorpId(corp_id) for corp_id in result.scalars().all()]
+
+    async def list_directory_syncs(self) -> list[DirectorySyncState]:
+        stmt = select(DirectorySyncOrm).order_by(DirectorySyncOrm.corp_id)
+        result = await self.session_maker().execute(stmt)
+        return [DirectorySyncState.from_orm(d) for d in result.scalars().all()]
+
+    async def claim_directory_sync(
+        self, corp_id: CorpId, lease: float, interval: Optional[float] = None
+    ) -> Optional[DirectorySyncState]:
+        """
+        把企业的同步进度标记为 RUNNING 并返回
+
+        其他 worker 正在同步 (lease 秒内有进度), 或者距离上次同步完成不足 interval 秒时返回 None;
+        上次同步没有完成时保留 cursor 与已写入的用户数, 从尚未写入的部门继续
+        """
+        now = pendulum.now()
+        skip = and_(
+            DirectorySyncOrm.status == DirectorySyncStatus.RUNNING.value,
+            DirectorySyncOrm.updated_at > now - timedelta(seconds=lease),
+        )
+        if interval is not None:
+            skip = or_(
+                skip,
+                and_(
+                    DirectorySyncOrm.status == DirectorySyncStatus.SUCCEEDED.value,
+                    DirectorySyncOrm.finished_at > now - timedelta(seconds=interval),
                 ),
-                auth=BASIC_AUTH,
             )
-            if response.status_code != httpx.codes.OK:
-                raise DingDingException(f"获取企业授权信息失败: {response.text}")
-            return CorpAuth(**response.json())
+        stmt = (
+            insert(DirectorySyncOrm)
+            .values(
+                corp_id=corp_id,
+                status=DirectorySyncStatus.RUNNING.value,
+                synced_users=0,
+                started_at=now,
+                updated_at=now,
+            )
+            .on_conflict_do_update(
+                constraint=DirectorySyncOrm.uq_directory_sync_corp_id,
+                set_={
+                    'status': DirectorySyncStatus.RUNNING.value,
+                    'synced_users': case((DirectorySyncOrm.cursor.is_(None), 0), else_=DirectorySyncOrm.synced_users),
+                    'started_at': now,
+                    'last_error': None,
+                    'updated_at': now,
+                },
+                where=not_(skip),
+            )
+            .returning(*DirectorySyncOrm.__table__.columns)
+        )
+        result = await self.session_maker().execute(stmt)
+        data = result.one_or_none()
+        return DirectorySyncState.from_orm(data) if data else None
+
+    async def save_directory_sync(
+        self,
+        corp_id: CorpId,
+        status: DirectorySyncStatus,
+        cursor: Optional[str],
+        synced_users: int,
+        last_error: Optional[str] = None,
+    ) -> bool:
+        now = pendulum.now()
+        values = {
+            'status': status.value,
+            'cursor': cursor,
+            'synced_users': synced_users,
+            'last_error': last_error,
+            'updated_at': now,
+        }
+        if status == DirectorySyncStatus.SUCCEEDED:
+            values['finished_at'] = now
+        stmt = update(DirectorySyncOrm).where(DirectorySyncOrm.corp_id == corp_id).values(values)
+        await self.session_maker().execute(stmt)
+        return True
+
+    # ==================== 以下方法 PostgresRepository 向云端数据库获取 ====================
+    # 套件与企业授权信息缓存在本地, 云端通过 /dingding/local/cache/invalidate 通知失效, 再由 cache_bus 同步到所有 worker
+    async def get_org_suite_auth_info(self, corp_id: str) -> Optional[CorpAuth]:
+        return await self._corp_auths.get(corp_id, lambda: self._load_corp_auth(corp_id))
 
     async def get_suite(self, suite_key: str) -> Optional[Suite]:
-        async with AsyncClient() as client:
-            response = await client.get(
-                url=urljoin(
-                    settings.dingding_cloud_host,
-                    f"/dingding/internal/suite/{suite_key}",
-                ),
-                auth=BASIC_AUTH,
+        return await self._suites.get(suite_key, lambda: self._load_suite(suite_key))
+
+    def invalidate_cache(self, kind: CacheKind, key: str) -> None:
+        logging.info("本地缓存失效 %s: %s", kind, key)
+        cache = self._suites if kind == CacheKind.SUITE else self._corp_auths
+        cache.invalidate(key)
+
+    def apply_cache_event(self, event: Optional[CacheEvent]) -> None:
+        """其他 worker 收到云端的失效通知后, 通过 cache_bus 同步到本 worker"""
+        if event is None:
+            self._suites.clear()
+            self._corp_auths.clear()
+        elif event.kind in (CacheKind.SUITE, CacheKind.CORP_AUTH):
+            self.invalidate_cache(event.kind, event.key)
+
+    def cache_metrics(self) -> dict[str, Any]:
+        return {'suite': self._suites.report(), 'corp_auth': self._corp_auths.report()}
+
+    async def _load_corp_auth(self, corp_id: str) -> Optional[CorpAuth]:
+        try:
+            data = await self._get_cloud(f"/dingding/internal/corp/{corp_id}", "获取企业授权信息失败")
+        except (DingDingException, httpx.TransportError) as err:
+            stmt = select(CorpAuthOrm).where(CorpAuthOrm.corp_id == corp_id)
+            if not _cloud_unavailable(err) or (corp_auth := await self._read_local(stmt, CorpAuth)) is None:
+                raise
+            logging.warning("云端获取企业 %s 授权信息失败, 使用本地副本", corp_id)
+            return corp_auth
+
+        if data is None:
+            # 企业已解除授权或不存在, 本地副本同时删除
+            if self.persist_cache:
+                await self._write_local(delete(CorpAuthOrm).where(CorpAuthOrm.corp_id == corp_id))
+            return None
+
+        corp_auth = CorpAuth(**data)
+        if self.persist_cache:
+            await self._write_local(
+                insert(CorpAuthOrm)
+                .values(corp_id=corp_auth.corp_id, permanent_code=corp_auth.permanent_code, raw=corp_auth.raw)
+                .on_conflict_do_update(
+                    constraint=CorpAuthOrm.uq_corp_auth_corp_id,
+                    set_={
+                        'permanent_code': corp_auth.permanent_code,
+                        'raw': corp_auth.raw,
+                        'updated_at': pendulum.now(),
+                    },
+                )
             )
-            if response.status_code != httpx.codes.OK:
-                raise DingDingException(f"获取套件信息失败: {response.text}")
-            return Suite(**response.json())
+        return corp_auth
 
-    async def get_user_by_auth_code(self, auth_code: str) -> DingDingUser:
-        async with AsyncClient() as client:
-            response = await client.get(
-                url=urljoin(
-                    settings.dingding_cloud_host,
-                    f'/dingding/internal/user/{auth_code}',
-                ),
-                auth=BASIC_AUTH,
+    async def _load_suite(self, suite_key: str) -> Optional[Suite]:
+        try:
+            data = await self._get_cloud(f"/dingding/internal/suite/{suite_key}", "获取套件信息失败")
+        except (DingDingException, httpx.TransportError) as err:
+            stmt = select(SuiteOrm).where(SuiteOrm.suite_key == suite_key)
+            if not _cloud_unavailable(err) or (suite := await self._read_local(stmt, Suite)) is None:
+                raise
+            logging.warning("云端获取套件 %s 信息失败, 使用本地副本", suite_key)
+            return suite
+
+        if data is None:
+            if self.persist_cache:
+                await self._write_local(delete(SuiteOrm).where(SuiteOrm.suite_key == suite_key))
+            return None
+
+        suite = Suite(**data)
+        if self.persist_cache:
+            await self._write_local(
+                insert(SuiteOrm)
+                .values(corp_id=suite.corp_id, suite_key=suite.suite_key, suite_ticket=suite.suite_ticket)
+                .on_conflict_do_update(
+                    constraint=SuiteOrm.uq_suite_ticket_corp_id,
+                    set_={
+                        'suite_key': suite.suite_key,
+                        'suite_ticket': suite.suite_ticket,
+                        'updated_at': pendulum.now(),
+                    },
+                )
             )
-            if response.status_code != httpx.codes.OK:
-                raise DingDingException(f"获取用户信息失败: {response.text}")
-            if not response.json():
-                raise DingDingException(f"获取用户信息失败: 未找到用户信息 {auth_code}")
-            return DingDingUser(**response.json())
+        return suite
+
+    # 缓存可能在后台刷新, 此时请求的 session 可能已经关闭, 所以本地副本使用独立的 session
+    async def _read_local(self, stmt: Any, model: Any) -> Any:
+        if not self.persist_cache:
+            return None
+        async with PostgresSession() as session:
+            data = (await session.execute(stmt)).scalars().first()
+            return model.from_orm(data) if data else None
+
+    @classmethod
+    async def _write_local(cls, stmt: Any) -> None:
+        try:
+            async with PostgresSession() as session, session.begin():
+                await session.execute(stmt)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            logging.warning("保存云端信息的本地副本失败: %s", err)
+
+    async def get_user_by_auth_code(self, auth_code: str) -> DingDingUser:
+        # auth_code 只能被消费一次, 不做重试
+        response = await self.http.cloud.get(f'/dingding/internal/user/{auth_code}', auth=BASIC_AUTH)
+        if response.status_code != httpx.codes.OK:
+            raise DingDingException(f"获取用户信息失败: {response.text}")
+        if not response.json():
+            raise DingDingException(f"获取用户信息失败: 未找到用户信息 {auth_code}")
+        return DingDingUser(**response.json())
+
+    async def _get_cloud(self, path: str, message: str) -> Any:
+        async def _get() -> Any:
+            response = await self.http.cloud.get(path, auth=BASIC_AUTH)
+            if response.status_code == httpx.codes.NOT_FOUND:
+                return None
+            return check_response(response, message)
+
+        return await retry(_get, self.retry_policy, path)
 
     # ==================== 以下方法 PostgresRepository 不应该支持，数据在云端 ====================
 
@@ -107,3 +479,9 @@ class PostgresRepository(Repository):
 
     async def relieve_org_suite_auth_info(self, corp_id: str) -> bool:
         raise NotImplementedError(f"{type(self).__name__} 不支持解除企业授权 relieve_org_suite_auth_info 方法")
+
+    async def save_org_suite_auth_infos(self, data: dict[str, dict[str, Any]]) -> bool:
+        raise NotImplementedError(f"{type(self).__name__} 不支持保存企业授权信息 save_org_suite_auth_infos 方法")
+
+    async def relieve_org_suite_auth_infos(self, corp_ids: list[str]) -> bool:
+        raise NotImplementedError(f"{type(self).__name__} 不支持解除企业授权 relieve_org_suite_auth_infos 方法")
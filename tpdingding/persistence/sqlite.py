@@ -1,7 +1,5 @@
 import json
-import logging
 from typing import Any
-from typing import Dict
 from typing import Optional
 
 import pendulum
@@ -16,93 +14,107 @@ from tpdingding.model.entity import CorpId
 from tpdingding.model.entity import DingDingUser
 from tpdingding.model.entity import Suite
 from tpdingding.persistence.abstract import Repository
+from tpdingding.persistence.auth_code import AuthCodeMixIn
+from tpdingding.persistence.cache_event import CacheEventMixIn
+from tpdingding.persistence.dedup import SeenEventMixIn
+from tpdingding.persistence.inbox import EventInboxMixIn
 from tpdingding.persistence.model.orm import BaseOrm
 from tpdingding.persistence.model.orm import CorpAuthOrm
 from tpdingding.persistence.model.orm import SuiteOrm
 
 
-class SQLiteRepository(Repository):
+class SQLiteRepository(AuthCodeMixIn, EventInboxMixIn, SeenEventMixIn, CacheEventMixIn, Repository):
     """
     部署在云端，用 SqlLite 作为持久化存储
-    存储 Suite 信息, 存储 CorpAuth 信息，存储用户信息（内存暂存）
+    存储 Suite 信息, 存储 CorpAuth 信息，暂存 auth_code 对应的用户信息与待处理的事件回调
     """
 
-    def __init__(self, maker: SQLiteSessionMaker):
+    def __init__(self, maker: SQLiteSessionMaker, auth_code_ttl: float = 300, auth_code_max_entries: int = 10000):
         self.session_maker = maker
-        self.cache: Dict[str, DingDingUser] = {}
+        self.auth_code_ttl = auth_code_ttl
+        self.auth_code_max_entries = auth_code_max_entries
 
     @classmethod
     async def create_all(cls):
-        with SQLITE_ENGINE.begin() as conn:
-            BaseOrm.metadata.create_all(conn)
+        async with SQLITE_ENGINE.begin() as conn:
+            await conn.run_sync(BaseOrm.metadata.create_all)
 
     async def save_org_suite_auth_info(self, corp_id: str, data: dict[str, Any]) -> bool:
-        stmt = (
-            insert(CorpAuthOrm)
-            .values(
-                corp_id=corp_id,
-                permanent_code=data['permanent_code'],
-                raw=json.dumps(data, ensure_ascii=False),
-            )
-            .on_conflict_do_update(
-                index_elements=[CorpAuthOrm.corp_id],
-                set_={
-                    'raw': json.dumps(data, ensure_ascii=False),
-                    'permanent_code': data['permanent_code'],
-                    'updated_at': pendulum.now(),
-                },
-            )
+        return await self.save_org_suite_auth_infos({corp_id: data})
+
+    async def relieve_org_suite_auth_info(self, corp_id: CorpId) -> bool:
+        return await self.relieve_org_suite_auth_infos([corp_id])
+
+    async def save_org_suite_auth_infos(self, data: dict[str, dict[str, Any]]) -> bool:
+        stmt = insert(CorpAuthOrm).values(
+            [
+                {
+                    'corp_id': corp_id,
+                    'permanent_code': auth['permanent_code'],
+                    'raw': json.dumps(auth, ensure_ascii=False),
+                }
+                for corp_id, auth in data.items()
+            ]
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[CorpAuthOrm.corp_id],
+            set_={
+                'raw': stmt.excluded.raw,
+                'permanent_code': stmt.excluded.permanent_code,
+                'updated_at': pendulum.now(),
+            },
         )
-        self.session_maker().execute(stmt)
+        await self.session_maker().execute(stmt)
         return True
 
-    async def relieve_org_suite_auth_info(self, corp_id: CorpId) -> bool:
-        stmt = delete(CorpAuthOrm).where(CorpAuthOrm.corp_id == corp_id)
-        self.session_maker().execute(stmt)
+    async def relieve_org_suite_auth_infos(self, corp_ids: list[str]) -> bool:
+        stmt = delete(CorpAuthOrm).where(CorpAuthOrm.corp_id.in_(corp_ids))
+        await self.session_maker().execute(stmt)
         return True
 
     async def get_org_suite_auth_info(self, corp_id: CorpId) -> Optional[CorpAuth]:
         stmt = select(CorpAuthOrm).where(CorpAuthOrm.corp_id == corp_id)
-        result = self.session_maker().execute(stmt)
+        result = await self.session_maker().execute(stmt)
         data = result.scalar_one_or_none()
         return CorpAuth.from_orm(data) if data else None
 
     async def save_suite_ticket(self, suite: Suite) -> bool:
-        stmt = (
-            insert(SuiteOrm)
-            .values(
-                suite_ticket=suite.suite_ticket,
-                corp_id=suite.corp_id,
-                suite_key=suite.suite_key,
-            )
-            .on_conflict_do_update(
-                index_elements=[SuiteOrm.corp_id],
-                set_={
-                    'suite_ticket': suite.suite_ticket,
-                    'updated_at': pendulum.now(),
-                },
-            )
+        stmt = insert(SuiteOrm).values(
+            suite_ticket=suite.suite_ticket,
+            corp_id=suite.corp_id,
+            suite_key=suite.suite_key,
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[SuiteOrm.corp_id],
+            set_={
+                'suite_ticket': stmt.excluded.suite_ticket,
+                'updated_at': pendulum.now(),
+            },
+            # ticket 没有变化时不改写 updated_at
+            where=SuiteOrm.suite_ticket != stmt.excluded.suite_ticket,
         )
-        self.session_maker().execute(stmt)
+        await self.session_maker().execute(stmt)
         return True
 
     async def get_suite(self, suite_key: str) -> Optional[Suite]:
         stmt = select(SuiteOrm).where(SuiteOrm.suite_key == suite_key)
-        result = self.session_maker().execute(stmt)
+        result = await self.session_maker().execute(stmt)
         data = result.scalar_one_or_none()
         return Suite.from_orm(data) if data else None
 
     async def save_user(self, auth_code: str, user: DingDingUser) -> bool:
-        self.cache[auth_code] = user
+        await self.save_auth_code(auth_code, user)
         return True
 
     async def get_user_by_auth_code(self, auth_code: str) -> DingDingUser:
-        if auth_code not in self.cache:
-            raise ValueError(f"auth_code {auth_code} 不存在")
-        user = self.cache.pop(auth_code)
-        logging.warning("AuthCode %s 对应的用户信息已经被消费，不可重复使用", auth_code)
-        return user
+        return await self.consume_auth_code(auth_code)
 
     # ==================== 以下方法 SQLiteRepository 不支持 ====================
     async def of_user_ids(self, user_ids: list[str]) -> list[DingDingUser]:
         raise NotImplementedError(f"{type(self).__name__} 不支持 of_user_ids 方法")
+
+    async def of_staff_ids(self, tenant_id: str, staff_ids: list[str]) -> list[DingDingUser]:
+        raise NotImplementedError(f"{type(self).__name__} 不支持 of_staff_ids 方法")
+
+    async def save_users(self, users: list[DingDingUser]) -> int:
+        raise NotImplementedError(f"{type(self).__name__} 不支持 save_users 方法")
@@ -1,6 +1,7 @@
 """用于钉钉回调的 云端Router"""
 import json
 import logging
+from functools import lru_cache
 from typing import Optional
 
 import httpx
@@ -16,17 +17,35 @@ from tpdingding.exception import DingDingException
 from tpdingding.handler.handle import handle_event
 from tpdingding.helper.dependencies import get_context
 from tpdingding.helper.dependencies import login
+from tpdingding.helper.dependencies import read_only_session
+from tpdingding.helper.executor import BLOCKING_EXECUTOR
 from tpdingding.model.context import Context
+from tpdingding.model.entity import CloudBatchSendMessageInput
 from tpdingding.model.entity import CloudSendMessageInput
 from tpdingding.model.entity import CorpAuth
 from tpdingding.model.entity import CorpId
 from tpdingding.model.entity import DingDingUser
+from tpdingding.model.entity import SendMessageChunkResult
 from tpdingding.model.entity import Suite
 from tpdingding.model.event import EventSuccessReceived
+from tpdingding.model.event import EventType
+from tpdingding.persistence.inbox import EventInboxMixIn
 from tpdingding.persistence.sqlite import SQLiteRepository
 from tpdingding.router import router
 
 DOMAIN_DELIMITER = '::'
+# 钉钉校验回调地址时需要同步处理, 不经过收件箱
+INLINE_EVENT_TYPES = {EventType.CHECK_URL, EventType.CHECK_UPDATE_SUITE_URL}
+
+
+@lru_cache(maxsize=1)
+def callback_crypto() -> DingCallbackCrypto3:
+    """加解密实例只读, 所有回调共享, 避免每次回调重新解析 AES key"""
+    return DingCallbackCrypto3(
+        settings.dingding_token,
+        settings.dingding_aes_key,
+        settings.dingding_suit_key,
+    )
 
 
 @router.post('/dingding/event/pushed', summary='钉钉事件推送', tags=['钉钉事件回调'])
@@ -37,15 +56,29 @@ async def event_callback(
     nonce: str = Query(description="随机数"),
     ctx: Context = Depends(get_context),
 ) -> EventSuccessReceived:
-    data = await request.json()
-    dtc = DingCallbackCrypto3(
-        settings.dingding_token,
-        settings.dingding_aes_key,
-        settings.dingding_suit_key,
-    )
-    msg = dtc.get_decrypt_msg(msg_signature, timestamp, nonce, data['encrypt'])
-    await handle_event(ctx, json.loads(msg))
-    return EventSuccessReceived(**dtc.get_encrypted_map('success'))
+    """事件写入收件箱后立即返回 success, 由后台 worker 处理; 校验回调地址的事件直接处理"""
+    body = await request.body()
+    msg, event_type, order_key = await BLOCKING_EXECUTOR.run(_decrypt_event, body, msg_signature, timestamp, nonce)
+    if settings.inbox_enabled and event_type not in INLINE_EVENT_TYPES:
+        assert isinstance(ctx.repo, EventInboxMixIn), '收件箱需要 EventInboxMixIn'
+        await ctx.repo.enqueue_event(event_type, msg, order_key)
+    else:
+        await handle_event(ctx, json.loads(msg))
+    return EventSuccessReceived(**await BLOCKING_EXECUTOR.run(callback_crypto().get_encrypted_map, 'success'))
+
+
+def _decrypt_event(body: bytes, msg_signature: str, timestamp: str, nonce: str) -> tuple[str, str, Optional[str]]:
+    """
+    验签, 解密和 JSON 解析都是 CPU 密集任务, 在线程池中执行; 返回解密后的事件 json, 事件类型与收件箱的 order_key
+
+    order_key: bizData 只涉及一个企业时为该企业的 corp_id, 涉及多个企业时为 *, 没有 bizData 时为空
+    """
+    data = json.loads(body)
+    msg = callback_crypto().get_decrypt_msg(msg_signature, timestamp, nonce, data['encrypt'])
+    event = json.loads(msg)
+    corp_ids = {item['corp_id'] for item in event.get('bizData') or []}
+    order_key = None if not corp_ids else corp_ids.pop() if len(corp_ids) == 1 else '*'
+    return msg, event['EventType'].upper(), order_key
 
 
 @router.get(
@@ -86,6 +119,7 @@ async def get_user_by_auth_code(
 
 @router.get(
     '/dingding/internal/corp/{corp_id}',
+    dependencies=[Depends(read_only_session)],
     summary='获取企业信息',
     tags=['内部调用接口'],
     response_model=Optional[CorpAuth],
@@ -100,6 +134,7 @@ async def get_corp_info(
 
 @router.get(
     '/dingding/internal/suite/{suite_key}',
+    dependencies=[Depends(read_only_session)],
     summary='获取套件信息',
     tags=["内部调用接口"],
     response_model=Optional[Suite],
@@ -121,3 +156,17 @@ async def cloud_send_messages(
 ) -> Response:
     await ctx.dingding_srv.send_message(message.user_ids, message.message, message.corp_id)
     return Response(status_code=httpx.codes.OK, content='success')
+
+
+@router.post(
+    '/dingding/internal/send/messages:batch',
+    summary='批量发送钉钉消息',
+    tags=['内部调用接口'],
+    response_model=list[SendMessageChunkResult],
+)
+async def cloud_send_messages_batch(
+    message: CloudBatchSendMessageInput,
+    ctx: Context = Depends(get_context),
+    _: str = Depends(login),
+) -> list[SendMessageChunkResult]:
+    return await ctx.dingding_srv.send_messages_batch(message.jobs)
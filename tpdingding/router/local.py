@@ -1,26 +1,32 @@
 """执行处理在内网服务器上的 Router"""
-
-import json
-import logging
-from urllib.parse import urljoin
+from typing import Union
 
 import httpx
-import pendulum
 from fastapi import Depends
+from fastapi import HTTPException
 from fastapi import Query
 from fastapi import Request
 from fastapi import Response
 
-from settings import BASIC_AUTH
-from settings import settings
-from tpdingding.exception import DingDingException
 from tpdingding.helper.dependencies import get_context
+from tpdingding.helper.dependencies import login
+from tpdingding.helper.dependencies import read_only_session
+from tpdingding.helper.session import after_commit
+from tpdingding.model.cache import CacheInvalidation
 from tpdingding.model.context import Context
-from tpdingding.model.entity import CloudSendMessageInput
+from tpdingding.model.directory import DirectorySyncAccepted
+from tpdingding.model.directory import DirectorySyncInput
+from tpdingding.model.directory import DirectorySyncState
+from tpdingding.model.entity import DeliveryStatus
+from tpdingding.model.entity import DingDingUserImportInput
+from tpdingding.model.entity import DingDingUserImportResult
 from tpdingding.model.entity import SendMessageInput
+from tpdingding.model.entity import SendMessageReport
 from tpdingding.model.entity import StaffId
 from tpdingding.model.entity import TenantId
 from tpdingding.model.iam import BindDingdingUserInput
+from tpdingding.model.outbox import OutboxAccepted
+from tpdingding.model.outbox import OutboxMessage
 from tpdingding.persistence.postgres import PostgresRepository
 from tpdingding.router import router
 
@@ -39,6 +45,11 @@ async def auth_user_callback(
     dingding_user.tenant_id = tenant_id
 
     await ctx.repo.save_user(auth_code, dingding_user)
+    # 提交之后再让各个 worker 的缓存失效, 避免其他 worker 在提交之前重新读到旧的绑定
+    after_commit(
+        ctx.repo.session_maker(),
+        lambda: ctx.staff_resolver.invalidate(tenant_id, staff_id, dingding_user.user_id),
+    )
     await ctx.iam_srv.bind_ding_user(
         BindDingdingUserInput(
             staff_id=staff_id,
@@ -51,58 +62,119 @@ async def auth_user_callback(
     return Response(status_code=httpx.codes.OK, content='success')
 
 
-@router.post('/dingding/local/send/messages', summary='发送钉钉消息', tags=['钉钉消息推送'])
+@router.post(
+    '/dingding/local/send/messages',
+    summary='发送钉钉消息',
+    tags=['钉钉消息推送'],
+    response_model=SendMessageReport,
+)
 async def send_messages(
     _: Request,
     message: SendMessageInput,
     ctx: Context = Depends(get_context),
-) -> Response:
+) -> Union[SendMessageReport, Response]:
+    """接收人可以分属多个钉钉企业, 返回每个接收人的发送结果; 没有任何接收人发送成功时返回 502"""
     assert isinstance(ctx.repo, PostgresRepository), '本地部署使用 PostgresRepository'
-    logging.info("尝试为租户为 %s 的 staff %s 发送消息", message.tenant_id, message.staff_ids)
-
-    # 获取用户
-    iam_registered_dingding_users = await ctx.iam_srv.list_dingding_users(message.staff_ids)
-    # logging.info("IAM 平台已注册的钉钉用户: %s", iam_registered_dingding_users)
-    user_ids_to_send, user_ids_missing = [], []
-    for staff_id in message.staff_ids:
-        if staff_id not in iam_registered_dingding_users:
-            user_ids_missing.append(staff_id)
-        else:
-            user_ids_to_send.append(iam_registered_dingding_users[staff_id].dingding_id)
-
-    if not user_ids_to_send:
-        logging.warning("没有找到任何用户")
+    if (report := await ctx.message_srv.send(message)) is None:
         return Response(status_code=httpx.codes.NOT_FOUND, content='没有找到任何用户')
+    if not report.of_status(DeliveryStatus.SENT):
+        return Response(status_code=httpx.codes.BAD_GATEWAY, content=report.json(), media_type='application/json')
+
+    return report
+
+
+@router.post(
+    '/dingding/local/send/messages:async',
+    summary='异步发送钉钉消息',
+    tags=['钉钉消息推送'],
+    status_code=httpx.codes.ACCEPTED,
+    response_model=OutboxAccepted,
+)
+async def send_messages_async(
+    message: SendMessageInput,
+    ctx: Context = Depends(get_context),
+) -> OutboxAccepted:
+    """消息写入发件箱后立即返回, 由后台 worker 发送"""
+    assert isinstance(ctx.repo, PostgresRepository), '本地部署使用 PostgresRepository'
+    return OutboxAccepted(id=await ctx.repo.enqueue_message(message))
 
-    if user_ids_missing:
-        logging.warning('尝试发送消息，未找到部分用户: %s ', user_ids_missing)
-
-    # 发送消息
-    local_dingding_users = await ctx.repo.of_user_ids(user_ids_to_send)  # 为了拿到 corp_id
-    # logging.info("本地已注册的钉钉用户: %s", local_dingding_users)
-    if not local_dingding_users:
-        raise DingDingException('没有找到 corp_id')
-
-    logging.info('Final: 尝试发送消息给 %s', user_ids_to_send)
-
-    # 钉钉消息模版使用 message 作为消息变量
-    # 钉钉消息模版使用 url 作为跳转地址
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            urljoin(settings.dingding_cloud_host, '/dingding/internal/send/messages'),
-            json=CloudSendMessageInput(
-                corp_id=local_dingding_users[0].corp_id,
-                user_ids=user_ids_to_send,
-                message=json.dumps(
-                    {
-                        'message': message.data + f'\n{pendulum.now().strftime("%Y-%m-%d %H:%M:%S")}',
-                        'url': message.url or settings.site_url,
-                    }
-                ),
-            ).dict(),
-            auth=BASIC_AUTH,
-        )
-        if response.status_code != httpx.codes.OK:
-            raise DingDingException(f"发送消息失败 {response.text}")
 
+@router.get(
+    '/dingding/local/send/messages/{message_id}',
+    dependencies=[Depends(read_only_session)],
+    summary='查询异步发送状态',
+    tags=['钉钉消息推送'],
+    response_model=OutboxMessage,
+)
+async def get_send_message_status(
+    message_id: int,
+    ctx: Context = Depends(get_context),
+) -> OutboxMessage:
+    assert isinstance(ctx.repo, PostgresRepository), '本地部署使用 PostgresRepository'
+    if (outbox_message := await ctx.repo.get_outbox_message(message_id)) is None:
+        raise HTTPException(status_code=httpx.codes.NOT_FOUND, detail=f'消息 {message_id} 不存在')
+    return outbox_message
+
+
+@router.post('/dingding/local/cache/invalidate', summary='云端通知缓存失效', tags=['内部调用接口'])
+async def invalidate_cache(
+    invalidation: CacheInvalidation,
+    ctx: Context = Depends(get_context),
+    _: str = Depends(login),
+) -> Response:
+    # 只有一个 worker 收到通知, 通过 cache_bus 让所有 worker 的缓存失效
+    ctx.cache_bus.publish(invalidation.kind, invalidation.key)
     return Response(status_code=httpx.codes.OK, content='success')
+
+
+@router.post(
+    '/dingding/local/users:import',
+    summary='批量导入钉钉用户',
+    tags=['内部调用接口'],
+    response_model=DingDingUserImportResult,
+)
+async def import_users(
+    data: DingDingUserImportInput,
+    ctx: Context = Depends(get_context),
+    _: str = Depends(login),
+) -> DingDingUserImportResult:
+    """整个企业接入时一次导入全部用户, 已存在的用户按 (corp_id, user_id) 更新"""
+    assert isinstance(ctx.repo, PostgresRepository), '本地部署使用 PostgresRepository'
+    imported = await ctx.repo.save_users(data.users)
+    if any(user.tenant_id and user.staff_id for user in data.users):
+        after_commit(ctx.repo.session_maker(), ctx.staff_resolver.invalidate_all)
+    return DingDingUserImportResult(imported=imported, skipped=len(data.users) - imported)
+
+
+@router.post(
+    '/dingding/local/directory:sync',
+    summary='同步钉钉通讯录',
+    tags=['内部调用接口'],
+    status_code=httpx.codes.ACCEPTED,
+    response_model=DirectorySyncAccepted,
+)
+async def sync_directory(
+    data: DirectorySyncInput,
+    ctx: Context = Depends(get_context),
+    _: str = Depends(login),
+) -> DirectorySyncAccepted:
+    """在后台从钉钉通讯录同步企业的全部用户, 上次同步未完成的企业从中断的部门继续"""
+    assert isinstance(ctx.repo, PostgresRepository), '本地部署使用 PostgresRepository'
+    corp_ids = data.corp_ids or await ctx.repo.list_directory_corp_ids()
+    ctx.directory_srv.start(corp_ids, data.force)
+    return DirectorySyncAccepted(corp_ids=corp_ids)
+
+
+@router.get(
+    '/dingding/local/directory/sync',
+    dependencies=[Depends(read_only_session)],
+    summary='查询通讯录同步进度',
+    tags=['内部调用接口'],
+    response_model=list[DirectorySyncState],
+)
+async def list_directory_syncs(
+    ctx: Context = Depends(get_context),
+    _: str = Depends(login),
+) -> list[DirectorySyncState]:
+    assert isinstance(ctx.repo, PostgresRepository), '本地部署使用 PostgresRepository'
+    return await ctx.repo.list_directory_syncs()
@@ -0,0 +1,33 @@
+"""运行指标, 云端与本地部署共用"""
+from typing import Any
+
+from fastapi import Depends
+
+from tpdingding.helper.dependencies import get_context
+from tpdingding.helper.dependencies import login
+from tpdingding.helper.executor import BLOCKING_EXECUTOR
+from tpdingding.helper.pool import pool_metrics
+from tpdingding.helper.session import POSTGRES_ENGINE
+from tpdingding.helper.session import SQLITE_ENGINE
+from tpdingding.model.context import Context
+from tpdingding.persistence.postgres import PostgresRepository
+from tpdingding.router import router
+
+
+@router.get('/dingding/internal/metrics', summary='运行指标', tags=['内部调用接口'])
+async def get_metrics(
+    ctx: Context = Depends(get_context),
+    _: str = Depends(login),
+) -> dict[str, Any]:
+    is_local = isinstance(ctx.repo, PostgresRepository)
+    return {
+        'db_pool': pool_metrics(POSTGRES_ENGINE if is_local else SQLITE_ENGINE),
+        'dingding': ctx.dingding_srv.metrics(),
+        'blocking_executor': BLOCKING_EXECUTOR.report(),
+        'staff_resolver': ctx.staff_resolver.report(),
+        'cloud_cache': ctx.repo.cache_metrics() if is_local else None,
+        'directory_sync': ctx.directory_srv.report() if is_local else None,
+        'event_dedup': ctx.event_dedup.report(),
+        'suite_ticket': ctx.suite_ticket_store.report(),
+        'cache_bus': ctx.cache_bus.report(),
+    }
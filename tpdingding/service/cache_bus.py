@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections.abc import Callable
+from contextvars import ContextVar
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Optional
+
+import asyncpg
+from sqlalchemy import func
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tpdingding.helper.session import SessionScope
+from tpdingding.helper.session import background_session
+from tpdingding.model.cache import CacheEvent
+from tpdingding.model.cache import CacheKind
+from tpdingding.persistence.cache_event import CacheEventMixIn
+
+# event 为 None 时表示可能丢失了事件 (断线, 日志被清理), 订阅者需要清空全部缓存
+CacheSubscriber = Callable[[Optional[CacheEvent]], None]
+
+
+@dataclass
+class CacheBusMetrics:
+    published: int = 0
+    received: int = 0
+    resets: int = 0
+    failures: int = 0
+
+
+class CacheBus:
+    """
+    进程内的缓存变化总线, 不在 worker 之间广播, 用于单 worker 部署或关闭 cache_bus_enabled 时
+
+    publish 先同步通知本进程的订阅者, 子类再在后台把事件发送给其他 worker
+    """
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self.metrics = CacheBusMetrics()
+        self._subscribers: list[CacheSubscriber] = []
+        self._tasks: set[asyncio.Task] = set()
+        self._lock: Optional[asyncio.Lock] = None  # 在事件循环中创建
+
+    def subscribe(self, subscriber: CacheSubscriber) -> None:
+        self._subscribers.append(subscriber)
+
+    def publish(self, kind: CacheKind, key: str, value: Optional[str] = None) -> None:
+        event = CacheEvent(kind=kind, key=key, value=value, origin=self.origin)
+        self._deliver(event)
+        task = asyncio.create_task(self._send(event))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def start(self) -> None:
+        ...
+
+    async def stop(self) -> None:
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'type': type(self).__name__}
+
+    async def _send(self, event: CacheEvent) -> None:
+        # 按发布顺序逐个发送, 同一个 key 先获取再失效时, 其他 worker 不会以相反的顺序收到
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        try:
+            async with self._lock:
+                await self._broadcast(event)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            self.metrics.failures += 1
+            logging.warning('广播缓存变化 %s: %s 失败: %s', event.kind, event.key, err)
+            return
+        self.metrics.published += 1
+
+    async def _broadcast(self, event: CacheEvent) -> None:
+        """把事件发送给其他 worker, 进程内的总线不需要发送"""
+
+    def _receive(self, event: Optional[CacheEvent]) -> None:
+        """收到其他 worker 发布的事件"""
+        if event is None:
+            self.metrics.resets += 1
+            logging.warning('缓存变化可能丢失, 清空全部缓存')
+        elif event.origin == self.origin:
+            return
+        else:
+            self.metrics.received += 1
+        self._deliver(event)
+
+    def _deliver(self, event: Optional[CacheEvent]) -> None:
+        for subscriber in self._subscribers:
+            try:
+                subscriber(event)
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('处理缓存变化失败: %s', event)
+
+
+class PostgresCacheBus(CacheBus):
+    """
+    本地部署通过 Postgres LISTEN/NOTIFY 广播, 每个 worker 使用一个单独的 asyncpg 连接 LISTEN
+
+    每 keepalive 秒检查一次连接, 断线重连后清空全部缓存。pgbouncer 事务模式下 LISTEN 不可用
+    """
+
+    def __init__(self, engine: AsyncEngine, channel: str, keepalive: float):
+        super().__init__()
+        self.engine = engine
+        self.channel = channel
+        self.keepalive = keepalive
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._listener = asyncio.create_task(self._listen(), name='cache-bus-listener')
+
+    async def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.cancel()
+            await asyncio.gather(self._listener, return_exceptions=True)
+            self._listener = None
+        await super().stop()
+
+    async def _broadcast(self, event: CacheEvent) -> None:
+        async with self.engine.connect() as conn:
+            await conn.execute(select(func.pg_notify(self.channel, event.json())))
+            await conn.commit()
+
+    async def _listen(self) -> None:
+        dsn = self.engine.url.set(drivername='postgresql').render_as_string(hide_password=False)
+        reconnect = False
+        while True:
+            try:
+                conn = await asyncpg.connect(dsn)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.warning('缓存变化总线连接 Postgres 失败: %s', err)
+                await asyncio.sleep(self.keepalive)
+                continue
+
+            try:
+                await conn.add_listener(self.channel, self._on_notify)
+                if reconnect:
+                    self._receive(None)
+                reconnect = True
+                while True:
+                    await asyncio.sleep(self.keepalive)
+                    await conn.execute('SELECT 1')
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.warning('缓存变化总线连接断开, 重新连接: %s', err)
+            finally:
+                conn.terminate()
+
+    def _on_notify(self, *args: Any) -> None:
+        # asyncpg 的回调参数为 (connection, pid, channel, payload)
+        self._receive(CacheEvent.parse_raw(args[-1]))
+
+
+class SQLiteCacheBus(CacheBus):
+    """
+    云端部署写入 sqlite 中的 cache_event 表, 每个 worker 每 poll_interval 秒读取新的记录
+
+    记录保留 retention 秒; worker 读取到的 id 不连续时, 说明中间的记录已经被清理, 清空全部缓存
+    """
+
+    def __init__(
+        self,
+        repo: CacheEventMixIn,
+        session: tuple[ContextVar[SessionScope], Callable[[], AsyncSession]],
+        poll_interval: float,
+        retention: float,
+        batch_size: int = 500,
+    ):
+        super().__init__()
+        self.repo = repo
+        self.session = session
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.batch_size = batch_size
+        self._last_id = 0
+        self._purged_at = time.monotonic()
+        self._poller: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        async with background_session(*self.session):
+            self._last_id = await self.repo.last_cache_event_id()
+        self._poller = asyncio.create_task(self._poll(), name='cache-bus-poller')
+
+    async def stop(self) -> None:
+        if self._poller is not None:
+            self._poller.cancel()
+            await asyncio.gather(self._poller, return_exceptions=True)
+            self._poller = None
+        await super().stop()
+
+    async def _broadcast(self, event: CacheEvent) -> None:
+        async with background_session(*self.session):
+            await self.repo.append_cache_event(event)
+
+    async def _poll(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self._read()
+                await self._purge()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('读取缓存变化失败')
+
+    async def _read(self) -> None:
+        while True:
+            async with background_session(*self.session):
+                events = await self.repo.list_cache_events(self._last_id, self.batch_size)
+            if not events:
+                return
+            if events[0][0] != self._last_id + 1:
+                self._receive(None)
+            for event_id, event in events:
+                self._last_id = event_id
+                self._receive(event)
+            if len(events) < self.batch_size:
+                return
+
+    async def _purge(self) -> None:
+        # 单独的事务, 清理是写操作, 不与读取放在同一个事务中
+        if time.monotonic() - self._purged_at < self.retention:
+            return
+        self._purged_at = time.monotonic()
+        async with background_session(*self.session):
+            purged = await self.repo.purge_cache_events(self.retention)
+        logging.info('清理过期的缓存变化 %s 条', purged)
@@ -0,0 +1,69 @@
+import hashlib
+import logging
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+
+from tpdingding.helper.cache import LRUCache
+from tpdingding.helper.session import after_commit
+from tpdingding.persistence.dedup import SeenEventMixIn
+
+
+@dataclass
+class DedupMetrics:
+    processed: int = 0
+    memory_hits: int = 0
+    db_hits: int = 0
+    purged: int = 0
+
+
+def event_key(biz_data: dict[str, Any]) -> str:
+    """同一条推送数据的 biz_type / corp_id / biz_id 相同, 内容变化时 biz_data 的摘要不同"""
+    digest = hashlib.blake2b(str(biz_data.get('biz_data', '')).encode(), digest_size=16).hexdigest()
+    return f"{biz_data.get('biz_type')}:{biz_data.get('corp_id')}:{biz_data.get('biz_id')}:{digest}"
+
+
+class EventDeduplicator:
+    """
+    跳过钉钉重复推送的 bizData
+
+    先查进程内 LRU, 未命中时在 seen_event 表中记录; 记录与处理结果在同一个事务中提交,
+    事务提交成功后才放入 LRU, 处理失败回滚时重试不会被误判为重复。过期的记录每 purge_interval 秒清理一次
+    """
+
+    def __init__(self, repo: SeenEventMixIn, ttl: float, maxsize: int, purge_interval: float):
+        self.repo = repo
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self.metrics = DedupMetrics()
+        self._recent: LRUCache[bool] = LRUCache(maxsize, ttl)
+        self._purged_at = time.monotonic()
+
+    async def first_seen(self, biz_data: dict[str, Any]) -> bool:
+        """第一次处理时返回 True, 重复推送时返回 False"""
+        key = event_key(biz_data)
+        if self._recent.get_many([key]):
+            self.metrics.memory_hits += 1
+            return False
+
+        await self._purge()
+        if not await self.repo.mark_event_seen(key, self.ttl):
+            self.metrics.db_hits += 1
+            self._recent.set_many({key: True})
+            return False
+
+        self.metrics.processed += 1
+        after_commit(self.repo.session_maker(), lambda: self._recent.set_many({key: True}))
+        return True
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'size': len(self._recent)}
+
+    async def _purge(self) -> None:
+        if time.monotonic() - self._purged_at < self.purge_interval:
+            return
+        self._purged_at = time.monotonic()
+        purged = await self.repo.purge_seen_events()
+        self.metrics.purged += purged
+        logging.info('清理过期的推送记录 %s 条', purged)
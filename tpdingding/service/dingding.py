@@ -1,11 +1,14 @@
+import asyncio
 import base64
 import hashlib
 import hmac
 import json
 import logging
+from collections.abc import Callable
+from contextvars import ContextVar
+from typing import Any
 from typing import Optional
 
-import httpx
 import pendulum
 from alibabacloud_dingtalk.contact_1_0 import models as dingtalkcontact__1__0_models
 from alibabacloud_dingtalk.contact_1_0.client import Client as dingtalkcontact_1_0Client
@@ -17,16 +20,31 @@ from alibabacloud_dingtalk.oauth2_1_0.models import GetUserTokenResponseBody
 from alibabacloud_tea_openapi import models as open_api_models
 from alibabacloud_tea_util import models as util_models
 from alibabacloud_tea_util.client import Client as UtilClient
-from httpx import AsyncClient
+from sqlalchemy.ext.asyncio import AsyncSession
 from Tea.exceptions import TeaException
 
 from settings import DeployMode
 from settings import settings
 from tpdingding.exception import DingDingException
+from tpdingding.helper.http import HttpClients
+from tpdingding.helper.ratelimit import RateLimitEndpoint
+from tpdingding.helper.ratelimit import RateLimiter
+from tpdingding.helper.retry import CONNECT_ERRORS
+from tpdingding.helper.retry import RETRY_POLICY
+from tpdingding.helper.retry import RetryPolicy
+from tpdingding.helper.retry import check_response
+from tpdingding.helper.retry import retry
+from tpdingding.helper.session import SessionScope
+from tpdingding.helper.session import background_session
+from tpdingding.model.cache import CacheEvent
+from tpdingding.model.cache import CacheKind
 from tpdingding.model.entity import AgentId
+from tpdingding.model.entity import CloudSendMessageInput
 from tpdingding.model.entity import CorpId
 from tpdingding.model.entity import DingDingUser
 from tpdingding.model.entity import DingDingUserInput
+from tpdingding.model.entity import OpenId
+from tpdingding.model.entity import SendMessageChunkResult
 from tpdingding.model.entity import Suite
 from tpdingding.model.entity import UnionId
 from tpdingding.model.entity import UserId
@@ -34,6 +52,8 @@ from tpdingding.model.event import GrantType
 from tpdingding.model.token import AccessToken
 from tpdingding.persistence.abstract import Repository
 from tpdingding.persistence.postgres import PostgresRepository
+from tpdingding.service.cache_bus import CacheBus
+from tpdingding.service.token import TokenManager
 
 
 class DingDingService:
@@ -41,39 +61,93 @@ class DingDingService:
     suite_secret: str
     repo: Repository
 
-    def __init__(
+    def __init__(  # pylint: disable=too-many-locals
         self,
         suite_key: str,
         suite_secret: str,
         repo: Repository,
+        session: tuple[ContextVar[SessionScope], Callable[[], AsyncSession]],
         corp_token_url: str,
         send_message_url: str,
         template_id: str,
+        http: HttpClients,
+        token_expiry_margin: int = 0,
+        token_refresh_ahead: int = 0,
+        max_users_per_message: int = 100,
+        corp_concurrency: int = 5,
+        rate_limiter: Optional[RateLimiter] = None,
+        retry_policy: RetryPolicy = RETRY_POLICY,
+        cache_bus: Optional[CacheBus] = None,
     ):
         self.suite_key: str = suite_key
         self.suite_secret: str = suite_secret
         self.repo: Repository = repo
+        self.session = session
         self.corp_token_url = corp_token_url
         self.send_message_url = send_message_url
         self.template_id = template_id
+        self.http = http
+        self.max_users_per_message = max_users_per_message
+        self.corp_concurrency = corp_concurrency
+        self.rate_limiter = rate_limiter
+        self.retry_policy = retry_policy
 
         self._provider_corp_id: Optional[CorpId] = None
         self._suite: Optional[Suite] = None
-        self._corp_tokens: dict[CorpId, AccessToken] = {}
-        self._suite_access_token: Optional[AccessToken] = None
+        self._corp_tokens = TokenManager(
+            'corp_token', self._fetch_corp_token, token_expiry_margin, token_refresh_ahead, self._invalidate_corp_token
+        )
+        self._suite_access_token = TokenManager(
+            'suite_access_token', self._fetch_suite_access_token, token_expiry_margin, token_refresh_ahead
+        )
         self._corp_agent_id: dict[CorpId, AgentId] = {}  # TODO: 暂时假定一个企业只有一个应用
+        self._corp_send_semaphores: dict[CorpId, asyncio.Semaphore] = {}
+
+        # 套件, 企业 agent_id 与企业 token 缓存在每个 worker 中, 通过 cache_bus 在 worker 之间同步
+        self.cache_bus = cache_bus or CacheBus()
+        self.cache_bus.subscribe(self.apply_cache_event)
 
-    def refresh_suite(self, corp_id: CorpId, suite_ticket: str) -> None:
+    def refresh_suite(self, corp_id: CorpId, suite_ticket: str) -> bool:
+        """更新内存中的套件信息, ticket 没有变化时返回 False"""
+        if self._suite is not None and self._suite.corp_id == corp_id and self._suite.suite_ticket == suite_ticket:
+            return False
         self._provider_corp_id = corp_id
         self._suite = Suite(
             corp_id=corp_id,
             suite_key=self.suite_key,
             suite_ticket=suite_ticket,
         )
+        return True
+
+    def publish_suite(self, suite: Suite) -> None:
+        """套件信息保存后通知所有 worker 更新"""
+        self.cache_bus.publish(CacheKind.SUITE, suite.suite_key, suite.json())
+
+    def evict_corp(self, corp_id: CorpId) -> None:
+        """企业授权或解除授权后, 所有 worker 删除该企业的 agent_id 与 token"""
+        self.cache_bus.publish(CacheKind.CORP_AUTH, corp_id)
+
+    def apply_cache_event(self, event: Optional[CacheEvent]) -> None:
+        if event is None:
+            self._suite = None
+            self._corp_agent_id.clear()
+            self._corp_tokens.clear()
+        elif event.kind == CacheKind.SUITE:
+            if event.value is None:
+                self._suite = None
+            else:
+                suite = Suite.parse_raw(event.value)
+                self.refresh_suite(corp_id=suite.corp_id, suite_ticket=suite.suite_ticket)
+        elif event.kind == CacheKind.CORP_AUTH:
+            self._corp_agent_id.pop(event.key, None)
+            self._corp_tokens.set(event.key, None)
+        elif event.kind == CacheKind.CORP_TOKEN:
+            # 只广播失效, 每个 worker 通过自己的 TokenManager 重新获取
+            self._corp_tokens.set(event.key, None)
 
     async def get_suite(self) -> Suite:
         if settings.dingding_deploy_mode == DeployMode.LOCAL:
-            # LOCAL 部署模式，一定要向云端获取套件信息
+            # LOCAL 部署模式，一定要向云端获取套件信息，由 repo 缓存并在云端通知时失效
             assert isinstance(self.repo, PostgresRepository)
             suite = await self.repo.get_suite(self.suite_key)
             if suite is None:
@@ -94,26 +168,89 @@ class DingDingService:
 
         https://open.dingtalk.com/document/isvapp-server/work-notification-templating-send-notification-interface
         """
-        async with AsyncClient() as client:
-            response = await client.post(
+        await self._send_message(user_ids, message, corp_id)
+        return True
+
+    async def send_messages_batch(self, jobs: list[CloudSendMessageInput]) -> list[SendMessageChunkResult]:
+        """
+        批量发送消息
+
+        每个任务按照钉钉单次调用的接收人上限拆分，所有分片并发发送，同一企业内的并发数受 corp_concurrency 限制。
+        请求的 AsyncSession 不能并发使用, 发送之前逐个企业查询 agent_id, 并发发送的分片不再访问数据库
+        """
+        agent_ids: dict[CorpId, AgentId] = {}
+        errors: dict[CorpId, str] = {}
+        for corp_id in dict.fromkeys(job.corp_id for job in jobs):
+            try:
+                agent_ids[corp_id] = await self._get_corp_agent_id(corp_id)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.warning("企业 %s 获取 agent_id 失败: %s", corp_id, err)
+                errors[corp_id] = str(err)
+
+        chunks = [
+            (job.corp_id, job.user_ids[i : i + self.max_users_per_message], job.message)
+            for job in jobs
+            for i in range(0, len(job.user_ids), self.max_users_per_message)
+        ]
+        logging.info("批量发送钉钉消息, 任务数: %s, 分片数: %s", len(jobs), len(chunks))
+
+        async def _send(corp_id: CorpId, user_ids: list[UserId], message: str) -> SendMessageChunkResult:
+            if corp_id in errors:
+                return SendMessageChunkResult(corp_id=corp_id, user_ids=user_ids, success=False, errmsg=errors[corp_id])
+            return await self._send_chunk(corp_id, user_ids, message, agent_ids[corp_id])
+
+        return list(await asyncio.gather(*(_send(*chunk) for chunk in chunks)))
+
+    async def _send_chunk(
+        self, corp_id: CorpId, user_ids: list[UserId], message: str, agent_id: AgentId
+    ) -> SendMessageChunkResult:
+        if corp_id not in self._corp_send_semaphores:
+            self._corp_send_semaphores[corp_id] = asyncio.Semaphore(self.corp_concurrency)
+
+        async with self._corp_send_semaphores[corp_id]:
+            try:
+                task_id = await self._send_message(user_ids, message, corp_id, agent_id)
+            except Exception as err:  # pylint: disable=broad-exception-caught
+                logging.warning("企业 %s 分片发送钉钉消息失败: %s", corp_id, err)
+                return SendMessageChunkResult(corp_id=corp_id, user_ids=user_ids, success=False, errmsg=str(err))
+
+        return SendMessageChunkResult(corp_id=corp_id, user_ids=user_ids, success=True, task_id=task_id)
+
+    async def _send_message(
+        self, user_ids: list[UserId], message: str, corp_id: CorpId, agent_id: Optional[AgentId] = None
+    ) -> Optional[int]:
+        """发送一次钉钉消息，返回钉钉的 task_id; agent_id 为空时查询"""
+        if agent_id is None:
+            agent_id = await self._get_corp_agent_id(corp_id)
+
+        async def _send() -> dict[str, Any]:
+            access_token = await self.get_corp_token(corp_id)
+            await self._throttle(RateLimitEndpoint.SEND_MESSAGE, corp_id)
+            response = await self.http.dingding.post(
                 url=self.send_message_url,
                 params={
-                    "access_token": await self.get_corp_token(corp_id),
+                    "access_token": access_token,
                 },
                 json={
-                    "agent_id": await self._get_corp_agent_id(corp_id),
+                    "agent_id": agent_id,
                     "userid_list": ','.join(user_ids),
                     "template_id": self.template_id,
                     "data": message,
                 },
             )
-            if response.status_code != httpx.codes.OK or response.json()['errcode'] != 0:
-                raise DingDingException(
-                    f"发送钉钉消息失败,状态码:{response.status_code}, 返回内容:{response.text}",
-                )
-            logging.info("发送钉钉消息成功 %s", response.text)
+            return check_response(response, "发送钉钉消息失败")
+
+        # 发送消息不是幂等的, 只重试请求没有发出的错误, 避免重复发送
+        data = await retry(
+            _send,
+            self.retry_policy,
+            'send_message',
+            lambda: self._corp_tokens.invalidate(corp_id),
+            retry_on=CONNECT_ERRORS,
+        )
+        logging.info("发送钉钉消息成功 %s", data)
 
-        return True
+        return data.get('task_id')
 
     async def get_corp_token(self, corp_id: CorpId) -> str:
         """
@@ -121,60 +258,73 @@ class DingDingService:
 
         https://developer.work.weixin.qq.com/document/path/90605
         """
-        if (token := self._corp_tokens.get(corp_id)) and not token.is_expired():
-            return token.value
+        return await self._corp_tokens.get(corp_id)
+
+    async def _fetch_corp_token(self, corp_id: CorpId) -> AccessToken:
+        # token 在后台任务中刷新, 不能使用发起请求的会话
+        async with background_session(*self.session):
+            suite_ticket = await self._get_suite_ticket()
 
-        async with AsyncClient() as client:
+        async def _fetch() -> dict[str, Any]:
+            await self._throttle(RateLimitEndpoint.GET_CORP_TOKEN, corp_id)
             timestamp = int(pendulum.now().timestamp() * 1000)
-            response = await client.post(
+            response = await self.http.dingding.post(
                 url=self.corp_token_url,
                 params={
                     "accessKey": self.suite_key,
                     'timestamp': timestamp,
-                    'suiteTicket': await self._get_suite_ticket(),
-                    'signature': await self._get_signature(timestamp),
+                    'suiteTicket': suite_ticket,
+                    'signature': self._get_signature(timestamp, suite_ticket),
                 },
                 json={'auth_corpid': corp_id},
             )
-            if response.status_code != httpx.codes.OK:
-                raise DingDingException(f"获取企业内 {corp_id} 凭证失败,状态码:{response.status_code},返回内容:{response.text}")
-
-            data = response.json()
-            if (errcode := data.get('errcode', 0)) and errcode != 0:
-                raise DingDingException(f"获取企业内 {corp_id} 凭证失败, 响应内容: {data}")
-
-            token = AccessToken(data['access_token'], data['expires_in'])
-            self._corp_tokens[corp_id] = token
+            return check_response(response, f"获取企业内 {corp_id} 凭证失败")
 
-            return token.value
+        data = await retry(_fetch, self.retry_policy, 'get_corp_token')
+        return AccessToken(data['access_token'], data['expires_in'])
 
     async def get_suite_access_token(self) -> str:
         # https://open.dingtalk.com/document/isvapp-server/obtains-the-suite_acess_token-of-third-party-enterprise-applications
-        if self._suite_access_token is not None and not self._suite_access_token.is_expired():
-            return self._suite_access_token.value
+        return await self._suite_access_token.get(self.suite_key)
+
+    async def _fetch_suite_access_token(self, _: str) -> AccessToken:
+        async with background_session(*self.session):
+            auth_corp_id = await self._get_auth_corp_id()
+            suite_ticket = await self._get_suite_ticket()
 
         client = dingtalkoauth2_1_0Client(open_api_models.Config(protocol='https', region_id='central'))
         get_corp_access_token_request = dingtalkoauth_2__1__0_models.GetCorpAccessTokenRequest(
             suite_key=self.suite_key,
             suite_secret=self.suite_secret,
-            auth_corp_id=await self._get_auth_corp_id(),
-            suite_ticket=await self._get_suite_ticket(),
+            auth_corp_id=auth_corp_id,
+            suite_ticket=suite_ticket,
         )
         try:
             response = await client.get_corp_access_token_async(get_corp_access_token_request)
-            self._suite_access_token = AccessToken(
-                value=response.body.access_token,
-                expires_in=response.body.expire_in,
-            )
-            return self._suite_access_token.value
-
         except TeaException as err:
             if not UtilClient.empty(err.code) and not UtilClient.empty(err.message):
                 logging.warning("Get access token error of code %s and message %s", err.code, err.message)
-                raise
+            raise
 
-    async def _get_signature(self, timestamp: int) -> str:
-        string_to_sign = f"{timestamp}\n{await self._get_suite_ticket()}"
+        return AccessToken(value=response.body.access_token, expires_in=response.body.expire_in)
+
+    def metrics(self) -> dict[str, Any]:
+        return {
+            'corp_token': self._corp_tokens.report(),
+            'suite_access_token': self._suite_access_token.report(),
+            'rate_limit': self.rate_limiter.report() if self.rate_limiter else None,
+        }
+
+    def _invalidate_corp_token(self, corp_id: CorpId) -> None:
+        """钉钉返回 token 无效时通知所有 worker 删除该企业的 token, 不广播 token 的值"""
+        self.cache_bus.publish(CacheKind.CORP_TOKEN, corp_id)
+
+    async def _throttle(self, endpoint: RateLimitEndpoint, corp_id: CorpId) -> None:
+        if self.rate_limiter is not None:
+            await self.rate_limiter.acquire(endpoint, corp_id)
+
+    def _get_signature(self, timestamp: int, suite_ticket: str) -> str:
+        string_to_sign = f"{timestamp}\n{suite_ticket}"
         signature = hmac.new(
             bytes(self.suite_secret, 'UTF-8'),
             msg=bytes(string_to_sign, 'UTF-8'),
@@ -246,15 +396,73 @@ class DingDingService:
         return token.body
 
     async def _get_userid_by_unionid(self, unionid: UnionId, corp_id: CorpId) -> UserId:
-        async with AsyncClient() as client:
-            response = await client.post(
+        async def _fetch() -> dict[str, Any]:
+            access_token = await self.get_corp_token(corp_id)
+            await self._throttle(RateLimitEndpoint.GET_BY_UNIONID, corp_id)
+            response = await self.http.dingding.post(
                 url='https://oapi.dingtalk.com/topapi/user/getbyunionid',
-                params={'access_token': await self.get_corp_token(corp_id)},
+                params={'access_token': access_token},
                 json={"unionid": unionid},
             )
-            if response.status_code != httpx.codes.OK or response.json().get('errcode', 0) != 0:
-                raise Exception(  # pylint: disable=broad-exception-raised
-                    f"根据 unionid 获取 userid 失败,状态码:{response.status_code},返回内容:{response.text}"
-                )
+            return check_response(response, "根据 unionid 获取 userid 失败")
+
+        data = await retry(_fetch, self.retry_policy, 'getbyunionid', lambda: self._corp_tokens.invalidate(corp_id))
+        return data['result']['userid']
 
-            return response.json()['result']['userid']
+    async def list_sub_department_ids(self, corp_id: CorpId, dept_id: int) -> list[int]:
+        """
+        获取下一级部门 ID 列表
+
+        https://open.dingtalk.com/document/isvapp/obtain-a-sub-department-id-list-v2
+        """
+
+        async def _fetch() -> dict[str, Any]:
+            access_token = await self.get_corp_token(corp_id)
+            await self._throttle(RateLimitEndpoint.LIST_DEPARTMENT, corp_id)
+            response = await self.http.dingding.post(
+                url='https://oapi.dingtalk.com/topapi/v2/department/listsubid',
+                params={'access_token': access_token},
+                json={'dept_id': dept_id},
+            )
+            return check_response(response, f"获取企业 {corp_id} 部门 {dept_id} 的子部门失败")
+
+        data = await retry(_fetch, self.retry_policy, 'list_department', lambda: self._corp_tokens.invalidate(corp_id))
+        return data['result']['dept_id_list']
+
+    async def list_department_users(
+        self, corp_id: CorpId, dept_id: int, cursor: int, size: int
+    ) -> tuple[list[DingDingUser], Optional[int]]:
+        """
+        分页获取部门用户详情, 返回本页的用户与下一页的 cursor, 没有下一页时 cursor 为 None
+
+        通讯录接口不返回 open_id, open_id 为空字符串, 写入时保留已有的值
+
+        https://open.dingtalk.com/document/isvapp/queries-the-complete-information-of-a-department-user
+        """
+
+        async def _fetch() -> dict[str, Any]:
+            access_token = await self.get_corp_token(corp_id)
+            await self._throttle(RateLimitEndpoint.LIST_USER, corp_id)
+            response = await self.http.dingding.post(
+                url='https://oapi.dingtalk.com/topapi/v2/user/list',
+                params={'access_token': access_token},
+                json={'dept_id': dept_id, 'cursor': cursor, 'size': size},
+            )
+            return check_response(response, f"获取企业 {corp_id} 部门 {dept_id} 的用户失败")
+
+        data = await retry(_fetch, self.retry_policy, 'list_user', lambda: self._corp_tokens.invalidate(corp_id))
+        result = data['result']
+        users = [
+            DingDingUser(
+                nick=item['name'],
+                corp_id=corp_id,
+                open_id=OpenId(''),
+                union_id=item['unionid'],
+                user_id=item['userid'],
+                email=item.get('email') or item.get('org_email') or None,
+                avatar_url=item.get('avatar') or None,
+                mobile=item.get('mobile') or None,
+            )
+            for item in result.get('list', [])
+        ]
+        return users, result.get('next_cursor') if result.get('has_more') else None
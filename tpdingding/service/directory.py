@@ -0,0 +1,232 @@
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from collections.abc import Awaitable
+from collections.abc import Callable
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Optional
+from typing import TypeVar
+
+from tpdingding.helper.session import POSTGRES_SESSION_VAR
+from tpdingding.helper.session import PostgresSession
+from tpdingding.helper.session import background_session
+from tpdingding.model.directory import DirectorySyncState
+from tpdingding.model.directory import DirectorySyncStatus
+from tpdingding.model.entity import CorpId
+from tpdingding.model.entity import DingDingUser
+from tpdingding.model.entity import UserId
+from tpdingding.persistence.postgres import PostgresRepository
+from tpdingding.service.dingding import DingDingService
+
+T = TypeVar('T')
+
+ROOT_DEPT_ID = 1  # 钉钉企业的根部门 ID
+
+
+@dataclass
+class DirectorySyncMetrics:
+    runs: int = 0
+    skipped: int = 0
+    succeeded: int = 0
+    failed: int = 0
+    departments: int = 0
+    users: int = 0
+
+
+class DirectorySyncService:
+    """
+    从钉钉通讯录同步企业的全部用户到本地 dingding_user 表
+
+    * 先遍历部门树, 再按部门分页拉取用户, 同一企业内并发拉取的部门数受 dept_concurrency 限制
+    * 用户攒够 batch_size 个后批量写入, 并在同一个事务中把尚未写入的部门作为 cursor 保存
+    * 同步中断后从 cursor 继续; 距离上次同步完成不足 interval 秒的企业跳过
+    * 多个 worker 通过 directory_sync 表互斥, 同一企业同时只有一个 worker 在同步;
+      每获取一层部门或一页用户后检查租约, 距离上次保存超过 lease / 3 秒时写入缓冲区并续约, 与 batch_size 无关
+    """
+
+    def __init__(
+        self,
+        dingding_srv: DingDingService,
+        repo: PostgresRepository,
+        page_size: int,
+        batch_size: int,
+        corp_concurrency: int,
+        dept_concurrency: int,
+        interval: float,
+        lease: float,
+    ):
+        self.dingding_srv = dingding_srv
+        self.repo = repo
+        self.page_size = page_size
+        self.batch_size = batch_size
+        self.corp_concurrency = corp_concurrency
+        self.dept_concurrency = dept_concurrency
+        self.interval = interval
+        self.lease = lease
+        self.metrics = DirectorySyncMetrics()
+
+        self._tasks: set[asyncio.Task] = set()
+
+    def start(self, corp_ids: list[CorpId], force: bool = False) -> None:
+        """在后台同步企业通讯录"""
+        task = asyncio.create_task(self.sync(corp_ids, force), name='directory-sync')
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self) -> None:
+        """取消进行中的同步, 已写入的进度保存在 cursor 中, 租约过期后可以继续"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def sync(self, corp_ids: list[CorpId], force: bool = False) -> None:
+        semaphore = asyncio.Semaphore(self.corp_concurrency)
+
+        async def _sync(corp_id: CorpId) -> None:
+            async with semaphore:
+                try:
+                    await self.sync_corp(corp_id, force)
+                except Exception:  # pylint: disable=broad-exception-caught
+                    logging.exception('企业 %s 通讯录同步失败', corp_id)
+
+        logging.info('开始同步通讯录, 企业数: %s', len(corp_ids))
+        await asyncio.gather(*(_sync(corp_id) for corp_id in corp_ids))
+
+    async def sync_corp(self, corp_id: CorpId, force: bool = False) -> bool:
+        """同步一个企业的通讯录, 被其他 worker 同步中或者同步间隔未到时返回 False"""
+        interval = None if force else self.interval
+        state = await self.transaction(lambda: self.repo.claim_directory_sync(corp_id, self.lease, interval))
+        if state is None:
+            self.metrics.skipped += 1
+            logging.info('企业 %s 通讯录正在同步或距离上次同步不足 %s 秒, 跳过', corp_id, self.interval)
+            return False
+
+        self.metrics.runs += 1
+        run = _CorpSync(self, state)
+        try:
+            await run.run()
+        except Exception as err:
+            self.metrics.failed += 1
+            await self.transaction(
+                lambda: self.repo.save_directory_sync(
+                    corp_id, DirectorySyncStatus.FAILED, run.cursor(), run.synced_users, str(err)
+                )
+            )
+            raise
+
+        self.metrics.succeeded += 1
+        logging.info('企业 %s 通讯录同步完成, 写入用户 %s 个', corp_id, run.synced_users)
+        return True
+
+    async def transaction(self, func: Callable[[], Awaitable[T]]) -> T:
+        """后台任务没有请求的 session, 每次写入使用独立的 session 与事务"""
+        async with background_session(POSTGRES_SESSION_VAR, PostgresSession):
+            return await func()
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'running': len(self._tasks)}
+
+
+class _CorpSync:
+    """一个企业的一次同步"""
+
+    def __init__(self, srv: DirectorySyncService, state: DirectorySyncState):
+        self.srv = srv
+        self.corp_id = state.corp_id
+        self.synced_users = state.synced_users
+        self.pending: list[int] = json.loads(state.cursor) if state.cursor else []
+
+        self._buffer: dict[UserId, DingDingUser] = {}
+        self._fetched: set[int] = set()  # 用户已全部进入缓冲区, 下次写入后从 pending 中移除的部门
+        self._seen: set[UserId] = set()  # 同一个用户可以属于多个部门, 只写入一次
+        self._lock = asyncio.Lock()
+        self._saved_at = time.monotonic()  # 领取时已经续约
+
+    def cursor(self) -> Optional[str]:
+        return json.dumps(self.pending) if self.pending else None
+
+    async def run(self) -> None:
+        if self.pending:
+            logging.info('企业 %s 继续上次未完成的同步, 剩余部门 %s 个', self.corp_id, len(self.pending))
+        else:
+            self.pending = await self._list_departments()
+            logging.info('企业 %s 共有部门 %s 个', self.corp_id, len(self.pending))
+            async with self._lock:
+                await self._flush(DirectorySyncStatus.RUNNING)
+
+        queue = deque(self.pending)
+
+        async def _worker() -> None:
+            try:
+                while queue:
+                    await self._sync_department(queue.popleft())
+            except BaseException:
+                queue.clear()  # 一个部门失败时其他 worker 不再领取新的部门
+                raise
+
+        await asyncio.gather(*(_worker() for _ in range(self.srv.dept_concurrency)))
+        async with self._lock:
+            await self._flush(DirectorySyncStatus.SUCCEEDED)
+
+    async def _list_departments(self) -> list[int]:
+        """按层遍历部门树, 同一层的部门并发获取子部门"""
+        semaphore = asyncio.Semaphore(self.srv.dept_concurrency)
+
+        async def _children(dept_id: int) -> list[int]:
+            async with semaphore:
+                return await self.srv.dingding_srv.list_sub_department_ids(self.corp_id, dept_id)
+
+        departments, level = [ROOT_DEPT_ID], [ROOT_DEPT_ID]
+        while level:
+            level = [child for children in await asyncio.gather(*map(_children, level)) for child in children]
+            departments.extend(level)
+            async with self._lock:
+                if self._lease_expiring():
+                    await self._flush(DirectorySyncStatus.RUNNING)
+        return departments
+
+    async def _sync_department(self, dept_id: int) -> None:
+        cursor: Optional[int] = 0
+        while cursor is not None:
+            users, cursor = await self.srv.dingding_srv.list_department_users(
+                self.corp_id, dept_id, cursor, self.srv.page_size
+            )
+            async with self._lock:
+                for user in users:
+                    if user.user_id not in self._seen:
+                        self._seen.add(user.user_id)
+                        self._buffer[user.user_id] = user
+                if len(self._buffer) >= self.srv.batch_size or self._lease_expiring():
+                    await self._flush(DirectorySyncStatus.RUNNING)
+
+        async with self._lock:
+            self._fetched.add(dept_id)
+        self.srv.metrics.departments += 1
+
+    def _lease_expiring(self) -> bool:
+        return time.monotonic() - self._saved_at >= self.srv.lease / 3
+
+    async def _flush(self, status: DirectorySyncStatus) -> None:
+        """写入缓冲区中的用户并保存进度, 调用方需要持有 _lock"""
+        users = list(self._buffer.values())
+        pending = [dept_id for dept_id in self.pending if dept_id not in self._fetched]
+        synced_users = self.synced_users + len(users)
+        cursor = json.dumps(pending) if pending and status == DirectorySyncStatus.RUNNING else None
+
+        async def _write() -> None:
+            if users:
+                await self.srv.repo.save_users(users)
+            await self.srv.repo.save_directory_sync(self.corp_id, status, cursor, synced_users)
+
+        await self.srv.transaction(_write)
+        self._saved_at = time.monotonic()
+        self._buffer.clear()
+        self._fetched.clear()
+        self.pending = pending
+        self.synced_users = synced_users
+        self.srv.metrics.users += len(users)
@@ -0,0 +1,45 @@
+import asyncio
+import logging
+from typing import Optional
+from urllib.parse import urljoin
+
+from settings import BASIC_AUTH
+from tpdingding.helper.http import HttpClients
+from tpdingding.model.cache import CacheInvalidation
+from tpdingding.model.cache import CacheKind
+
+
+class InvalidationNotifier:
+    """云端部署在套件或企业授权变化时, 通知本地部署使缓存失效"""
+
+    def __init__(self, http: HttpClients, local_hosts: list[str]):
+        self.http = http
+        self.local_hosts = local_hosts
+        self._tasks: set[asyncio.Task] = set()
+
+    def notify(self, kind: CacheKind, key: str) -> Optional[asyncio.Task]:
+        """在后台通知, 不阻塞事件回调"""
+        if not self.local_hosts:
+            return None
+        task = asyncio.create_task(self._notify(CacheInvalidation(kind=kind, key=key)))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _notify(self, invalidation: CacheInvalidation) -> None:
+        results = await asyncio.gather(
+            *(
+                self.http.local.post(
+                    urljoin(host, '/dingding/local/cache/invalidate'),
+                    json=invalidation.dict(),
+                    auth=BASIC_AUTH,
+                )
+                for host in self.local_hosts
+            ),
+            return_exceptions=True,
+        )
+        for host, result in zip(self.local_hosts, results):
+            if isinstance(result, Exception):
+                logging.warning('通知本地部署 %s 缓存失效失败: %s', host, result)
+            elif result.is_error:
+                logging.warning('通知本地部署 %s 缓存失效失败: %s', host, result.text)
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+
+import httpx
+import pendulum
+
+from settings import BASIC_AUTH
+from settings import settings
+from tpdingding.exception import DingDingException
+from tpdingding.helper.http import HttpClients
+from tpdingding.model.entity import CloudBatchSendMessageInput
+from tpdingding.model.entity import CloudSendMessageInput
+from tpdingding.model.entity import CorpId
+from tpdingding.model.entity import DeliveryStatus
+from tpdingding.model.entity import DingDingRecipient
+from tpdingding.model.entity import RecipientDelivery
+from tpdingding.model.entity import SendMessageChunkResult
+from tpdingding.model.entity import SendMessageInput
+from tpdingding.model.entity import SendMessageReport
+from tpdingding.model.entity import StaffId
+from tpdingding.model.entity import UserId
+from tpdingding.service.resolver import StaffResolver
+
+
+class MessageService:
+    """本地部署发送消息: 将 staff 解析为钉钉用户, 按企业分组后由云端服务发送"""
+
+    def __init__(self, resolver: StaffResolver, http: HttpClients):
+        self.resolver = resolver
+        self.http = http
+
+    async def send(
+        self,
+        message: SendMessageInput,
+        created_at: Optional[datetime] = None,
+    ) -> Optional[SendMessageReport]:
+        """
+        发送消息并返回每个接收人的发送结果, 没有找到任何接收人时返回 None
+
+        接收人分属多个钉钉企业时, 每个企业单独调用一次云端服务, 并发执行, 某个企业失败不影响其他企业。
+        created_at 为消息的创建时间, 会附加在消息内容末尾, 默认为当前时间
+        """
+        if not (recipients := await self.resolve(message)):
+            return None
+        return await self.deliver(message, recipients, created_at)
+
+    async def resolve(self, message: SendMessageInput) -> dict[StaffId, DingDingRecipient]:
+        """解析接收人, 需要数据库会话; 发件箱 worker 在短事务中解析, 发送时不持有事务"""
+        logging.info("尝试为租户为 %s 的 staff %s 发送消息", message.tenant_id, message.staff_ids)
+
+        # 获取用户
+        recipients = await self.resolver.resolve(message.tenant_id, message.staff_ids)
+        if not recipients:
+            logging.warning("没有找到任何用户")
+            return recipients
+
+        user_ids_missing = [staff_id for staff_id in message.staff_ids if staff_id not in recipients]
+        if user_ids_missing:
+            logging.warning('尝试发送消息，未找到部分用户: %s ', user_ids_missing)
+        return recipients
+
+    async def deliver(
+        self,
+        message: SendMessageInput,
+        recipients: dict[StaffId, DingDingRecipient],
+        created_at: Optional[datetime] = None,
+    ) -> SendMessageReport:
+        """发送给已解析的接收人, 不访问数据库"""
+        # 多个 staff 可能绑定同一个钉钉用户, 按企业分组时去重
+        by_corp: defaultdict[CorpId, dict[UserId, None]] = defaultdict(dict)
+        for recipient in recipients.values():
+            by_corp[recipient.corp_id][recipient.user_id] = None
+        logging.info('Final: 尝试发送消息给 %s', {corp_id: list(user_ids) for corp_id, user_ids in by_corp.items()})
+
+        # 钉钉消息模版使用 message 作为消息变量
+        # 钉钉消息模版使用 url 作为跳转地址
+        # 接收人较多时由云端按钉钉上限拆分并发发送
+        created_at = (created_at or pendulum.now()).astimezone()
+        content = json.dumps(
+            {
+                'message': message.data + f'\n{created_at.strftime("%Y-%m-%d %H:%M:%S")}',
+                'url': message.url or settings.site_url,
+            }
+        )
+        results = await asyncio.gather(
+            *(
+                self._send_corp(CloudSendMessageInput(corp_id=corp_id, user_ids=list(user_ids), message=content))
+                for corp_id, user_ids in by_corp.items()
+            )
+        )
+
+        chunks = {
+            (chunk.corp_id, user_id): chunk
+            for corp_results in results
+            for chunk in corp_results
+            for user_id in chunk.user_ids
+        }
+        report = SendMessageReport(
+            recipients=[
+                self._delivery(staff_id, recipients.get(staff_id), chunks)
+                for staff_id in dict.fromkeys(message.staff_ids)
+            ]
+        )
+        if failed := report.of_status(DeliveryStatus.FAILED):
+            logging.error('部分用户发送消息失败: %s', [(recipient.staff_id, recipient.errmsg) for recipient in failed])
+        return report
+
+    async def _send_corp(self, job: CloudSendMessageInput) -> list[SendMessageChunkResult]:
+        """单个企业的发送任务, 调用失败时把该企业的全部用户记为失败"""
+        try:
+            response = await self.http.cloud.post(
+                '/dingding/internal/send/messages:batch',
+                json=CloudBatchSendMessageInput(jobs=[job]).dict(),
+                auth=BASIC_AUTH,
+            )
+            if response.status_code != httpx.codes.OK:
+                raise DingDingException(f"发送消息失败 {response.text}")
+            return [SendMessageChunkResult.parse_obj(chunk) for chunk in response.json()]
+        except (DingDingException, httpx.HTTPError) as err:
+            logging.warning('企业 %s 发送消息失败: %s', job.corp_id, err)
+            return [SendMessageChunkResult(corp_id=job.corp_id, user_ids=job.user_ids, success=False, errmsg=str(err))]
+
+    @staticmethod
+    def _delivery(
+        staff_id: StaffId,
+        recipient: Optional[DingDingRecipient],
+        chunks: dict[tuple[CorpId, UserId], SendMessageChunkResult],
+    ) -> RecipientDelivery:
+        if recipient is None:
+            return RecipientDelivery(staff_id=staff_id, status=DeliveryStatus.NOT_FOUND, errmsg='没有找到绑定的钉钉用户')
+
+        chunk = chunks.get((recipient.corp_id, recipient.user_id))
+        if chunk is None:
+            return RecipientDelivery(
+                staff_id=staff_id,
+                status=DeliveryStatus.FAILED,
+                user_id=recipient.user_id,
+                corp_id=recipient.corp_id,
+                errmsg='云端服务没有返回该用户的发送结果',
+            )
+        return RecipientDelivery(
+            staff_id=staff_id,
+            status=DeliveryStatus.SENT if chunk.success else DeliveryStatus.FAILED,
+            user_id=recipient.user_id,
+            corp_id=recipient.corp_id,
+            task_id=chunk.task_id,
+            errmsg=chunk.errmsg,
+        )
@@ -0,0 +1,125 @@
+import json
+import logging
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Optional
+
+from tpdingding.helper.cache import LRUCache
+from tpdingding.model.cache import CacheEvent
+from tpdingding.model.cache import CacheKind
+from tpdingding.model.entity import CorpId
+from tpdingding.model.entity import DingDingRecipient
+from tpdingding.model.entity import StaffId
+from tpdingding.model.entity import TenantId
+from tpdingding.model.entity import UserId
+from tpdingding.persistence.abstract import Repository
+from tpdingding.service.cache_bus import CacheBus
+from tpdingding.service.iam import IAMService
+
+
+@dataclass
+class ResolverMetrics:
+    hits: int = 0
+    misses: int = 0
+    db_resolved: int = 0
+    iam_resolved: int = 0
+    unresolved: int = 0
+
+
+class StaffResolver:
+    """
+    IAM 平台的 staff_id 解析为钉钉用户 (user_id, corp_id)
+
+    先查进程内 LRU 缓存, 未命中的 staff 批量查询本地 dingding_user 表,
+    表中仍没有绑定信息的 staff 再批量向 IAM 查询。用户重新绑定时需要在提交之后调用 invalidate,
+    失效通过 cache_bus 同步到所有 worker, 避免其他 worker 继续发送给之前绑定的钉钉用户。
+    """
+
+    def __init__(
+        self,
+        repo: Repository,
+        iam_srv: IAMService,
+        maxsize: int,
+        ttl: float,
+        cache_bus: Optional[CacheBus] = None,
+    ):
+        self.repo = repo
+        self.iam_srv = iam_srv
+        self.metrics = ResolverMetrics()
+        self._cache: LRUCache[DingDingRecipient] = LRUCache(maxsize, ttl)
+        self.cache_bus = cache_bus or CacheBus()
+        self.cache_bus.subscribe(self.apply_cache_event)
+
+    async def resolve(self, tenant_id: TenantId, staff_ids: list[StaffId]) -> dict[StaffId, DingDingRecipient]:
+        """返回能解析的 staff, 解析不到的 staff 不在结果中"""
+        cached = self._cache.get_many((tenant_id, staff_id) for staff_id in staff_ids)
+        resolved = {staff_id: recipient for (_, staff_id), recipient in cached.items()}
+        self.metrics.hits += len(resolved)
+
+        misses = list(dict.fromkeys(staff_id for staff_id in staff_ids if staff_id not in resolved))
+        if not misses:
+            return resolved
+        self.metrics.misses += len(misses)
+
+        loaded = await self._load_from_db(tenant_id, misses)
+        self.metrics.db_resolved += len(loaded)
+
+        if misses := [staff_id for staff_id in misses if staff_id not in loaded]:
+            from_iam = await self._load_from_iam(misses)
+            self.metrics.iam_resolved += len(from_iam)
+            self.metrics.unresolved += len(misses) - len(from_iam)
+            loaded.update(from_iam)
+
+        self._cache.set_many({(tenant_id, staff_id): recipient for staff_id, recipient in loaded.items()})
+        resolved.update(loaded)
+        return resolved
+
+    def invalidate(self, tenant_id: TenantId, staff_id: StaffId, user_id: Optional[UserId] = None) -> None:
+        """staff 重新绑定钉钉用户时调用, 同时清理之前绑定到该钉钉用户的 staff"""
+        self.cache_bus.publish(CacheKind.STAFF_BINDING, json.dumps([tenant_id, staff_id, user_id]))
+
+    def invalidate_all(self) -> None:
+        """批量导入用户时清空所有 worker 的缓存"""
+        self.cache_bus.publish(CacheKind.STAFF_BINDING, '*')
+
+    def apply_cache_event(self, event: Optional[CacheEvent]) -> None:
+        if event is None or (event.kind == CacheKind.STAFF_BINDING and event.key == '*'):
+            self._cache.clear()
+        elif event.kind == CacheKind.STAFF_BINDING:
+            tenant_id, staff_id, user_id = json.loads(event.key)
+            self._cache.invalidate((tenant_id, staff_id))
+            if user_id is not None:
+                self._cache.invalidate_where(lambda _, recipient: recipient.user_id == user_id)
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'size': len(self._cache)}
+
+    async def _load_from_db(self, tenant_id: TenantId, staff_ids: list[StaffId]) -> dict[StaffId, DingDingRecipient]:
+        # 重新绑定时 save_user 会解除其他行的绑定; 仍有多行时结果按 updated_at 排序, 保留最近绑定的钉钉用户
+        users = await self.repo.of_staff_ids(tenant_id, staff_ids)
+        return {
+            user.staff_id: DingDingRecipient(staff_id=user.staff_id, user_id=user.user_id, corp_id=user.corp_id)
+            for user in users
+            if user.staff_id and user.user_id
+        }
+
+    async def _load_from_iam(self, staff_ids: list[StaffId]) -> dict[StaffId, DingDingRecipient]:
+        accounts = await self.iam_srv.list_dingding_users(staff_ids)
+        if not accounts:
+            return {}
+
+        user_ids = list({account.dingding_id for account in accounts.values()})
+        corps: dict[UserId, CorpId] = {}
+        for user in await self.repo.of_user_ids(user_ids):
+            corps.setdefault(user.user_id, user.corp_id)
+
+        wanted, resolved = set(staff_ids), {}
+        for staff_id, account in accounts.items():
+            if staff_id not in wanted:
+                continue
+            if (corp_id := corps.get(account.dingding_id)) is None:
+                logging.warning("staff %s 绑定的钉钉用户 %s 不在本地用户表中", staff_id, account.dingding_id)
+                continue
+            resolved[staff_id] = DingDingRecipient(staff_id=staff_id, user_id=account.dingding_id, corp_id=corp_id)
+        return resolved
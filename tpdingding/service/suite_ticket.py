@@ -0,0 +1,124 @@
+import asyncio
+import logging
+from collections.abc import Callable
+from contextvars import ContextVar
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tpdingding.helper.session import SessionScope
+from tpdingding.helper.session import background_session
+from tpdingding.model.cache import CacheKind
+from tpdingding.model.entity import CorpId
+from tpdingding.model.entity import Suite
+from tpdingding.persistence.abstract import Repository
+from tpdingding.service.dingding import DingDingService
+from tpdingding.service.invalidation import InvalidationNotifier
+
+
+@dataclass
+class SuiteTicketMetrics:
+    received: int = 0
+    unchanged: int = 0
+    flushes: int = 0
+    written: int = 0
+    failures: int = 0
+
+
+class SuiteTicketStore:
+    """
+    保存钉钉推送的 suite ticket
+
+    * 与内存中的 _suite 相同的 ticket 直接跳过, 不写数据库
+    * 变化的 ticket 先更新内存, 再放入写缓冲区, 第一次放入后最多 flush_interval 秒写入数据库,
+      期间同一企业的多次推送只写最后一次; 写入失败时保留并在 flush_interval 秒后重试
+    * 写入提交后才通知其他 worker 与本地部署刷新套件缓存, 应用关闭时写入缓冲区中剩余的 ticket
+
+    进程在写入之前退出时数据库中仍是上一个 ticket, 钉钉每 20 分钟左右会重新推送
+    """
+
+    def __init__(
+        self,
+        dingding_srv: DingDingService,
+        repo: Repository,
+        notifier: InvalidationNotifier,
+        session: tuple[ContextVar[SessionScope], Callable[[], AsyncSession]],
+        flush_interval: float,
+    ):
+        self.dingding_srv = dingding_srv
+        self.repo = repo
+        self.notifier = notifier
+        self.session = session
+        self.flush_interval = flush_interval
+        self.metrics = SuiteTicketMetrics()
+
+        self._pending: dict[CorpId, Suite] = {}
+        self._timer: Optional[asyncio.Task] = None
+        self._lock: Optional[asyncio.Lock] = None  # 在事件循环中创建
+
+    def save(self, corp_id: CorpId, suite_ticket: str) -> bool:
+        """ticket 没有变化时返回 False"""
+        self.metrics.received += 1
+        if not self.dingding_srv.refresh_suite(corp_id=corp_id, suite_ticket=suite_ticket):
+            self.metrics.unchanged += 1
+            return False
+
+        self._pending[corp_id] = Suite(
+            corp_id=corp_id, suite_key=self.dingding_srv.suite_key, suite_ticket=suite_ticket
+        )
+        self._schedule()
+        return True
+
+    async def flush(self) -> None:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._pending:
+                return
+            pending, self._pending = self._pending, {}
+            try:
+                async with background_session(*self.session):
+                    for suite in pending.values():
+                        await self.repo.save_suite_ticket(suite)
+            except asyncio.CancelledError:
+                # 被取消时放回缓冲区, 由 stop 中的 flush 写入
+                self._pending = {**pending, **self._pending}
+                raise
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('保存 suite ticket 失败, %s 秒后重试', self.flush_interval)
+                self.metrics.failures += 1
+                self._pending = {**pending, **self._pending}
+                self._schedule()
+                return
+
+            self.metrics.flushes += 1
+            self.metrics.written += len(pending)
+            for suite in pending.values():
+                self.dingding_srv.publish_suite(suite)
+                self.notifier.notify(CacheKind.SUITE, suite.suite_key)
+
+    async def stop(self) -> None:
+        # _timer 只在等待期间不为空, 取消不会打断正在进行的写入; 正在写入时 flush 等待 _lock 后再写入剩余的 ticket
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        await self.flush()
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            logging.error('应用关闭时 suite ticket 没有保存: %s', list(self._pending))
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'pending': len(self._pending)}
+
+    def _schedule(self) -> None:
+        if self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later(), name='suite-ticket-flush')
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        self._timer = None  # 开始写入之后 stop 不再取消这个任务
+        await self.flush()
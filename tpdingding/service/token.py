@@ -0,0 +1,96 @@
+import asyncio
+import logging
+from collections.abc import Awaitable
+from collections.abc import Callable
+from collections.abc import Hashable
+from dataclasses import asdict
+from typing import Any
+from typing import Optional
+
+from tpdingding.model.token import AccessToken
+from tpdingding.model.token import TokenMetrics
+
+
+class TokenManager:
+    """
+    按 key 缓存 AccessToken
+
+    * 同一个 key 的并发刷新只会向上游发起一次请求, 其余协程等待同一个结果
+    * token 进入 refresh_ahead 窗口后, 先返回旧值并在后台刷新
+    * token 距离过期不足 expiry_margin 时视为已过期
+    * token 失效时调用 on_invalidate, 用于通知其他 worker 删除缓存; 不广播 token 的值, set 与 clear 不调用
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fetch: Callable[[Hashable], Awaitable[AccessToken]],
+        expiry_margin: int,
+        refresh_ahead: int,
+        on_invalidate: Optional[Callable[[Hashable], None]] = None,
+    ):
+        self.name = name
+        self.fetch = fetch
+        self.expiry_margin = expiry_margin
+        self.refresh_ahead = refresh_ahead
+        self.on_invalidate = on_invalidate
+        self.metrics = TokenMetrics()
+
+        self._tokens: dict[Hashable, AccessToken] = {}
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+    async def get(self, key: Hashable) -> str:
+        token = self._tokens.get(key)
+        if token is not None and not token.is_expired(self.expiry_margin):
+            self.metrics.hits += 1
+            if token.is_expired(self.refresh_ahead) and key not in self._inflight:
+                self.metrics.background_refreshes += 1
+                # 后台刷新不返回 shield, 失败由 _done 记录并取走异常
+                self._start(key)
+            return token.value
+
+        self.metrics.misses += 1
+        return (await self._refresh(key)).value
+
+    def invalidate(self, key: Hashable) -> None:
+        self._tokens.pop(key, None)
+        if self.on_invalidate is not None:
+            self.on_invalidate(key)
+
+    def set(self, key: Hashable, token: Optional[AccessToken]) -> None:
+        """token 为 None 时删除, 用于其他 worker 通知的失效"""
+        if token is None:
+            self._tokens.pop(key, None)
+        else:
+            self._tokens[key] = token
+
+    def clear(self) -> None:
+        self._tokens.clear()
+
+    def report(self) -> dict[str, Any]:
+        return {**asdict(self.metrics), 'cached': len(self._tokens), 'inflight': len(self._inflight)}
+
+    def _refresh(self, key: Hashable) -> Awaitable[AccessToken]:
+        # shield: 某个等待者被取消时不影响其他等待者
+        return asyncio.shield(self._start(key))
+
+    def _start(self, key: Hashable) -> asyncio.Task:
+        if (task := self._inflight.get(key)) is None:
+            task = asyncio.create_task(self._fetch(key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    async def _fetch(self, key: Hashable) -> AccessToken:
+        self.metrics.refreshes += 1
+        token = await self.fetch(key)
+        self._tokens[key] = token
+        return token
+
+    def _done(self, key: Hashable, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        if task.cancelled():
+            return
+        if (err := task.exception()) is not None:
+            self.metrics.failures += 1
+            logging.warning('%s 刷新 token 失败 %s: %s', self.name, key, err)
@@ -0,0 +1,105 @@
+import asyncio
+import json
+import logging
+from collections.abc import Callable
+from contextvars import ContextVar
+from datetime import timedelta
+
+import pendulum
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from tpdingding.handler.handle import handle_event
+from tpdingding.helper.session import SessionScope
+from tpdingding.helper.session import background_session
+from tpdingding.model.context import Context
+from tpdingding.model.inbox import InboxEvent
+from tpdingding.model.inbox import InboxStatus
+from tpdingding.persistence.inbox import EventInboxMixIn
+
+
+class InboxWorkerPool:
+    """
+    处理钉钉事件回调收件箱的 worker 协程池
+
+    回调只把解密后的事件写入收件箱就返回, 每个 gunicorn worker 进程各自启动一个协程池处理事件。
+    handler 按企业分组在各自的事务中提交, 全部成功后再删除事件, 与 handler 的写入不在同一个事务中;
+    worker 在删除之前崩溃或者部分分组失败时事件会被重新处理 (至少一次), 已提交的 bizData 由 event_dedup 跳过。
+    处理失败的事件按指数退避重试, 超过 max_attempts 次后标记为 FAILED
+    """
+
+    def __init__(
+        self,
+        repo: EventInboxMixIn,
+        context: Context,
+        session: tuple[ContextVar[SessionScope], Callable[[], AsyncSession]],
+        workers: int,
+        poll_interval: float,
+        lease: float,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+    ):
+        self.repo = repo
+        self.context = context
+        self.session = session
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        logging.info('启动事件收件箱 worker, 数量: %s', self.workers)
+        self._tasks = [asyncio.create_task(self._run(), name=f'inbox-worker-{i}') for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logging.info('事件收件箱 worker 已停止')
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                processed = await self._process_one()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('事件收件箱 worker 处理异常')
+                processed = False
+
+            if not processed:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _process_one(self) -> bool:
+        # 领取单独提交, 处理事件时不占用 sqlite 的写锁等待其他 worker
+        async with background_session(*self.session):
+            if (event := await self.repo.claim_event(self.lease)) is None:
+                return False
+
+        try:
+            async with background_session(*self.session):
+                await handle_event(self.context, json.loads(event.payload))
+                if not await self.repo.delete_event(event.id, event.claim_id):
+                    logging.warning('事件 %s 的租约已过期并被重新领取, 不删除', event.id)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            await self._fail(event, err)
+        return True
+
+    async def _fail(self, event: InboxEvent, err: Exception) -> None:
+        async with background_session(*self.session):
+            if event.attempts >= self.max_attempts:
+                logging.error('事件 %s 第 %s 次处理失败, 不再重试: %s', event.id, event.attempts, err)
+                await self.repo.update_event(event.id, event.claim_id, InboxStatus.FAILED, str(err))
+                return
+            delay = min(self.backoff_base * 2 ** (event.attempts - 1), self.backoff_max)
+            logging.warning('事件 %s 第 %s 次处理失败, %s 秒后重试: %s', event.id, event.attempts, delay, err)
+            await self.repo.update_event(
+                event.id,
+                event.claim_id,
+                InboxStatus.PENDING,
+                str(err),
+                next_attempt_at=pendulum.now('UTC') + timedelta(seconds=delay),
+            )
@@ -0,0 +1,157 @@
+import asyncio
+import logging
+from datetime import datetime
+from datetime import timedelta
+from typing import Optional
+
+import pendulum
+
+from tpdingding.helper.session import POSTGRES_SESSION_VAR
+from tpdingding.helper.session import PostgresSession
+from tpdingding.helper.session import background_session
+from tpdingding.model.entity import DeliveryStatus
+from tpdingding.model.entity import SendMessageInput
+from tpdingding.model.entity import SendMessageReport
+from tpdingding.model.outbox import OutboxEntry
+from tpdingding.model.outbox import OutboxStatus
+from tpdingding.persistence.postgres import PostgresRepository
+from tpdingding.service.message import MessageService
+
+
+class OutboxWorkerPool:
+    """
+    消费消息发件箱的 worker 协程池
+
+    每个 gunicorn worker 进程各自启动一个协程池, 多个进程之间通过 FOR UPDATE SKIP LOCKED 互斥。
+    领取, 解析接收人与记录结果各自是一个短事务, 发送时不持有事务和连接; worker 崩溃时租约到期后消息会被重新领取。
+    每个接收人的发送结果保存在发件箱中, 有接收人发送失败时按指数退避只重试失败的接收人,
+    超过 max_attempts 次后标记为 FAILED
+    """
+
+    def __init__(
+        self,
+        repo: PostgresRepository,
+        message_srv: MessageService,
+        workers: int,
+        poll_interval: float,
+        lease: float,
+        max_attempts: int,
+        backoff_base: float,
+        backoff_max: float,
+    ):
+        self.repo = repo
+        self.message_srv = message_srv
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self) -> None:
+        logging.info('启动消息发件箱 worker, 数量: %s', self.workers)
+        self._tasks = [asyncio.create_task(self._run(), name=f'outbox-worker-{i}') for i in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        logging.info('消息发件箱 worker 已停止')
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                processed = await self._process_one()
+            except Exception:  # pylint: disable=broad-exception-caught
+                logging.exception('消息发件箱 worker 处理异常')
+                processed = False
+
+            if not processed:
+                await asyncio.sleep(self.poll_interval)
+
+    async def _process_one(self) -> bool:
+        async with background_session(POSTGRES_SESSION_VAR, PostgresSession):
+            if (entry := await self.repo.claim_outbox_message(self.lease)) is None:
+                return False
+
+        if entry.attempts > self.max_attempts:
+            # 最后一次发送时 worker 崩溃, 租约到期后被重新领取
+            await self._record(entry, OutboxStatus.FAILED, '超过最大发送次数')
+            return True
+        await self._deliver(entry)
+        return True
+
+    async def _deliver(self, entry: OutboxEntry) -> None:
+        try:
+            report = await self._send(entry)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            await self._retry(entry, str(err))
+            return
+
+        if report is None:
+            await self._record(entry, OutboxStatus.FAILED, '没有找到任何用户')
+        elif failed := report.of_status(DeliveryStatus.FAILED):
+            error = f"发送消息失败 {[(recipient.staff_id, recipient.errmsg) for recipient in failed]}"
+            await self._retry(entry, error, report)
+        else:
+            await self._record(entry, OutboxStatus.SUCCEEDED, report=report)
+
+    async def _send(self, entry: OutboxEntry) -> Optional[SendMessageReport]:
+        """
+        重试时只发送给之前失败的接收人, 返回与之前的结果合并后的发送结果
+
+        已发送成功的用户不会重复收到; 一次钉钉调用在结果返回之前中断时, 该分片的用户仍可能重复收到
+        """
+        message = SendMessageInput.parse_raw(entry.payload)
+        previous = SendMessageReport.parse_raw(entry.report) if entry.report else None
+        if previous is not None:
+            message.staff_ids = [recipient.staff_id for recipient in previous.of_status(DeliveryStatus.FAILED)]
+
+        async with background_session(POSTGRES_SESSION_VAR, PostgresSession):
+            recipients = await self.message_srv.resolve(message)
+        if previous is None:
+            return await self.message_srv.deliver(message, recipients, entry.created_at) if recipients else None
+
+        # 之前失败的接收人重新解析不到时记为 NOT_FOUND
+        report = await self.message_srv.deliver(message, recipients, entry.created_at)
+        deliveries = {recipient.staff_id: recipient for recipient in previous.recipients}
+        deliveries.update((recipient.staff_id, recipient) for recipient in report.recipients)
+        return SendMessageReport(recipients=list(deliveries.values()))
+
+    async def _retry(self, entry: OutboxEntry, error: str, report: Optional[SendMessageReport] = None) -> None:
+        if entry.attempts >= self.max_attempts:
+            logging.error('发件箱消息 %s 第 %s 次发送失败, 不再重试: %s', entry.id, entry.attempts, error)
+            await self._record(entry, OutboxStatus.FAILED, error, report=report)
+            return
+        delay = min(self.backoff_base * 2 ** (entry.attempts - 1), self.backoff_max)
+        logging.warning('发件箱消息 %s 第 %s 次发送失败, %s 秒后重试: %s', entry.id, entry.attempts, delay, error)
+        await self._record(
+            entry,
+            OutboxStatus.PENDING,
+            error,
+            next_attempt_at=pendulum.now() + timedelta(seconds=delay),
+            report=report,
+        )
+
+    async def _record(
+        self,
+        entry: OutboxEntry,
+        status: OutboxStatus,
+        last_error: Optional[str] = None,
+        next_attempt_at: Optional[datetime] = None,
+        report: Optional[SendMessageReport] = None,
+    ) -> None:
+        async with background_session(POSTGRES_SESSION_VAR, PostgresSession):
+            recorded = await self.repo.update_outbox_message(
+                entry.id,
+                entry.attempts,
+                status,
+                last_error,
+                next_attempt_at=next_attempt_at,
+                report=report.json() if report is not None else None,
+            )
+        if not recorded:
+            logging.warning('发件箱消息 %s 的租约已过期并被重新领取, 第 %s 次的结果 %s 没有保存', entry.id, entry.attempts, status)